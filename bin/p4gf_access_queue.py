@@ -1,17 +1,28 @@
 #! /usr/bin/env python3.3
 '''AccessQueue'''
 
-from collections import deque
+from collections import OrderedDict
 
 # pylint: disable=C0103
 # Invalid name
 class AccessQueue:
     '''
-    A queue where the least-recently accessed object is at index 0, most
+    A queue where the least-recently accessed object is at the front, most
     recently accessed object is at the end of the queue.
+
+    Objects must be hashable. Every operation takes constant time: an
+    OrderedDict moves an accessed object to the end without searching for
+    it, which a deque.remove() would do.
     '''
     def __init__(self, maxlen=None):
-        self.q = deque(maxlen=maxlen)
+        self.maxlen = maxlen
+        self.q      = OrderedDict()
+
+    def __len__(self):
+        return len(self.q)
+
+    def __contains__(self, obj):
+        return obj in self.q
 
     def access(self, obj):
         '''
@@ -23,37 +34,36 @@ class AccessQueue:
 
         Return None if nothing fell off the queue.
         '''
-        prev_first = None
-        if self.q:
-            prev_first = self.q[0]
-
         if obj in self.q:
-            self.q.remove(obj)
-
-        self.q.append(obj)
-
-        if (prev_first != self.q[0]
-            and prev_first != obj):
-            return prev_first
+            self.q.move_to_end(obj)
+            return None
 
+        self.q[obj] = None
+        if self.maxlen is not None and self.maxlen < len(self.q):
+            return self.q.popitem(last=False)[0]
         return None
 
     def pop_oldest(self):
         '''
         Remove the least-recently-accessed object from our queue and return it.
         '''
-        return self.q.popleft()
+        return self.q.popitem(last=False)[0]
+
+    def remove(self, obj):
+        '''
+        Remove an object from our queue, if present.
+        '''
+        self.q.pop(obj, None)
 
     def is_full(self):
         '''
         Are we at capacity, will a call to access() of something not in our queue
         cause an object to fall off?
         '''
-        return self.q.maxlen == len(self.q)
+        return self.maxlen is not None and self.maxlen <= len(self.q)
 
     def clear(self):
         '''
         Reset to empty.
         '''
         self.q.clear()
-
@@ -32,11 +32,19 @@ import time
 import traceback
 
 import p4gf_env_config  # pylint: disable=W0611
+import p4gf_daemon_client
+if __name__ == "__main__":
+    # Let a running p4gf_daemon.py serve this request, if there is one,
+    # before we pay to import everything else.
+    p4gf_daemon_client.serve(p4gf_daemon_client.ENTRY_AUTH_SERVER)
+# pylint:disable=C0413
+# Import not at top of module: deliberately after the daemon hand-off.
 import p4gf_call_git
 import p4gf_const
 import p4gf_context
 import p4gf_copy_p2g
 import p4gf_create_p4
+import p4gf_fast_fetch
 import p4gf_gc
 import p4gf_git
 from   p4gf_git_swarm import GSReviewCollection
@@ -53,8 +61,10 @@ import p4gf_util
 import p4gf_version
 import p4gf_atomic_lock
 import p4gf_translate
+# pylint:enable=C0413
 
 LOG = p4gf_log.for_module()
+LOG_LOCK_WAIT = LOG.getChild(NTR('lock_wait'))
 
 
 def _log_environ(environ):
@@ -185,14 +195,43 @@ def _call_git(args, ctx):
         args -- parsed command line arguments object.
         ctx -- context object.
     """
+    return _call_git_dir(args, ctx.view_dirs.GIT_DIR)
+
+
+def _call_git_dir(args, git_dir):
+    """
+    Invoke the git command on git_dir, returning its exit code.
+
+    Arguments:
+        args -- parsed command line arguments object.
+        git_dir -- absolute path to the Git Fusion repo.
+    """
     # Pass to git-upload-pack/git-receive-pack. But with the view
     # converted to an absolute path to the Git Fusion repo.
     converted_argv = args.options[:-1]
-    converted_argv.append(ctx.view_dirs.GIT_DIR)
+    converted_argv.append(git_dir)
     cmd_list = args.command + converted_argv
     return p4gf_proc.call(cmd_list)
 
 
+def _log_lock_wait(view_name, path):
+    """
+    Record how long this request waited for locks, so that an admin can
+    watch lock contention by enabling DEBUG for p4gf_auth_server.lock_wait.
+
+    Arguments:
+        view_name -- internal repo name.
+        path -- which way we served the request: fast fetch, fetch, or push.
+    """
+    if not LOG_LOCK_WAIT.isEnabledFor(logging.DEBUG):
+        return
+    totals = p4gf_lock.lock_wait_totals()
+    waits = ['{} {:.0f} ms'.format(kind, 1000 * totals[kind][1])
+             for kind in (p4gf_lock.VIEW, p4gf_lock.SHARED, p4gf_lock.EXCLUSIVE)
+             if kind in totals]
+    LOG_LOCK_WAIT.debug('{} {}: {}'.format(path, view_name, ', '.join(waits) or NTR('none')))
+
+
 # pylint: disable=R0915, R0912
 def main(poll_only=False):
     """set up repo for a view
@@ -233,12 +272,14 @@ def main(poll_only=False):
             return 2
         LOG.debug("connected to P4: %s", p4)
 
-        p4gf_server_common.check_readiness(p4)
+        # A p4gf_daemon.py parent may have run these checks for us.
+        if not p4gf_server_common.checks_passed():
+            p4gf_server_common.check_readiness(p4)
 
-        p4gf_server_common.check_lock_perm(p4)
+            p4gf_server_common.check_lock_perm(p4)
 
-        if not p4gf_server_common.check_protects(p4):
-            p4gf_server_common.raise_p4gf_perm()
+            if not p4gf_server_common.check_protects(p4):
+                p4gf_server_common.raise_p4gf_perm()
 
         if p4gf_server_common.run_special_command(view_name, p4, args.user):
             return 0
@@ -264,14 +305,26 @@ def main(poll_only=False):
                                                    view_name)
 
         # Create Git Fusion server depot, user, config. NOPs if already created.
-        p4gf_init.init(p4)
+        if not p4gf_server_common.checks_passed():
+            p4gf_init.init(p4)
 
         write_motd()
 
+        # A fetch with nothing new to copy from Perforce need not wait for
+        # the view lock or build a Context. Serve it straight from Git.
+        if not (poll_only or is_push):
+            code = p4gf_fast_fetch.fetch( p4, view_name
+                                        , functools.partial(_call_git_dir, args)
+                                        , view_perm )
+            if code is not None:
+                _log_lock_wait(view_name, NTR('fast fetch'))
+                return code
+
         # view_name is the internal view_name (identical when notExist special chars)
         before_lock_time = time.time()
         with p4gf_lock.view_lock(p4, view_name) as view_lock:
             after_lock_time = time.time()
+            p4gf_lock.record_lock_wait(p4gf_lock.VIEW, after_lock_time - before_lock_time)
 
             # Create Git Fusion per-repo client view mapping and config.
             #
@@ -318,6 +371,7 @@ def main(poll_only=False):
                         p4gf_git.set_bare(False)
                         p4gf_copy_p2g.copy_p2g_ctx(ctx)
                         p4gf_init_repo.process_imports(ctx)
+                        p4gf_fast_fetch.record(ctx)
 
                         # Now is also an appropriate time to clear out any stale Git
                         # Swarm reviews. We're pre-pull, pre-push, time when we've
@@ -354,6 +408,12 @@ def main(poll_only=False):
                         # branch. Must include all lightweight branches, too.
                         ctx.switch_client_view_to_union()
 
+                        # A push may change what fetches must check for.
+                        # Make them take the full path until the next one
+                        # records it anew.
+                        if is_push:
+                            p4gf_fast_fetch.forget(view_name)
+
                         exclusive = 'upload' not in args.command[0]
                         code = p4gf_call_git.call_git(
                                 git_caller, ctx, view_name, view_lock, exclusive)
@@ -364,6 +424,7 @@ def main(poll_only=False):
                         code = os.EX_SOFTWARE
 
             p4gf_gc.process_garbage(NTR('at end of auth_server'))
+            _log_lock_wait(view_name, NTR('push') if is_push else NTR('fetch'))
             if LOG.isEnabledFor(logging.DEBUG):
                 end_time = time.time()
                 frm = NTR("Runtime: preparation {} ms, lock acquisition {} ms,"
@@ -388,7 +449,11 @@ def main_ignores():
 #pylint:enable=E0602
 
 
-if __name__ == "__main__":
+def run_main():
+    """
+    Serve one request from sys.argv, os.environ, and stdin/stdout/stderr.
+    Run as __main__, or in a p4gf_daemon.py child. Exits via sys.exit().
+    """
     # Ensure any errors occurring in the setup are sent to stderr, while the
     # code below directs them to stderr once rather than twice.
     try:
@@ -401,5 +466,10 @@ if __name__ == "__main__":
     except:
         # Cannot continue if above code failed.
         sys.exit(1)
+    # pylint: enable=W0702
     # main() already writes errors to stderr, so don't let logger do it again
     p4gf_log.run_with_exception_logger(main_ignores, write_to_stderr=False)
+
+
+if __name__ == "__main__":
+    run_main()
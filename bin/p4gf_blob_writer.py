@@ -0,0 +1,303 @@
+#! /usr/bin/env python3.3
+'''
+Write one Git blob object, hashing and compressing content as it arrives.
+
+A Git blob's sha1 covers a "blob {size}\\0" header followed by the content,
+so we cannot start hashing until we know the content's size. When the caller
+knows that size up front (such as the fileSize that 'p4 print' reports in
+its tagged stat), BlobWriter emits the header immediately and hashes and
+compresses each chunk in a single pass: no spooling to a temp file, no
+re-reading that temp file.
+
+When the size is unknown, or the caller will rewrite content on its way in
+(ktext unexpansion, symlink newline trim), BlobWriter spools the content to a
+SpooledTemporaryFile and hashes/compresses it at close(), same as before.
+
+If streamed content turns out not to match its promised size, close()
+recovers the content from the compressed temp file and re-hashes it with
+the correct header. Slow, but correct, and rare.
+
+Given a PackWriter, BlobWriter appends blobs to a packfile instead of writing
+loose objects. Pack entries carry no "blob {size}\0" header, so in that mode
+only the sha1, not the compressed stream, sees the header.
+'''
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+
+from   p4gf_l10n      import NTR
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # pylint:disable=W1401
+                        # Anomalous backslash in string: '\0'
+_BLOB_HEADER = NTR('blob {}\0')
+                        # pylint:enable=W1401
+
+                        # Spool content up to this size in memory before
+                        # rolling over to a real temp file.
+_SPOOL_MAX_MEMORY = 1024 * 1024
+
+                        # Chunk size when reading spooled or compressed
+                        # content back.
+_CHUNK_SIZE = 64 * 1024
+
+
+class BlobWriter:
+    '''
+    Accumulate one blob's content, write it as a loose object or pack entry.
+
+    Create one BlobWriter per blob. write() content, then close() to get the
+    sha1 and land the loose object under objects_dir (or in pack_writer's
+    pack). Call discard() instead of close() to abandon a partially written
+    blob.
+    '''
+
+    def __init__(self, tempdir, size=None, objects_dir='.git/objects'
+                , pack_writer=None):
+        '''
+        size is the number of content bytes the caller promises to
+        write(), or None if unknown. Pass None if the caller will alter the
+        content before it reaches write().
+
+        pack_writer is an optional p4gf_git_pack.PackWriter.
+        '''
+        self.tempdir     = tempdir
+        self.objects_dir = objects_dir
+        self.pack_writer = pack_writer
+        self.size        = size
+        self.byte_count  = 0
+
+                        # Streaming: sha1 and zlib fed as content arrives.
+        self._sha1       = None
+        self._compress   = None
+        self._compressed = None     # temp file of zlib output
+
+                        # Spooling: content held until close().
+        self._spool      = None
+
+        if size is None:
+            self._spool = tempfile.SpooledTemporaryFile(
+                                      max_size = _SPOOL_MAX_MEMORY
+                                    , dir      = tempdir
+                                    , prefix   = NTR('p2g-print-') )
+        else:
+            self._start_stream(size)
+
+    @property
+    def is_streaming(self):
+        '''Are we hashing as we go, or spooling until close()?'''
+        return self._spool is None
+
+    def write(self, data):
+        '''
+        Append a chunk of content.
+        '''
+        if not len(data):
+            return
+        self.byte_count += len(data)
+        if self._spool is not None:
+            self._spool.write(data)
+        else:
+            self._sha1.update(data)
+            self._compressed.write(self._compress.compress(data))
+
+    def trim_trailing_newline(self):
+        '''
+        If spooled content ends with a newline, drop that newline.
+
+        'p4 print' adds a trailing newline to symlink content, which is no
+        good for Git symlinks. Only legal when spooling: streamed content is
+        already hashed.
+        '''
+        assert self._spool is not None
+        size = self._spool.tell()
+        if not size:
+            return
+        self._spool.seek(-1, 2)
+        if self._spool.read(1) == b'\n':
+            self._spool.seek(size - 1)
+            self._spool.truncate()
+            self.byte_count -= 1
+
+    def close(self):
+        '''
+        Finish the blob, move it into objects_dir if not already there.
+
+        Return its sha1 as a 40-char hex string.
+        '''
+        if self._spool is not None:
+            self._stream_spool()
+        elif self.byte_count != self.size:
+            LOG.debug('size mismatch: promised={} actual={}. Re-hashing.'
+                      .format(self.size, self.byte_count))
+            self._restream()
+
+        self._compressed.write(self._compress.flush())
+        sha1 = self._sha1.hexdigest()
+        if self.pack_writer:
+            self._compressed.seek(0)
+            self.pack_writer.add(sha1, NTR('blob'), self.size, self._compressed)
+            self._compressed.close()
+            self._compressed = None
+        else:
+            self._compressed.close()
+            self._land(sha1)
+        return sha1
+
+    def discard(self):
+        '''
+        Abandon this blob, delete any temp files.
+        '''
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self._compressed:
+            self._compressed.close()
+            if not self.pack_writer:
+                _unlink_quietly(self._compressed.name)
+            self._compressed = None
+
+    def _start_stream(self, size):
+        '''
+        Emit the header, prepare to hash and compress content.
+        '''
+        self.size        = size
+                        # pylint:disable=E1101
+                        # Module 'hashlib' has no 'sha1' member
+        self._sha1       = hashlib.sha1()
+                        # pylint:enable=E1101
+        self._compress   = zlib.compressobj()
+        header = _BLOB_HEADER.format(size).encode()
+        self._sha1.update(header)
+        if self.pack_writer:
+                        # Pack entry: stays in memory unless huge, then
+                        # copied into the pack. No header in the stream.
+            self._compressed = tempfile.SpooledTemporaryFile(
+                                      max_size = _SPOOL_MAX_MEMORY
+                                    , dir      = self.tempdir
+                                    , prefix   = NTR('p2g-blob-') )
+        else:
+                        # Loose object: renamed into place at close().
+            self._compressed = tempfile.NamedTemporaryFile(
+                                      delete = False
+                                    , dir    = self.tempdir
+                                    , prefix = NTR('p2g-blob-') )
+            self._compressed.write(self._compress.compress(header))
+
+    def _stream_spool(self):
+        '''
+        Now that we know the spooled content's size, stream it through the
+        hasher and compressor.
+        '''
+        spool = self._spool
+        self._spool = None
+        self._start_stream(spool.tell())
+        spool.seek(0)
+        self._pump(spool)
+        spool.close()
+
+    def _restream(self):
+        '''
+        Streamed content did not match its promised size. Our header, and
+        thus our sha1, is wrong. Recover the content from our compressed
+        temp file and start over with the correct size.
+        '''
+        old = self._compressed
+        old.write(self._compress.flush())
+        old.seek(0)
+        spool = tempfile.SpooledTemporaryFile( max_size = _SPOOL_MAX_MEMORY
+                                             , dir      = self.tempdir
+                                             , prefix   = NTR('p2g-print-') )
+        decompress = zlib.decompressobj()
+        if self.pack_writer:
+            header_skip = 0
+        else:
+            header_skip = len(_BLOB_HEADER.format(self.size).encode())
+        while True:
+            chunk = old.read(_CHUNK_SIZE)
+            if chunk:
+                data = decompress.decompress(chunk)
+            else:
+                data = decompress.flush()
+            if header_skip:
+                skip = min(header_skip, len(data))
+                data = data[skip:]
+                header_skip -= skip
+            spool.write(data)
+            if not chunk:
+                break
+        old.close()
+        if not self.pack_writer:
+            _unlink_quietly(old.name)
+        self._spool = spool
+        self._stream_spool()
+
+    def _pump(self, f):
+        '''
+        Feed file f's remaining content through the hasher and compressor.
+        '''
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            self._sha1.update(chunk)
+            self._compressed.write(self._compress.compress(chunk))
+
+    def _land(self, sha1):
+        '''
+        Move our compressed temp file to its loose object path.
+        If another writer beat us to it, drop ours.
+        '''
+        obj_dir  = os.path.join(self.objects_dir, sha1[:2])
+        obj_path = os.path.join(obj_dir, sha1[2:])
+        if os.path.exists(obj_path):
+            _unlink_quietly(self._compressed.name)
+        else:
+            p4gf_util.ensure_dir(obj_dir)
+            shutil.move(self._compressed.name, obj_path)
+            p4gf_util.chmod_644_minimum(obj_path)
+        self._compressed = None
+
+# -- end class BlobWriter -----------------------------------------------------
+
+
+def _unlink_quietly(path):
+    '''
+    Delete a temp file, not caring if it's already gone.
+    '''
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def size_if_streamable(vardict, p4file, need_unexpand=False, charset=None):
+    '''
+    Return the int fileSize reported by a 'p4 print' tagged stat, if that
+    size will match the bytes we eventually hash for this file revision.
+
+    Return None if the server did not report a size, or if we will rewrite
+    the content before hashing it: symlink newline trim, ktext
+    unexpansion, or charset translation of unicode files. Callers pass None
+    to BlobWriter to spool such content.
+    '''
+    if p4file.is_symlink():
+        return None
+    if need_unexpand and p4file.is_k_type():
+        return None
+    if charset and p4file.is_unicode():
+        return None
+    v = vardict.get('fileSize')
+    if v is None:
+        return None
+    if isinstance(v, bytes):
+        v = v.decode()
+    try:
+        return int(v)
+    except ValueError:
+        return None
@@ -6,19 +6,176 @@ A pool of temporary Perforce client spec objects that we can use when querying
 Perforce for files within a defined view, usually a single branch view.
 
 """
+import errno
+import fcntl
+import hashlib
+import json
 import logging
+import os
+import time
 
 from   p4gf_access_queue import AccessQueue
 import p4gf_branch
+import p4gf_config
 import p4gf_const
 from   p4gf_l10n import _, NTR
 import p4gf_util
 
 LOG = logging.getLogger(__name__)
 
+                        # Shared by all processes on this host that use
+                        # this repo's pool, in the repo's view directory.
+_INDEX_FILE = NTR('client-pool.json')
+
+                        # Counter names, as reported in our debug log and
+                        # accumulated in the index file.
+HIT     = NTR('hit')        # already ours, no Perforce or index access
+REUSE   = NTR('reuse')      # another process already set this view
+CREATE  = NTR('create')     # new client spec
+SWITCH  = NTR('switch')     # changed an unused client's view
+DELETE  = NTR('delete')     # trimmed back to pool size
+COUNTERS = [HIT, REUSE, CREATE, SWITCH, DELETE]
+
+
 def _to_key(view_lines):
-    '''list of lines is not hashable. Join 'em.'''
-    return '\n'.join(view_lines)
+    '''
+    list of lines is not hashable, and can be long. Hash 'em.
+    '''
+    return hashlib.sha1('\n'.join(view_lines).encode('utf-8')).hexdigest()
+
+
+def _pid_alive(pid):
+    '''
+    Is process pid still running on this host?
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def delete_temp_clients(p4, view_name):
+    '''
+    Delete any temp client specs created on this server for this repo.
+
+    For p4gf_delete_repo: the pool keeps its clients between processes.
+    '''
+    pattern = p4gf_const.P4GF_REPO_TEMP_CLIENT.format( server_id = p4gf_util.get_server_id()
+                                                     , repo_name = view_name
+                                                     , n         = '*')
+    clients = [client['client'] for client
+               in p4.run(NTR(["clients", "-e", pattern]))]
+    for client in clients:
+        p4.run(NTR(["client", "-d", client]))
+    return len(clients)
+
+
+class _Index:
+    '''
+    Which clients exist in this repo's pool, which view each has, when each
+    was last used, and which processes are using each.
+
+        {"clients": {client_name: {"view":  view key or null,
+                                   "used":  time.time(),
+                                   "pids":  [pid, ...]}},
+         "counts":  {counter name: count}}
+
+    A JSON file that a process holds an exclusive flock on from reading
+    it until writing it back.
+    '''
+
+    def __init__(self, path):
+        self.path    = path
+        self.fd      = None
+        self.clients = {}
+        self.counts  = {}
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                break
+            except InterruptedError:
+                continue
+        try:
+            content = json.loads(os.pread(self.fd, os.fstat(self.fd).st_size, 0)
+                                 .decode('utf-8') or '{}')
+            self.clients = content.get(NTR('clients'), {})
+            self.counts  = content.get(NTR('counts'),  {})
+        except (ValueError, AttributeError):
+            LOG.warning('ignoring unreadable client pool index {}'.format(self.path))
+            self.clients = {}
+            self.counts  = {}
+        # Forget any process that exited without releasing its clients.
+        for client in self.clients.values():
+            client[NTR('pids')] = [pid for pid in client.get(NTR('pids'), [])
+                                   if _pid_alive(pid)]
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        try:
+            if exc_type is None:
+                data = json.dumps({ NTR('clients') : self.clients
+                                  , NTR('counts')  : self.counts }).encode('utf-8')
+                os.ftruncate(self.fd, 0)
+                os.pwrite(self.fd, data, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        return False
+
+    def client_for_view(self, key):
+        '''
+        Return the name of the client whose view has key, or None.
+        '''
+        for (client_name, client) in self.clients.items():
+            if client.get(NTR('view')) == key:
+                return client_name
+        return None
+
+    def lease(self, client_name, key, pid):
+        '''
+        Record that process pid uses client_name, which has view key.
+        '''
+        client = self.clients.setdefault(client_name, {NTR('pids'): []})
+        client[NTR('view')] = key
+        client[NTR('used')] = time.time()
+        if pid not in client[NTR('pids')]:
+            client[NTR('pids')].append(pid)
+
+    def release(self, client_name, pid):
+        '''
+        Record that process pid no longer uses client_name.
+        '''
+        client = self.clients.get(client_name)
+        if not client:
+            return
+        client[NTR('used')] = time.time()
+        if pid in client[NTR('pids')]:
+            client[NTR('pids')].remove(pid)
+
+    def least_recently_used_unused(self):
+        '''
+        Return the name of the least-recently-used client that no process
+        uses, or None if every client is in use.
+        '''
+        unused = [(client.get(NTR('used'), 0), client_name)
+                  for (client_name, client) in self.clients.items()
+                  if not client[NTR('pids')]]
+        if not unused:
+            return None
+        return min(unused)[1]
+
+    def add_counts(self, counts):
+        '''
+        Accumulate one process's counters into our host-wide totals.
+        '''
+        for (name, count) in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+
 
 # pylint: disable=C0103
 # Invalid name
@@ -32,21 +189,35 @@ class ClientPool:
     view over and over, create a pool of clients, each switched to a view, and use
     the appropriate client for the query.
 
-    Deletes clients upon exit.
+    Clients outlive the process that creates them: every process on this host
+    that queries this repo shares one pool of up to client-pool-size clients,
+    recorded in an index file in the repo's view directory. A process that
+    needs a view that some earlier process already set reuses that client
+    without writing to db.view at all. A process never switches the view of a
+    client that another live process is using. When every client is in use,
+    it creates one more, and cleanup() trims the pool back to size.
     '''
 
     def __init__(self, ctx):
         self.ctx                       = ctx
 
-            # A queue of view_lines, sequenced by access time.
-            # When we're full, we pop the least-recently-accessed
-            # view_lines off this queue and recycle its associated
-            # client spec.
-        self.q                         = AccessQueue(maxlen=10)
+            # Pool size from config, read upon first use.
+        self.size                      = None
 
-            # Associate view_lines with the client spec that uses them.
+            # A queue of view keys for the clients this process uses,
+            # sequenced by access time. When we're full, we release
+            # the least-recently-accessed client so that it may be
+            # recycled.
+        self.q                         = None
+
+            # Associate a view key with the client spec that uses it.
         self.view_lines_to_client_name = {}
 
+            # Have we checked our index against Perforce's client specs?
+        self.reconciled                = False
+
+        self.counts                    = dict.fromkeys(COUNTERS, 0)
+
     def for_view(self, view_lines):
         '''
         Return the name of a Perforce client spec that has the requested view.
@@ -56,18 +227,43 @@ class ClientPool:
         client_name = self.view_lines_to_client_name.get(key)
         if client_name:
             self.q.access(key)
+            self.counts[HIT] += 1
             return client_name
 
-        # Do we have room to create a new client?
-        if not self.q.is_full():
-            client_name = self._create_client_for_view_lines(view_lines)
+        if self.q is None:
+            self.size = self._configured_size()
+            self.q = AccessQueue(maxlen=self.size)
 
-        # No room. Recycle an old client.
-        else:
-            old_view_lines = self.q.pop_oldest()
-            client_name    = self.view_lines_to_client_name[old_view_lines]
-            del self.view_lines_to_client_name[old_view_lines]
-            self._set_view_lines(client_name, view_lines)
+        pid = os.getpid()
+        with _Index(self._index_path()) as index:
+            if not self.reconciled:
+                self._reconcile(index)
+
+            # No room for another of ours? Release our oldest.
+            if self.q.is_full():
+                old_key = self.q.pop_oldest()
+                index.release(self.view_lines_to_client_name.pop(old_key), pid)
+
+            # Has some process already set a client to this view?
+            client_name = index.client_for_view(key)
+            if client_name:
+                self.counts[REUSE] += 1
+            else:
+                # Room for a new client? Or one nobody's using to recycle?
+                # If neither, grow past our size until cleanup().
+                if len(index.clients) < self.size:
+                    client_name = None
+                else:
+                    client_name = index.least_recently_used_unused()
+                if client_name:
+                    self._set_view_lines(client_name, view_lines)
+                    self.counts[SWITCH] += 1
+                else:
+                    client_name = self._create_client_for_view_lines(
+                                        view_lines, self._generate_client_name(index))
+                    self.counts[CREATE] += 1
+
+            index.lease(client_name, key, pid)
 
         self.q.access(key)
         self.view_lines_to_client_name[key] = client_name
@@ -75,29 +271,92 @@ class ClientPool:
 
     def cleanup(self):
         '''
-        Delete any temp client specs created on this server for this repo.
+        Release the clients this process used, and delete the least-recently-
+        used clients that no process is using until the pool is back down to
+        its configured size.
+
+        Does not delete the rest: the next process to query this repo can
+        reuse them.
+        '''
+        if self.q is None:
+            return
+        index_path = self._index_path()
+        if not os.path.isdir(os.path.dirname(index_path)):
+            # p4gf_delete_repo removed the repo, and with it our pool.
+            return
+
+        pid = os.getpid()
+        with _Index(index_path) as index:
+            for client_name in self.view_lines_to_client_name.values():
+                index.release(client_name, pid)
+            while self.size < len(index.clients):
+                client_name = index.least_recently_used_unused()
+                if not client_name:
+                    break
+                LOG.debug2('cleanup() deleting name={}'.format(client_name))
+                self.ctx.p4gfrun(NTR(["client", "-d", client_name]))
+                del index.clients[client_name]
+                self.counts[DELETE] += 1
+            index.add_counts(self.counts)
+            totals = dict(index.counts)
+
+        LOG.debug('client pool {view}: {this} (this host: {host})'
+                  .format( view = self.ctx.config.view_name
+                         , this = _format_counts(self.counts)
+                         , host = _format_counts(totals)))
+        self.q.clear()
+        self.view_lines_to_client_name.clear()
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+    def _configured_size(self):
+        '''
+        Return the pool size from this repo's config.
+        '''
+        config = p4gf_config.get_repo(self.ctx.p4gf, self.ctx.config.view_name)
+        try:
+            size = config.getint( p4gf_config.SECTION_REPO
+                                , p4gf_config.KEY_CLIENT_POOL_SIZE
+                                , fallback = int(p4gf_config.VALUE_CLIENT_POOL_SIZE))
+        except ValueError:
+            LOG.warning('{} config setting has invalid value, using {}'
+                        .format( p4gf_config.KEY_CLIENT_POOL_SIZE
+                               , p4gf_config.VALUE_CLIENT_POOL_SIZE))
+            size = int(p4gf_config.VALUE_CLIENT_POOL_SIZE)
+        return max(1, size)
+
+    def _index_path(self):
+        '''
+        Where do we record this repo's pool?
+        '''
+        return os.path.join(self.ctx.view_dirs.view_container, _INDEX_FILE)
 
-        Don't limit this to clients created by this pool instance.
+    def _reconcile(self, index):
+        '''
+        Forget any client in our index that no longer exists in Perforce.
+        Adopt any that exists without an index entry, such as one left
+        behind by an older Git Fusion, so that it is recycled first.
         '''
         pattern = p4gf_const.P4GF_REPO_TEMP_CLIENT.format( server_id = p4gf_util.get_server_id()
                                                          , repo_name = self.ctx.config.view_name
                                                          , n         = '*')
-        clients = [client['client'] for client
-                   in self.ctx.p4gfrun(NTR(["clients", "-e", pattern]))]
-        for client in clients:
-            self.ctx.p4gfrun(NTR(["client", "-d", client]))
-        # also clear this instance of references to deleted clients
-        self.q.clear()
-        self.view_lines_to_client_name.clear()
+        existing = set(client['client'] for client
+                       in self.ctx.p4gfrun(NTR(["clients", "-e", pattern])))
+        for client_name in list(index.clients.keys()):
+            if client_name not in existing:
+                del index.clients[client_name]
+        for client_name in existing:
+            if client_name not in index.clients:
+                index.clients[client_name] = { NTR('view') : None
+                                             , NTR('used') : 0
+                                             , NTR('pids') : [] }
+        self.reconciled = True
 
-    def _create_client_for_view_lines(self, view_lines):
+    def _create_client_for_view_lines(self, view_lines, client_name):
         '''
         Create a new client spec with the requested view_lines.
 
         Return its name.
         '''
-        client_name = self._generate_client_name()
-
         # Let client root match the real ctx.p4's client so that server-
         # calculated local paths match. Might come in handy.
         client_root = self.ctx.contentlocalroot
@@ -144,12 +403,30 @@ class ClientPool:
                                     , 'client', client_name
                                     , { 'View' : new_view_map.as_array() })
 
-    def _generate_client_name(self):
+    def _generate_client_name(self, index):
         '''
         Return "git-fusion-{server_id}-{repo_name}-temp-{n}", suitable for use as a
-        name for a temporary client
+        name for a temporary client, with the lowest n not already in index.
         '''
-        return p4gf_const.P4GF_REPO_TEMP_CLIENT.format( server_id = p4gf_util.get_server_id()
-                                                      , repo_name = self.ctx.config.view_name
-                                                      , n         = len(self.q.q))
+        n = 0
+        while True:
+            client_name = p4gf_const.P4GF_REPO_TEMP_CLIENT.format(
+                                  server_id = p4gf_util.get_server_id()
+                                , repo_name = self.ctx.config.view_name
+                                , n         = n)
+            if client_name not in index.clients:
+                return client_name
+            n += 1
+
 
+def _format_counts(counts):
+    '''
+    Return "hit=N reuse=N create=N switch=N delete=N" and db.view writes
+    per lookup.
+    '''
+    lookups = sum(counts.get(name, 0) for name in [HIT, REUSE, CREATE, SWITCH])
+    writes  = sum(counts.get(name, 0) for name in [CREATE, SWITCH, DELETE])
+    return NTR('{counts} view-writes/lookup={rate:.3f}').format(
+          counts = ' '.join(NTR('{}={}').format(name, counts.get(name, 0))
+                            for name in COUNTERS)
+        , rate   = writes / lookups if lookups else 0.0 )
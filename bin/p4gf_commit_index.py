@@ -0,0 +1,204 @@
+#! /usr/bin/env python3.3
+'''
+A local, persistent index of one repo's Git commit <-> Perforce changelist
+mapping.
+
+The authoritative mapping lives in Perforce: one file per commit under
+//.git-fusion/objects/repos/{repo}/commits/..., plus git-fusion-index-*
+counters. Querying those costs a round trip to the Perforce server per
+lookup. Push preflight on large repos makes thousands of such lookups.
+
+CommitIndex copies the mapping into a SQLite file under the repo's view
+directory, along with a "high-water mark": the highest changelist that
+touched the commit files when we last synchronized. p4gf_object_type
+compares that against the server's current high-water mark (one cheap
+'p4 changes -m1') and fetches only the commit files submitted since.
+
+Each distinct sha1 also gets a sequence number when first added, so that
+consumers such as FastExport's persistent marks file can ask for "every
+sha1 added since sequence N" rather than re-read the whole index. A
+generation number changes whenever a sha1 leaves the index, telling those
+consumers to start over.
+
+This module knows nothing about Perforce. See p4gf_object_type for the
+synchronization logic.
+'''
+import logging
+import sqlite3
+
+from   p4gf_l10n      import NTR
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # Seconds to wait for another process to release
+                        # its lock on the index file.
+_BUSY_TIMEOUT = 60
+
+
+class CommitIndex:
+    '''
+    sha1 <-> (branch_id, change) for one repo, stored in a single SQLite
+    file.
+
+    branch_id values are as they appear in commit object depot paths:
+    any '/' replaced with '-'.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        p4gf_util.ensure_parent_dir(db_path)
+        self._db = sqlite3.connect(db_path, timeout=_BUSY_TIMEOUT)
+        self._db.executescript(NTR(
+              'CREATE TABLE IF NOT EXISTS commits'
+            ' ( sha1      TEXT    NOT NULL'
+            ' , branch_id TEXT    NOT NULL'
+            ' , change    INTEGER NOT NULL'
+            ' , PRIMARY KEY (sha1, branch_id, change) );'
+            'CREATE INDEX IF NOT EXISTS commits_change'
+            ' ON commits (change);'
+            'CREATE INDEX IF NOT EXISTS commits_branch_change'
+            ' ON commits (branch_id, change);'
+            'CREATE TABLE IF NOT EXISTS meta'
+            ' ( key   TEXT PRIMARY KEY'
+            ' , value TEXT NOT NULL );'
+            'CREATE TABLE IF NOT EXISTS sha1_seq'
+            ' ( seq  INTEGER PRIMARY KEY AUTOINCREMENT'
+            ' , sha1 TEXT    NOT NULL UNIQUE );'))
+        # Index written before we numbered sha1s? Number what's there.
+        if (    not self._db.execute(NTR('SELECT 1 FROM sha1_seq LIMIT 1')).fetchone()
+            and self._db.execute(NTR('SELECT 1 FROM commits LIMIT 1')).fetchone()):
+            self._db.execute(NTR('INSERT INTO sha1_seq (sha1)'
+                                 ' SELECT DISTINCT sha1 FROM commits'))
+        self._db.commit()
+
+    def _get_meta(self, key, default):
+        '''Return an integer from our meta table.'''
+        row = self._db.execute( NTR('SELECT value FROM meta WHERE key = ?')
+                              , (key,) ).fetchone()
+        return int(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        '''Store an integer in our meta table.'''
+        self._db.execute( NTR('INSERT OR REPLACE INTO meta VALUES (?, ?)')
+                        , (key, str(int(value))) )
+
+    @property
+    def high_water_mark(self):
+        '''
+        Highest changelist number included in this index, 0 if empty.
+        '''
+        return self._get_meta(NTR('high_water_mark'), 0)
+
+    def set_high_water_mark(self, change):
+        '''
+        Record that this index includes every commit file submitted at or
+        before changelist change.
+        '''
+        self._set_meta(NTR('high_water_mark'), change)
+
+    @property
+    def generation(self):
+        '''
+        Changes whenever a sha1 leaves this index. Anything built from
+        sha1s_since() must be rebuilt from all_sha1s() when this changes.
+        '''
+        return self._get_meta(NTR('generation'), 0)
+
+    @property
+    def last_seq(self):
+        '''
+        Sequence number of the most recently added sha1, 0 if none.
+        '''
+        row = self._db.execute(NTR('SELECT MAX(seq) FROM sha1_seq')).fetchone()
+        return int(row[0]) if row and row[0] else 0
+
+    def sha1s_since(self, seq):
+        '''
+        Return a list of (seq, sha1) for every sha1 first added after
+        sequence number seq, oldest first.
+        '''
+        return self._db.execute( NTR('SELECT seq, sha1 FROM sha1_seq'
+                                     ' WHERE seq > ? ORDER BY seq')
+                               , (int(seq),) ).fetchall()
+
+    def add(self, sha1, branch_id, change):
+        '''Record one commit.'''
+        self._db.execute( NTR('INSERT OR IGNORE INTO commits VALUES (?, ?, ?)')
+                        , (sha1, branch_id, int(change)) )
+        self._db.execute( NTR('INSERT OR IGNORE INTO sha1_seq (sha1) VALUES (?)')
+                        , (sha1,) )
+
+    def remove(self, sha1, branch_id, change):
+        '''Forget one commit.'''
+        self._db.execute( NTR('DELETE FROM commits'
+                              ' WHERE sha1 = ? AND branch_id = ? AND change = ?')
+                        , (sha1, branch_id, int(change)) )
+        if not self._db.execute( NTR('SELECT 1 FROM commits WHERE sha1 = ? LIMIT 1')
+                               , (sha1,) ).fetchone():
+            self._db.execute(NTR('DELETE FROM sha1_seq WHERE sha1 = ?'), (sha1,))
+            self._set_meta(NTR('generation'), 1 + self.generation)
+
+    def commits_for_sha1(self, sha1):
+        '''
+        Return a list of (branch_id, int change) for commit sha1.
+        '''
+        return self._db.execute( NTR('SELECT branch_id, change FROM commits'
+                                     ' WHERE sha1 = ?')
+                               , (sha1,) ).fetchall()
+
+    def commits_for_change(self, change):
+        '''
+        Return a list of (branch_id, sha1) copied from changelist change.
+        '''
+        return self._db.execute( NTR('SELECT branch_id, sha1 FROM commits'
+                                     ' WHERE change = ?')
+                               , (int(change),) ).fetchall()
+
+    def commits_between(self, first_change, last_change):
+        '''
+        Return a list of (int change, branch_id, sha1) for every commit
+        copied from a changelist in first_change..last_change inclusive,
+        ordered by change.
+        '''
+        return self._db.execute( NTR('SELECT change, branch_id, sha1 FROM commits'
+                                     ' WHERE change BETWEEN ? AND ?'
+                                     ' ORDER BY change')
+                               , (int(first_change), int(last_change)) ).fetchall()
+
+    def last_for_branch(self, branch_id):
+        '''
+        Return (int change, sha1) of the highest numbered changelist on
+        branch_id, or None if no commits on branch_id.
+        '''
+        return self._db.execute( NTR('SELECT change, sha1 FROM commits'
+                                     ' WHERE branch_id = ?'
+                                     ' ORDER BY change DESC LIMIT 1')
+                               , (branch_id,) ).fetchone()
+
+    def all_sha1s(self):
+        '''
+        Return a list of every commit sha1 in this index.
+        '''
+        return [row[0] for row in
+                self._db.execute(NTR('SELECT DISTINCT sha1 FROM commits'))]
+
+    def clear(self):
+        '''Forget everything, including the high-water mark.'''
+        generation = self.generation
+        self._db.execute(NTR('DELETE FROM commits'))
+        self._db.execute(NTR('DELETE FROM sha1_seq'))
+        self._db.execute(NTR('DELETE FROM meta'))
+        self._set_meta(NTR('generation'), 1 + generation)
+
+    def commit(self):
+        '''Write pending changes to disk.'''
+        self._db.commit()
+
+    def close(self):
+        '''Commit and close.'''
+        self._db.commit()
+        self._db.close()
+        self._db = None
+
+# -- end class CommitIndex ----------------------------------------------------
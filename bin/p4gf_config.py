@@ -65,6 +65,18 @@ KEY_PREFLIGHT_COMMIT                = NTR('preflight-commit')
 # overriding global values:
 KEY_HTTP_URL                        = NTR('http_url')  # no default, not propagated to per-repo
 KEY_SSH_URL                         = NTR('ssh_url')   # no default, not propagated to per-repo
+KEY_PRINT_WORKER_COUNT              = NTR('print-worker-count')
+VALUE_PRINT_WORKER_COUNT            = NTR('1')
+KEY_PRINT_TO_PACK                   = NTR('print-to-pack')
+KEY_PRINT_DEDUP                     = NTR('print-dedup')
+KEY_MIRROR_PIPELINE_DEPTH           = NTR('mirror-pipeline-depth')
+VALUE_MIRROR_PIPELINE_DEPTH         = NTR('0')
+KEY_FAST_FETCH                      = NTR('fast-fetch')
+KEY_FAST_FETCH_TTL                  = NTR('fast-fetch-ttl')
+VALUE_FAST_FETCH_TTL                = NTR('2')
+KEY_CLIENT_POOL_SIZE                = NTR('client-pool-size')
+VALUE_CLIENT_POOL_SIZE              = NTR('10')
+KEY_MIRROR_BULK_RESTORE             = NTR('mirror-bulk-restore')
 SECTION_FEATURES                    = NTR('@features')
 #FEATURE_TAGS                       = NTR('tags')
 FEATURE_MATRIX2                     = NTR('matrix2')
@@ -230,6 +242,38 @@ def combine_repo_with_global(p4, config):
     if not config.has_option(SECTION_REPO, KEY_CHARSET):
         config.set(                   SECTION_REPO,          KEY_CHARSET
                   , global_config.get(SECTION_REPO_CREATION, KEY_CHARSET))
+    if not config.has_option(         SECTION_REPO,            KEY_PRINT_WORKER_COUNT):
+        config.set(                   SECTION_REPO,            KEY_PRINT_WORKER_COUNT
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_PRINT_WORKER_COUNT
+                                     , fallback=VALUE_PRINT_WORKER_COUNT))
+    if not config.has_option(         SECTION_REPO,            KEY_PRINT_TO_PACK):
+        config.set(                   SECTION_REPO,            KEY_PRINT_TO_PACK
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_PRINT_TO_PACK
+                                     , fallback=VALUE_NO))
+    if not config.has_option(         SECTION_REPO,            KEY_PRINT_DEDUP):
+        config.set(                   SECTION_REPO,            KEY_PRINT_DEDUP
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_PRINT_DEDUP
+                                     , fallback=VALUE_YES))
+    if not config.has_option(         SECTION_REPO,            KEY_MIRROR_PIPELINE_DEPTH):
+        config.set(                   SECTION_REPO,            KEY_MIRROR_PIPELINE_DEPTH
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_MIRROR_PIPELINE_DEPTH
+                                     , fallback=VALUE_MIRROR_PIPELINE_DEPTH))
+    if not config.has_option(         SECTION_REPO,            KEY_FAST_FETCH):
+        config.set(                   SECTION_REPO,            KEY_FAST_FETCH
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_FAST_FETCH
+                                     , fallback=VALUE_NO))
+    if not config.has_option(         SECTION_REPO,            KEY_FAST_FETCH_TTL):
+        config.set(                   SECTION_REPO,            KEY_FAST_FETCH_TTL
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_FAST_FETCH_TTL
+                                     , fallback=VALUE_FAST_FETCH_TTL))
+    if not config.has_option(         SECTION_REPO,            KEY_CLIENT_POOL_SIZE):
+        config.set(                   SECTION_REPO,            KEY_CLIENT_POOL_SIZE
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_CLIENT_POOL_SIZE
+                                     , fallback=VALUE_CLIENT_POOL_SIZE))
+    if not config.has_option(         SECTION_REPO,            KEY_MIRROR_BULK_RESTORE):
+        config.set(                   SECTION_REPO,            KEY_MIRROR_BULK_RESTORE
+                  , global_config.get(SECTION_PERFORCE_TO_GIT, KEY_MIRROR_BULK_RESTORE
+                                     , fallback=VALUE_YES))
     return config
 
 
@@ -109,6 +109,11 @@ P4GF_TEMP_DIR_PREFIX                = NTR('p4gf_')
 P4GF_MOTD_FILE                      = NTR('{P4GF_DIR}/motd.txt')
 P4GF_FAILURE_LOG                    = NTR('{P4GF_DIR}/logs/{prefix}{date}.log.txt')
 P4GF_SWARM_PRT                      = NTR('swarm-pre-receive-list')
+P4GF_DAEMON_SOCKET                  = NTR('daemon.sock')
+P4GF_LOCAL_LOCK_DIR                 = NTR('locks')
+P4GF_DEPOT_BRANCH_INFO_CACHE        = NTR('depot-branch-info-cache.json')
+P4GF_PROTECTS_CACHE_DIR             = NTR('protects-cache')
+P4GF_FAST_EXPORT_MARKS              = NTR('fast-export-marks')
 
 # P4GF_HOME
 P4GF_HOME = os.path.expanduser(os.path.join("~", P4GF_DIR))
@@ -121,6 +126,10 @@ GIT_BIN_DEFAULT                  = 'git'
 GIT_BIN_NAME                     = 'GIT_BIN'
 GIT_BIN                          = GIT_BIN_DEFAULT
 
+# Number of p4gf_proc.ProcessRunner child processes. Set in the environment,
+# usually by the P4GF_ENV config file.
+P4GF_PROC_WORKER_COUNT_NAME      = NTR('P4GF_PROC_WORKER_COUNT')
+
 # section definition here avoids circularity issues with p4gf_env_config and p4gf_config
 SECTION_ENVIRONMENT       = NTR('environment')
 
@@ -600,40 +600,11 @@ class Context:
         branches. This includes depot branches that other Git Fusion repos
         created: we must stay lightweight even when sharing across repos.
 
-        Lazy-loaded from all depot branch-info files.
+        Lazy-loaded from all depot branch-info files, by way of a local
+        cache that p4gf_depot_branch.load_index() keeps up to date.
         '''
         if not self._depot_branch_info_index:
-            self._depot_branch_info_index = p4gf_depot_branch.DepotBranchInfoIndex()
-            root = p4gf_const.P4GF_DEPOT_BRANCH_INFO_ROOT.format(
-                                              P4GF_DEPOT=p4gf_const.P4GF_DEPOT)
-            root = root + '/...'
-            with p4gf_util.RawEncoding(self.p4):
-                file_data = self.p4.run('print', root)
-            delete = False
-            started = False
-            file_contents = ''
-            for item in file_data:
-                if isinstance(item, dict):
-                    if started:     # finish with the current branch info
-                        dbi = p4gf_depot_branch.depot_branch_info_from_string(file_contents)
-                        self._depot_branch_info_index.add(dbi)
-                    if item['action'] == 'delete':
-                        started = False
-                        delete = True
-                    else:
-                        file_contents = ''
-                        delete = False
-                        started = True
-                else:
-                    if delete:
-                        continue
-                    new_item = item.decode().strip()
-                    if len(new_item):
-                        file_contents = file_contents + new_item
-
-            if started:
-                dbi = p4gf_depot_branch.depot_branch_info_from_string(file_contents)
-                self._depot_branch_info_index.add(dbi)
+            self._depot_branch_info_index = p4gf_depot_branch.load_index(self.p4)
 
             if LOG.isEnabledFor(logging.DEBUG):
                 for dpid in self._depot_branch_info_index.by_id:
@@ -19,6 +19,7 @@ from p4gf_p2g_print_handler     import PrintHandler
 from p4gf_p2g_rev_range         import RevRange
 from p4gf_p4changelist          import P4Changelist
 from p4gf_gitmirror             import GitMirror
+from p4gf_mirror_restore        import MirrorRestore
 from p4gf_parent_commit_list    import ParentCommitList
 from p4gf_object_type           import ObjectType
 from p4gf_profiler              import Timer
@@ -30,6 +31,7 @@ import p4gf_filelog_action
 import p4gf_git
 import p4gf_log
 import p4gf_gc
+import p4gf_mirror_restore
 import p4gf_proc
 import p4gf_progress_reporter as ProgressReporter
 import p4gf_tag
@@ -98,11 +100,22 @@ class P2G:
                                     # Contains commit, tree, ANY type of sha1.
         self._sha1s_known_to_exist  = set()
 
+                                    # Commit sha1s that MirrorRestore found
+                                    # in our mirror but could not restore
+                                    # in full. No point in trying again one
+                                    # object at a time.
+        self._mirror_incomplete_sha1s = set()
+
                                     # Most recent ghost changelist seen (and
                                     # skipped) for that branch. Values are
                                     # SkippedGhost tuples.
         self._branch_id_to_skipped_ghost = {}
 
+                                    # BranchViewIndex for each set of
+                                    # branches _branches_intersecting()
+                                    # searches, by name of that set.
+        self._branch_view_index = {}
+
     def __str__(self):
         return "\n".join(["\n\nFast Import:\n",
                           str(self.fastimport)
@@ -474,6 +487,7 @@ class P2G:
 
             p4gf_gc.report_objects(NTR('after P2G._copy_print() graft change'))
 
+        printhandler.close()
         self.printed_revs = printhandler.revs
         if self.printed_revs:
             self.printed_rev_count += len(self.printed_revs)
@@ -657,6 +671,7 @@ class P2G:
                                  , p4_path ])
             LOG.debug3('_print_to_git_store() {} {}'.format(sha1, git_path))
             self._sha1s_known_to_exist.add(sha1)
+            p4gf_util.note_sha1s_exist([sha1])
             return git_path
 
     def _print_tree_to_git_store(self, sha1):
@@ -706,6 +721,11 @@ class P2G:
                            '        no commit in Perforce for ch={} branch={}. Returning False.'
                            .format(change.change, p4gf_util.abbrev(branch.branch_id)))
                 return False
+            if commit_ot.sha1 in self._mirror_incomplete_sha1s:
+                LOG.debug2('_fast_import_from_gitmirror() {} bulk restore found'
+                           ' commit incomplete in mirror. Returning False.'
+                           .format(p4gf_util.abbrev(commit_ot.sha1)))
+                return False
             if self._sha1_exists(commit_ot.sha1):
                 # Already copied. No need to do more.
                 LOG.debug2('_fast_import_from_gitmirror() {} commit already done, skipping'
@@ -781,6 +801,20 @@ class P2G:
                        .format(p4gf_util.abbrev(commit_ot.sha1)))
             return True
 
+    def _restore_from_gitmirror(self, sorted_changes):
+        '''
+        Restore as many commits and trees as we can, in bulk, from
+        //P4GF_DEPOT/objects/... before _fast_import_from_gitmirror() looks
+        for them one changelist at a time.
+        '''
+        if not p4gf_mirror_restore.is_enabled(self.ctx):
+            return
+        with Timer(FI_RESTORE):
+            restore = MirrorRestore(self.ctx)
+            restore.restore(sorted_changes)
+        self._sha1s_known_to_exist.update(restore.restored_sha1s)
+        self._mirror_incomplete_sha1s = restore.incomplete_sha1s
+
     def _get_changelist(self, changenum):
         """Get changelist object for change number, with no files.
         """
@@ -852,6 +886,7 @@ class P2G:
         current_branch = None
         LOG.debug3("_fast_import branch_dict={}".format(branch_dict.values()))
         self._fill_head_marks_from_current_heads()
+        self._restore_from_gitmirror(sorted_changes)
         mark_to_branch_id = {}
         with ProgressReporter.Determinate(len(sorted_changes)):
             for changenum in sorted_changes:
@@ -870,8 +905,10 @@ class P2G:
                     change = self._get_changelist_for_branch(changenum, None)
                     LOG.info('Copying {}'.format(change))
 
-                    branch_list = [branch for branch in self.ctx.undeleted_branches()
-                                   if branch.intersects_p4changelist(change)]
+                    branch_list = self._branches_intersecting(
+                                          NTR('undeleted')
+                                        , self.ctx.undeleted_branches()
+                                        , (f.depot_path for f in change.files))
                     for branch in branch_list:
                         self.ctx.heartbeat()
 
@@ -1204,6 +1241,20 @@ class P2G:
             if df:
                 yield df
 
+    def _branches_intersecting(self, name, branches, depot_paths):
+        '''
+        Return the branches whose view includes any of depot_paths.
+
+        Keeps one BranchViewIndex per name, rebuilt only when that set of
+        branches or any of their views changes.
+        '''
+        branches = list(branches)
+        index = self._branch_view_index.get(name)
+        if not (index and index.is_for(branches)):
+            index = p4gf_branch.BranchViewIndex(branches)
+            self._branch_view_index[name] = index
+        return index.branches_for_depot_paths(depot_paths)
+
     def _skip_ghost(self, ghost_p4change):
         '''
         We're not going to copy ghost_p4change to Git.
@@ -1215,22 +1266,22 @@ class P2G:
         '''
         change_num = ghost_p4change.change
         LOG.debug2('skipping ghost @{}'.format(change_num))
-        for branch_id, branch in self.ctx.branch_dict().items():
-
-                        # Do not call Branch.intersects_p4changelist() here. It
-                        # requires P4Changelist.files to be populated. P2G no
+                        # Do not use P4Changelist.files here. P2G no
                         # longer populates P4Changelist.files because that costs
                         # too much memory.
-            depot_file_list = self._files_in_change_num(change_num)
-            if branch.intersects_depot_file_list(depot_file_list):
-                LOG.debug2('skipping ghost @{} on branch {}'
-                        .format(change_num, p4gf_util.abbrev(branch_id)))
-                di = DescInfo.from_text(ghost_p4change.description)
-                ofcn = di.ghost_of_change_num               \
-                                    if (di and di.ghost_of_change_num) else 0
-                self._branch_id_to_skipped_ghost[branch_id] \
-                    = SkippedGhost( change_num    = int(change_num)
-                                  , of_change_num = int(ofcn) )
+        depot_file_list = list(self._files_in_change_num(change_num))
+        for branch in self._branches_intersecting( NTR('all')
+                                                 , self.ctx.branch_dict().values()
+                                                 , depot_file_list ):
+            branch_id = branch.branch_id
+            LOG.debug2('skipping ghost @{} on branch {}'
+                    .format(change_num, p4gf_util.abbrev(branch_id)))
+            di = DescInfo.from_text(ghost_p4change.description)
+            ofcn = di.ghost_of_change_num               \
+                                if (di and di.ghost_of_change_num) else 0
+            self._branch_id_to_skipped_ghost[branch_id] \
+                = SkippedGhost( change_num    = int(change_num)
+                              , of_change_num = int(ofcn) )
 
     def ghost_for_branch_id(self, branch_id):
         '''
@@ -1455,6 +1506,7 @@ FI_GITMIRROR   = NTR('FI from Git Mirror')
 FI_SHA1_EXISTS = NTR('_sha1_exists')
 FI_PRINT       = NTR('_print_to_git_store')
 FI_TO_TREE     = NTR('_commit_to_tree_sha1')
+FI_RESTORE     = NTR('Bulk restore from Git Mirror')
 
                         # Most recently seen commit/changelist for a single
                         # branch. Usually only 1 of mark/sha1 filled in:
@@ -140,6 +140,36 @@ def check_valid_filename(name, ctx):
     return None
 
 
+# Anything check_valid_filename() might reject for its characters alone.
+_SUSPECT_FILENAME_RE    = re.compile('[\x00-\x1f\x7f]|\\.\\.\\.')
+_SUSPECT_FILENAME_NT_RE = re.compile('[\x00-\x1f\x7f:]|\\.\\.\\.')
+
+
+def check_valid_filenames(names, ctx):
+    """Test many names at once, returning a dict of {name: error message}
+    for only those names that check_valid_filename() rejects.
+
+    Screens every name with a single regex search and encodes them all
+    at once, then runs the full check_valid_filename() only on suspects.
+    """
+    names = set(names)
+    if 'P4D/NT' in ctx.server_version:
+        suspect_re = _SUSPECT_FILENAME_NT_RE
+    else:
+        suspect_re = _SUSPECT_FILENAME_RE
+    suspects = [name for name in names if suspect_re.search(name)]
+    try:
+        '/'.join(names).encode(sys.getfilesystemencoding(), "strict")
+    except UnicodeEncodeError:
+        suspects = names
+    result = {}
+    for name in suspects:
+        err = check_valid_filename(name, ctx)
+        if err:
+            result[name] = err
+    return result
+
+
 # p4d treats many failures to open a file for {add, edit, delete, others}
 # not as an E_FAILED error, but as an E_INFO "oh by the way I totally failed
 # to do what you want.
@@ -186,19 +216,26 @@ MIRROR          = NTR('Mirror Git Objects')
 
 N_BLOBS = NTR('Number of Blobs')
 
+                        # Paths per 'p4 fstat' request when scanning a
+                        # push for locked files.
+_LOCKED_FSTAT_CHUNK_SIZE = 1000
+
 
 class ProtectsChecker:
     """class to handle filtering a list of paths against view and protections"""
-    def __init__(self, ctx, author, pusher):
-        """init P4.Map objects for author, pusher, view and combination"""
+    def __init__(self, ctx, author, pusher, ignore_author_perms=None):
+        """init P4.Map objects for author, pusher, view and combination
+
+        Pass ignore_author_perms from ignore_author_perms_for(ctx) to
+        avoid re-reading the repo config for each new checker.
+        """
         self.ctx = ctx
         self.author = author
         self.pusher = pusher
 
-        config = p4gf_config.get_repo(ctx.p4gf, ctx.config.view_name)
-        self.ignore_author_perms = config.get(p4gf_config.SECTION_REPO,
-                                              p4gf_config.KEY_IGNORE_AUTHOR_PERMS,
-                                              fallback='no') == 'yes'
+        if ignore_author_perms is None:
+            ignore_author_perms = self.ignore_author_perms_for(ctx)
+        self.ignore_author_perms = ignore_author_perms
 
         self.view_map = None
         self.read_protect_author = None
@@ -216,6 +253,21 @@ class ProtectsChecker:
         self.pusher_denied = []
         self.unmapped = []
 
+            # dict { gwt path : (client path, NTR result or None) }
+            #
+            # Our maps and view never change during one branch's preflight,
+            # so neither does a path's result.
+            # Remember it for the next commit that touches the same path.
+        self._path_result = {}
+
+    @staticmethod
+    def ignore_author_perms_for(ctx):
+        """Does ctx's repo config skip author write permission checks?"""
+        config = p4gf_config.get_repo(ctx.p4gf, ctx.config.view_name)
+        return config.get(p4gf_config.SECTION_REPO,
+                          p4gf_config.KEY_IGNORE_AUTHOR_PERMS,
+                          fallback='no') == 'yes'
+
     def init_view(self):
         """init view map for client"""
         self.view_map = self.ctx.clientmap
@@ -254,34 +306,49 @@ class ProtectsChecker:
         self.author_denied = []
         self.pusher_denied = []
         self.unmapped = []
-        c2d = P4.Map.RIGHT2LEFT
 
         for blob in blobs:
-            topath_c = self.ctx.gwt_path(blob['path']).to_client()
-            topath_d = self.ctx.gwt_path(blob['path']).to_depot()
+            (topath_c, result) = self._check_path(blob['path'])
+            if result == NTR('unmapped'):
+                self.unmapped.append(topath_c)
+            elif result == NTR('author denied'):
+                self.author_denied.append(topath_c)
+            elif result == NTR('pusher denied'):
+                self.pusher_denied.append(topath_c)
+
+    def _check_path(self, gwt_path):
+        """Return (client path, result) for one path, result None if our
+        filters pass the path.
+        """
+        r = self._path_result.get(gwt_path)
+        if r:
+            return r
+        c2d = P4.Map.RIGHT2LEFT
+        topath_c = self.ctx.gwt_path(gwt_path).to_client()
+        topath_d = self.ctx.gwt_path(gwt_path).to_depot()
 
-            # for all actions, need to check write access for dest path
-            result = "  "   # zum loggen
-            if topath_d and P4GF_DEPOT_OBJECTS_RE.match(topath_d):
-                continue
-            # do not require user write access to //.git-fusion/branches
-            if topath_d and P4GF_DEPOT_BRANCHES_RE.match(topath_d):
-                continue
-            if not self.write_filter.includes(topath_c, c2d):
-                if not self.view_map.includes(topath_c, c2d):
-                    self.unmapped.append(topath_c)
-                    result = NTR('unmapped')
-                elif not (self.ignore_author_perms or
-                          self.write_protect_author.includes(topath_d)):
-                    self.author_denied.append(topath_c)
-                    result = NTR('author denied')
-                elif not self.write_protect_pusher.includes(topath_d):
-                    self.pusher_denied.append(topath_c)
-                    result = NTR('pusher denied')
-                else:
-                    result = "?"
-                LOG.debug('filter_paths() {:<13} {}, {}'
-                          .format(result, blob['path'], topath_d))
+        # for all actions, need to check write access for dest path
+        result = None
+        if topath_d and P4GF_DEPOT_OBJECTS_RE.match(topath_d):
+            pass
+        # do not require user write access to //.git-fusion/branches
+        elif topath_d and P4GF_DEPOT_BRANCHES_RE.match(topath_d):
+            pass
+        elif not self.write_filter.includes(topath_c, c2d):
+            if not self.view_map.includes(topath_c, c2d):
+                result = NTR('unmapped')
+            elif not (self.ignore_author_perms or
+                      self.write_protect_author.includes(topath_d)):
+                result = NTR('author denied')
+            elif not self.write_protect_pusher.includes(topath_d):
+                result = NTR('pusher denied')
+            else:
+                result = "?"
+            LOG.debug('filter_paths() {:<13} {}, {}'
+                      .format(result, gwt_path, topath_d))
+        r = (topath_c, result)
+        self._path_result[gwt_path] = r
+        return r
 
     def has_error(self):
         """return True if any paths not passed by filters"""
@@ -367,6 +434,20 @@ class G2P:
             # used by preflight to check for impossible pushes
         self.stream_depots                 = None
 
+            # Batch preflight state, filled in by _preflight_check().
+            #
+            # dict { gwt path : error message } for invalid filenames.
+        self._preflight_filename_errors    = {}
+            # dict { (author p4user, branch_id) : ProtectsChecker }
+        self._preflight_protects_checkers  = {}
+            # ProtectsChecker.ignore_author_perms_for(), read once per push.
+        self._preflight_ignore_author_perms = None
+            # dict { branch_id : set(gwt path) } of every path pushed to
+            # each branch, or None if no locked files to look for.
+        self._preflight_branch_paths       = None
+            # dict { branch_id : { depot path : fstat dict } } locked files.
+        self._preflight_locked_files       = {}
+
     def _dump_on_failure(self, errmsg, is_exception):
         '''
         Something has gone horribly wrong and we've ended up in
@@ -793,11 +874,57 @@ class G2P:
 
     def _check_protects(self, p4user, blobs):
         """check if author is authorized to submit files"""
-        pc = ProtectsChecker(self.ctx, p4user, self.ctx.authenticated_p4user)
+        pc = self._protects_checker(p4user)
         pc.filter_paths(blobs)
         if pc.has_error():
             self._revert_and_raise(pc.error_message(), is_exception = False)
 
+    def _protects_checker(self, p4user):
+        """Return a ProtectsChecker for p4user on the current branch.
+
+        Joining protections with the branch view is costly. Join once per
+        author per branch, not once per commit.
+        """
+        key = (p4user, self._current_branch.branch_id)
+        pc = self._preflight_protects_checkers.get(key)
+        if not pc:
+            pc = ProtectsChecker( self.ctx, p4user, self.ctx.authenticated_p4user
+                                , self._preflight_ignore_author_perms )
+            self._preflight_protects_checkers[key] = pc
+        return pc
+
+    def _locked_files(self, branch_id):
+        """Return a dict { depot path : fstat dict } of locked files, or
+        files opened for exclusive edit, among all the files pushed to
+        branch_id.
+
+        Runs a chunked 'p4 fstat' over the union of paths pushed to
+        branch_id once, upon first call for that branch. Requires that
+        branch_id's view be the current client view.
+        """
+        locked = self._preflight_locked_files.get(branch_id)
+        if locked is not None:
+            return locked
+        locked = {}
+        paths = self._preflight_branch_paths.get(branch_id) \
+                if self._preflight_branch_paths else None
+        if paths:
+            client_paths = ['//{}/{}'.format( self.ctx.p4.client
+                                            , p4gf_util.escape_path(p))
+                            for p in sorted(paths)]
+            fstat_flags = NTR('otherLock | otherOpen0 & headType=*+l')
+            for i in range(0, len(client_paths), _LOCKED_FSTAT_CHUNK_SIZE):
+                chunk = client_paths[i:i + _LOCKED_FSTAT_CHUNK_SIZE]
+                r = self.ctx.p4run(['fstat', '-F', fstat_flags] + chunk
+                                   , log_warnings=logging.DEBUG)
+                for lf in r:
+                    if isinstance(lf, dict) and 'depotFile' in lf:
+                        locked[lf['depotFile']] = lf
+            LOG.debug('_locked_files() branch={} path_ct={} locked_ct={}'
+                      .format(p4gf_util.abbrev(branch_id), len(paths), len(locked)))
+        self._preflight_locked_files[branch_id] = locked
+        return locked
+
     @staticmethod
     def _log_fe_file(fe_file):
         '''
@@ -916,7 +1043,7 @@ class G2P:
 
         for f in commit['files']:
             LOG.debug3("_preflight_check_commit : commit files: " + self._log_fe_file(f))
-            err = check_valid_filename(f['path'], self.ctx)
+            err = self._preflight_filename_errors.get(f['path'])
             if err:
                 self._revert_and_raise(err, is_exception=False)
 
@@ -961,15 +1088,12 @@ class G2P:
         LOG.debug('checking locked files under //{}/...'.format(self.ctx.p4.client))
         if any_locked_files:
             # Scan for either locked files or files opened for exclusive edit.
-            files_in_commit = ['//{}/{}'.format(self.ctx.p4.client
-                                                , p4gf_util.escape_path(f['path']))
-                               for f in commit['files']]
-            if files_in_commit:
-                fstat_flags = NTR('otherLock | otherOpen0 & headType=*+l')
-                locked_files = self.ctx.p4run(['fstat', '-F', fstat_flags, '-m1', files_in_commit]
-                                              , log_warnings=logging.DEBUG)
-                if locked_files:
-                    lf1 = locked_files[0]
+            locked_files = self._locked_files(branch_id)
+            for f in commit['files']:
+                if not locked_files:
+                    break
+                lf1 = locked_files.get(self.ctx.gwt_to_depot_path(f['path']))
+                if lf1:
                     user = lf1['otherOpen'][0] if 'otherOpen' in lf1 else NTR('<unknown>')
                     # Collect the names (and clients) of users with locked files.
                     # Report back to the pusher so they can take appropriate action.
@@ -2173,6 +2297,11 @@ class G2P:
                 any_locked_files = self.ctx.p4run(['fstat', '-F', fstat_flags, '-m1'
                                                    , '//{}/...'.format(self.ctx.p4.client)]
                                                   , log_warnings=logging.DEBUG)
+
+            # Gather every path in the push, so that we can check filenames
+            # and locks once over their union rather than once per commit.
+            self._preflight_prepare(commits, any_locked_files)
+
             with ProgressReporter.Determinate(len(commits)):
                 for commit in commits:
                     ProgressReporter.increment(_('Checking commits...'))
@@ -2191,6 +2320,33 @@ class G2P:
                                                                 , any_locked_files)
 
 
+    def _preflight_prepare(self, commits, any_locked_files):
+        """
+        One pass over all commits in the push: validate every distinct
+        filename, and if there are locked files to look for, remember which
+        paths go to which branch for _locked_files().
+        """
+        all_paths    = set()
+        branch_paths = defaultdict(set) if any_locked_files else None
+        for commit in commits:
+            rev = commit['sha1']
+            if rev not in self.assigner.assign_dict:
+                continue
+            paths = [f['path'] for f in commit['files']]
+            all_paths.update(paths)
+            if branch_paths is not None:
+                for branch_id in self.assigner.assign_dict[rev].branch_id_list():
+                    branch_paths[branch_id].update(paths)
+
+        self._preflight_filename_errors   = check_valid_filenames(all_paths, self.ctx)
+        self._preflight_branch_paths      = branch_paths
+        self._preflight_locked_files      = {}
+        self._preflight_protects_checkers = {}
+        self._preflight_ignore_author_perms \
+                            = ProtectsChecker.ignore_author_perms_for(self.ctx)
+        LOG.debug('_preflight_prepare() path_ct={} invalid_ct={}'
+                  .format(len(all_paths), len(self._preflight_filename_errors)))
+
     def _push_start_counter_name(self):
         '''
         Return the counter where we record the last known changelist number
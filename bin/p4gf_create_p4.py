@@ -112,6 +112,15 @@ def close_all():
 
     del _CONNECTION_LIST[:]
 
+def forget_all():
+    '''
+    Let go of every connection we created, without disconnecting them.
+
+    For a forked child whose inherited connections belong to its parent:
+    disconnecting them would also close the parent's session.
+    '''
+    del _CONNECTION_LIST[:]
+
 def destroy(p4):
     '''
     Disconnect and unregister and delete.
@@ -0,0 +1,360 @@
+#! /usr/bin/env python3.3
+'''
+A long-lived Git Fusion server process that serves SSH and CGI requests for
+every repo, so that each request need not pay Git Fusion's startup cost.
+
+Without the daemon, every git fetch over SSH or HTTP starts a new Python
+process that imports some hundred modules, connects to Perforce, checks
+server readiness, lock permission, and protections, and runs p4gf_init,
+all before it looks at the repo. For a fetch with nothing to fetch, that
+setup is most of the latency.
+
+The daemon does that setup once:
+
+  * imports p4gf_auth_server, p4gf_http_server, and everything they import,
+  * holds one Perforce connection, and runs the server-wide checks and
+    p4gf_init over it every --check-ttl seconds.
+
+Then it listens on a Unix socket, {P4GF_HOME}/daemon.sock. Each
+p4gf_auth_server.py or CGI p4gf_http_server.py run connects to that
+socket and passes in its argv, environment, working directory, and
+stdin/stdout/stderr (see p4gf_daemon_client). The daemon forks a child per
+request. The child inherits all of the above already done, takes over the
+client's stdio and socket, runs the same code that the client would have
+run itself, and sends the client its exit code.
+
+Each request still gets its own process. Crashes, memory, locks, working
+directory, and environment stay per-request, same as before. Each child
+makes its own Perforce connections: a connection cannot be safely shared
+across fork(). Repo config and branch dictionaries are still loaded per
+request, under the repo's view lock, because pushes change them.
+
+Stop the daemon with SIGTERM, SIGINT, or SIGHUP. It removes its socket,
+and clients go back to serving requests themselves. Children already
+serving requests run to completion.
+'''
+import atexit
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+import p4gf_env_config  # pylint: disable=W0611
+import p4gf_auth_server
+import p4gf_create_p4
+import p4gf_daemon_client
+import p4gf_http_server
+import p4gf_init
+from   p4gf_l10n      import _, NTR, log_l10n
+import p4gf_log
+import p4gf_proc
+import p4gf_server_common
+import p4gf_util
+import p4gf_version
+
+LOG = p4gf_log.for_module()
+
+                        # Seconds to trust the server-wide checks before
+                        # running them again.
+_CHECK_TTL = 10
+
+                        # Seconds to wait for a client to send its request
+                        # once connected.
+_REQUEST_TIMEOUT = 10
+
+                        # Seconds between checks for exited children.
+_POLL_INTERVAL = 1.0
+
+_ENTRY_POINTS = { p4gf_daemon_client.ENTRY_AUTH_SERVER : p4gf_auth_server.run_main
+                , p4gf_daemon_client.ENTRY_HTTP_SERVER : p4gf_http_server.run_main }
+
+
+def _exit_code(status):
+    '''
+    Convert an os.waitpid() status to a shell-style exit code.
+    '''
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _close_fds(fds):
+    '''
+    Close file descriptors, ignoring any already closed.
+    '''
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+class Daemon:
+    '''
+    Listen on a Unix socket, fork a child to serve each request.
+    '''
+
+    def __init__(self, socket_path, check_ttl=_CHECK_TTL):
+        self.socket_path = socket_path
+        self.check_ttl   = check_ttl
+        self.listener    = None
+        self.p4          = None
+        self.checked_at  = 0
+        self.stopping    = False
+
+                        # pids of children still serving requests
+        self.children    = set()
+
+                        # Instrumentation
+        self.request_count = 0
+        self.started_at    = time.time()
+
+    def start(self):
+        '''
+        Bind our socket. Fail if another daemon is already listening there.
+        '''
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise RuntimeError(_('Git Fusion daemon already listening on {}')
+                                   .format(self.socket_path))
+            except ConnectionRefusedError:
+                # Left behind by a daemon that died. Take it over.
+                os.unlink(self.socket_path)
+            finally:
+                probe.close()
+        p4gf_util.ensure_parent_dir(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            self.listener.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.listener.listen(128)
+        LOG.info('Git Fusion daemon listening on {}, pid={}'
+                 .format(self.socket_path, os.getpid()))
+
+    def stop(self):
+        '''
+        Stop accepting requests. Does not wait for children still serving
+        requests: each one reports to its own client.
+        '''
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        if self.p4:
+            p4gf_create_p4.destroy(self.p4)
+            self.p4 = None
+        LOG.info('Git Fusion daemon stopped after {} requests in {:.0f} seconds'
+                 .format(self.request_count, time.time() - self.started_at))
+
+    def serve_forever(self):
+        '''
+        Accept and fork until signaled to stop.
+        '''
+        while not self.stopping:
+            try:
+                (readable, _w, _x) = select.select( [self.listener], [], []
+                                                  , _POLL_INTERVAL)
+            except InterruptedError:
+                readable = []
+            self._reap()
+            if readable and not self.stopping:
+                self._accept_one()
+
+    def _refresh_checks(self):
+        '''
+        If it has been more than check_ttl seconds since we last ran the
+        server-wide checks, run them again.
+
+        If they fail, leave them un-passed: each request will then run them
+        itself and report the failure to its own client.
+        '''
+        if time.time() < self.checked_at + self.check_ttl:
+            return
+        self.checked_at = time.time()
+        p4gf_server_common.forget_checks_passed()
+        try:
+            if not (self.p4 and self.p4.connected()):
+                self.p4 = p4gf_create_p4.create_p4()
+                if not self.p4:
+                    return
+            p4gf_server_common.check_readiness(self.p4)
+            p4gf_server_common.check_lock_perm(self.p4)
+            if not p4gf_server_common.check_protects(self.p4):
+                return
+            p4gf_init.init(self.p4)
+            p4gf_server_common.record_checks_passed(self.check_ttl)
+        # pylint:disable=W0703
+        # Catching too general exception
+        # Any failure here is a failure for requests to report, not for us.
+        except Exception as e:
+            LOG.warning('Git Fusion daemon checks failed: {}'.format(e))
+            if self.p4:
+                p4gf_create_p4.destroy(self.p4)
+                self.p4 = None
+        # pylint:enable=W0703
+
+    def _accept_one(self):
+        '''
+        Read one request and fork a child to serve it.
+        '''
+        try:
+            (conn, _addr) = self.listener.accept()
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+                return
+            raise
+        fds = []
+        try:
+            conn.settimeout(_REQUEST_TIMEOUT)
+            (request, fds) = p4gf_daemon_client.recv_request(conn)
+            conn.settimeout(None)
+        except OSError as e:
+            LOG.warning('Git Fusion daemon could not read request: {}'.format(e))
+            request = None
+        if not (request and request.get(NTR('entry')) in _ENTRY_POINTS):
+            LOG.warning('Git Fusion daemon rejected request: {}'.format(request))
+            _close_fds(fds)
+            conn.close()
+            return
+
+        self._refresh_checks()
+        self.request_count += 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            _close_fds(fds)
+            conn.close()
+            self.children.add(pid)
+            LOG.debug('forked {} for request #{}: {}'
+                      .format(pid, self.request_count, request[NTR('argv')]))
+            return
+        self._run_child(conn, request, fds)
+
+    def _run_child(self, conn, request, fds):
+        '''
+        In the forked child: become the client process, serve its request,
+        and send the client our exit code. Never returns.
+        '''
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT,  signal.SIG_DFL)
+            signal.signal(signal.SIGHUP,  signal.SIG_DFL)
+            self.listener.close()
+            p4gf_create_p4.forget_all()
+
+            for (target, fd) in zip((0, 1, 2), fds):
+                os.dup2(fd, target)
+            _close_fds(fds)
+            sys.stdin  = open(0, 'r', closefd=False)
+            sys.stdout = open(1, 'w', closefd=False)
+            sys.stderr = open(2, 'w', closefd=False)
+
+            os.environ.clear()
+            os.environ.update(request[NTR('environ')])
+            os.umask(request[NTR('umask')])
+            os.chdir(request[NTR('cwd')])
+            sys.argv = request[NTR('argv')]
+
+            _ENTRY_POINTS[request[NTR('entry')]]()
+            code = 0
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                code = 1
+            else:
+                code = 0
+        # pylint:disable=W0703
+        # Catching too general exception
+        # Whatever happens, the child must not return into the parent's loop.
+        except Exception:
+            LOG.exception('Git Fusion daemon child failed')
+        # pylint:enable=W0703
+        finally:
+            try:
+                # os._exit() skips atexit handlers, and some of ours matter,
+                # such as the one that closes the gitmirror pipe. Run them
+                # as a normal exit would.
+                # pylint:disable=W0212
+                # Access to a protected member
+                atexit._run_exitfuncs()
+                # pylint:enable=W0212
+                sys.stdout.flush()
+                sys.stderr.flush()
+                logging.shutdown()
+                p4gf_daemon_client.send_exit_code(conn, code)
+            finally:
+                # pylint:disable=W0212
+                # Access to a protected member
+                os._exit(code)
+                # pylint:enable=W0212
+
+    def _reap(self):
+        '''
+        Collect finished children so they do not linger as zombies.
+        '''
+        while self.children:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if not pid:
+                return
+            self.children.discard(pid)
+            LOG.debug('child {} exited {}'.format(pid, _exit_code(status)))
+
+
+def main():
+    '''
+    Run the daemon until signaled.
+    '''
+    parser = p4gf_util.create_arg_parser(
+        _('Serve Git Fusion SSH and HTTP requests from one long-lived process.'))
+    parser.add_argument('--socket', default=p4gf_daemon_client.socket_path(),
+                        help=_('Unix socket on which to listen'))
+    parser.add_argument('--check-ttl', type=int, default=_CHECK_TTL,
+                        help=_('seconds between server readiness checks'))
+    args = parser.parse_args()
+
+    p4gf_version.log_version()
+    log_l10n()
+    p4gf_version.version_check()
+    p4gf_proc.install_stack_dumper()
+
+    daemon = Daemon(args.socket, check_ttl=args.check_ttl)
+
+    def _signal_handler(signum, _frame):
+        '''
+        Stop accepting requests.
+        '''
+        LOG.info('Git Fusion daemon received signal {}, pid={}, exiting'
+                 .format(signum, os.getpid()))
+        daemon.stopping = True
+    signal.signal(signal.SIGTERM, _signal_handler)
+    signal.signal(signal.SIGINT,  _signal_handler)
+    signal.signal(signal.SIGHUP,  _signal_handler)
+
+    daemon.start()
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    p4gf_log.run_with_exception_logger(main, write_to_stderr=True)
@@ -0,0 +1,167 @@
+#! /usr/bin/env python3.3
+'''
+Hand one Git Fusion request to a running p4gf_daemon.py.
+
+p4gf_auth_server.py and p4gf_http_server.py call serve() before importing
+anything heavy. If a daemon is listening on its Unix socket, we pass it our
+argv, environment, working directory, umask, and stdin/stdout/stderr file
+descriptors, wait for it to run the request, and exit with its exit code.
+If no daemon is listening, serve() returns and the caller runs the request
+itself, same as always.
+
+Also holds the wire protocol, shared with p4gf_daemon.py:
+
+    client --> daemon   4-byte big-endian length, then that many bytes of
+                        UTF-8 JSON request. Three file descriptors
+                        (stdin, stdout, stderr) ride along as SCM_RIGHTS
+                        ancillary data on the first message.
+    daemon --> client   4-byte big-endian signed exit code, once the
+                        request completes.
+
+Keep this module light: it runs on every request before we know whether
+the daemon will do the real work.
+'''
+import array
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+
+import p4gf_const
+from   p4gf_l10n      import _, NTR
+
+LOG = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct(NTR('!I'))
+_EXIT   = struct.Struct(NTR('!i'))
+
+                        # stdin, stdout, stderr
+_FD_COUNT = 3
+
+                        # Which script's request is this?
+ENTRY_AUTH_SERVER = NTR('auth_server')
+ENTRY_HTTP_SERVER = NTR('http_server')
+
+
+def socket_path():
+    '''
+    Where does p4gf_daemon.py listen?
+    '''
+    return os.path.join(p4gf_const.P4GF_HOME, p4gf_const.P4GF_DAEMON_SOCKET)
+
+
+def send_request(sock, request, fds):
+    '''
+    Send one request dict, along with open file descriptors fds.
+    '''
+    body = json.dumps(request).encode('utf-8')
+    data = _LENGTH.pack(len(body)) + body
+    sent = sock.sendmsg([data], [( socket.SOL_SOCKET, socket.SCM_RIGHTS
+                                 , array.array('i', fds) )])
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def _recv_exactly(sock, size):
+    '''
+    Return exactly size bytes, or fewer if the peer hung up first.
+    '''
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_request(sock):
+    '''
+    Receive one request. Return (request dict, list of file descriptors),
+    or (None, fds) if the client hung up or sent garbage. Caller owns any
+    returned fds and must close them.
+    '''
+    fds = array.array('i')
+    (data, ancdata, _flags, _addr) = sock.recvmsg(
+                  _LENGTH.size
+                , socket.CMSG_SPACE(_FD_COUNT * fds.itemsize))
+    for (level, kind, cdata) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            usable = len(cdata) - (len(cdata) % fds.itemsize)
+            fds.frombytes(cdata[:usable])
+    fds = list(fds)
+    data += _recv_exactly(sock, _LENGTH.size - len(data))
+    if len(data) < _LENGTH.size or len(fds) != _FD_COUNT:
+        return (None, fds)
+    (length,) = _LENGTH.unpack(data)
+    body = _recv_exactly(sock, length)
+    if len(body) < length:
+        return (None, fds)
+    try:
+        return (json.loads(body.decode('utf-8')), fds)
+    except ValueError:
+        return (None, fds)
+
+
+def send_exit_code(sock, code):
+    '''
+    Tell the client that its request is complete.
+    '''
+    sock.sendall(_EXIT.pack(code))
+
+
+def recv_exit_code(sock):
+    '''
+    Wait for our request to complete. Return its exit code,
+    or None if the daemon hung up without telling us.
+    '''
+    data = _recv_exactly(sock, _EXIT.size)
+    if len(data) < _EXIT.size:
+        return None
+    return _EXIT.unpack(data)[0]
+
+
+def _current_umask():
+    '''
+    os.umask() can only be read by setting it.
+    '''
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def serve(entry):
+    '''
+    If p4gf_daemon.py is listening, have it run this process's request as
+    entry point entry, then exit with the request's exit code.
+
+    Return without doing anything if no daemon is listening.
+    '''
+    path = socket_path()
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        LOG.debug('no Git Fusion daemon at {}: {}'.format(path, e))
+        sock.close()
+        return
+
+    request = { NTR('entry')   : entry
+              , NTR('argv')    : sys.argv
+              , NTR('cwd')     : os.getcwd()
+              , NTR('umask')   : _current_umask()
+              , NTR('environ') : dict(os.environ) }
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with sock:
+        send_request(sock, request, [0, 1, 2])
+        code = recv_exit_code(sock)
+    if code is None:
+        sys.stderr.write(_('Git Fusion daemon exited before completing request.\n'))
+        code = 1
+    sys.exit(code)
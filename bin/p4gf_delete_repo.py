@@ -25,6 +25,7 @@ import sys
 
 import P4
 import p4gf_env_config    # pylint: disable=W0611
+import p4gf_client_pool
 import p4gf_config
 import p4gf_const
 import p4gf_context
@@ -259,6 +260,10 @@ def delete_client(args, p4, client_name, metrics, prune_objs=True):
         if not args.delete:
             print(NTR('p4 sync -f {}#none').format(command_path))
             print(NTR('p4 client -f -d {}').format(client_name))
+            print(NTR('p4 client -d {}').format(
+                p4gf_const.P4GF_REPO_TEMP_CLIENT.format( server_id = p4gf_util.get_server_id()
+                                                       , repo_name = view_name
+                                                       , n         = '*')))
             print(NTR('rm -rf {}').format(view_dirs.view_container))
             print(NTR('Deleting {} objects from //{}/objects/...').format(
                 len(objects_to_delete), p4gf_const.P4GF_DEPOT))
@@ -279,6 +284,7 @@ def delete_client(args, p4, client_name, metrics, prune_objs=True):
             print_verbose(args, NTR('Deleting client {}...').format(client_name))
             p4.run('client', '-df', client_name)
             metrics.clients += 1
+            metrics.clients += p4gf_client_pool.delete_temp_clients(p4, view_name)
             print_verbose(args, NTR("Deleting repo {0}'s directory {1}...").format(view_name,
                 view_dirs.view_container))
             _remove_tree(view_dirs.view_container, contents_only=False)
@@ -6,6 +6,8 @@ import logging
 from   collections import namedtuple
 import configparser
 import copy
+import json
+import os
 
 import p4gf_config
 import p4gf_const
@@ -257,9 +259,10 @@ class DepotBranchInfoIndex:
         '''
         Return DepotBranchInfo whose root prefixes depot_path.
 
-        O(N dbi) scan of entire list of DepotBranchInfo instances across
-        all repos ever. Called by code that discovers depot branches
-        that come from some other repo, but contribute to this repo.
+        Looks up each directory above depot_path, deepest first, in our
+        root->info dict: O(path depth), not O(N dbi) across all repos ever.
+        Called by code that discovers depot branches that come from some
+        other repo, but contribute to this repo.
         '''
         # Passed us just a root with no trailing delimiter? The loop below
         # won't find a match, but our dict lookup will (and quickly).
@@ -267,9 +270,12 @@ class DepotBranchInfoIndex:
         if r:
             return r
 
-        for dbi in self.by_id.values():
-            if depot_path.startswith(dbi.root_depot_path + '/'):
-                return dbi
+        i = depot_path.rfind('/')
+        while 2 < i:
+            r = self.by_root.get(depot_path[:i])
+            if r:
+                return r
+            i = depot_path.rfind('/', 0, i)
         return None
 
     def find_ancestor_change_num(self, child_dbi, ancestor_dbid):
@@ -347,6 +353,156 @@ class DepotBranchInfoIndex:
         return list(dbi_set)
 
 
+                        # Bump to discard caches written in an older format.
+_CACHE_VERSION = 1
+
+
+def _cache_path():
+    '''
+    Where do we cache parsed branch-info files?
+    '''
+    return os.path.join(p4gf_const.P4GF_HOME, p4gf_const.P4GF_DEPOT_BRANCH_INFO_CACHE)
+
+
+def _to_str(value):
+    '''
+    'p4 print' under RawEncoding might return bytes for tagged values.
+    '''
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def _dbi_to_dict(dbi):
+    '''
+    Return the parts of a DepotBranchInfo that its branch-info file holds,
+    as a JSON-friendly dict.
+    '''
+    return { NTR('id')      : dbi.depot_branch_id
+           , NTR('root')    : dbi.root_depot_path
+           , NTR('parents') : dbi.parent_depot_branch_id_list
+           , NTR('changes') : dbi.parent_changelist_list }
+
+
+def _dbi_from_dict(d):
+    '''
+    Inverse of _dbi_to_dict().
+    '''
+    dbi = DepotBranchInfo()
+    dbi.depot_branch_id             = d[NTR('id')]
+    dbi.root_depot_path             = d[NTR('root')]
+    dbi.parent_depot_branch_id_list = list(d[NTR('parents')])
+    dbi.parent_changelist_list      = list(d[NTR('changes')])
+    return dbi
+
+
+def _read_cache():
+    '''
+    Return (change, {depot_file: dict}) from our cache, or (None, {}) if no
+    usable cache.
+    '''
+    try:
+        with open(_cache_path(), 'r') as f:
+            content = json.load(f)
+        if content[NTR('version')] != _CACHE_VERSION:
+            return (None, {})
+        return (int(content[NTR('change')]), content[NTR('files')])
+    except (OSError, ValueError, KeyError, TypeError):
+        return (None, {})
+
+
+def _write_cache(change, files):
+    '''
+    Replace our cache all at once, so that concurrent readers see either
+    the old content or the new, never half of either.
+    '''
+    path = _cache_path()
+    tmp_path = NTR('{}.{}').format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({ NTR('version') : _CACHE_VERSION
+                      , NTR('change')  : change
+                      , NTR('files')   : files }, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        LOG.warning('cannot write depot branch cache {}: {}'.format(path, e))
+
+
+def _print_branch_info(p4, path):
+    '''
+    Generator: 'p4 print' branch-info files and yield (depot_file, dbi) for
+    each, with dbi None for a deleted file.
+    '''
+    depot_file = None
+    chunks     = []
+
+    def _parse():
+        '''Parse one file's accumulated content.'''
+        content = b''.join(chunks).decode().strip()
+        if not content:
+            return None
+        return depot_branch_info_from_string(content)
+
+    with p4gf_util.RawEncoding(p4):
+        file_data = p4.run('print', path)
+    for item in file_data:
+        if isinstance(item, dict):
+            if depot_file:
+                yield (depot_file, _parse())
+            depot_file = _to_str(item.get('depotFile'))
+            chunks     = []
+            if _to_str(item.get('action')) == 'delete':
+                yield (depot_file, None)
+                depot_file = None
+        elif depot_file:
+            chunks.append(item if isinstance(item, bytes) else item.encode())
+    if depot_file:
+        yield (depot_file, _parse())
+
+
+def load_index(p4):
+    '''
+    Return a DepotBranchInfoIndex of every depot branch-info file, from
+    every repo.
+
+    Rather than print all of them, keep a cache in P4GF_HOME of every
+    branch-info file as of some changelist, and print only the branch-info
+    files submitted since then.
+    '''
+    root = p4gf_const.P4GF_DEPOT_BRANCH_INFO_ROOT.format(
+                                              P4GF_DEPOT=p4gf_const.P4GF_DEPOT)
+    root = root + '/...'
+
+    r = p4.run('changes', '-m1', '-s', 'submitted', root)
+    head = int(p4gf_util.first_value_for_key(r, 'change') or 0)
+
+    (change, files) = _read_cache()
+    if change is None or head < change:
+        # No cache, or a cache from some other server.
+        change = None
+        files  = {}
+    if head != change:
+        if change is None:
+            path = NTR('{}@{}').format(root, head)
+        else:
+            path = NTR('{}@{},@{}').format(root, 1 + change, head)
+        updated = 0
+        for (depot_file, dbi) in _print_branch_info(p4, path):
+            if dbi:
+                files[depot_file] = _dbi_to_dict(dbi)
+            else:
+                files.pop(depot_file, None)
+            updated += 1
+        LOG.debug('depot branch cache: {} branch-info files from {}'
+                  .format(updated, path))
+        _write_cache(head, files)
+
+    index = DepotBranchInfoIndex()
+    for d in files.values():
+        index.add(_dbi_from_dict(d))
+    return index
+
+
 # "static initializer" time
 p4gf_util.test_vars_apply() # Honor sequential UUID option
 
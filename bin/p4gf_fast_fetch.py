@@ -0,0 +1,314 @@
+#! /usr/bin/env python3.3
+'''
+Serve a git fetch or clone straight from the Git repo, without the view
+lock or a Context, when Perforce has nothing new to copy into Git.
+
+Every fetch used to take the repo's view lock, build a Context, and ask
+P2G whether there was anything to copy. Concurrent fetches of a busy repo
+waited on each other for that view lock, even when none of them had any
+work to do.
+
+With config key fast-fetch enabled, each full fetch, after it copies from
+Perforce to Git with the view lock held, records in the repo's view
+directory what a later fetch must check for anything new:
+
+  * the depot paths in the union of all branch views,
+  * the highest changelist under //.git-fusion/repos/{repo}/...,
+    which a new branch or any other repo config change would pass.
+
+A later fetch reads that record and, with one 'p4 changes -m1', looks for
+any changelist on those paths since the last-copied-change counter, any
+new tags since the last-copied-tag counter, and any new repo config. If
+it finds none, it runs git-upload-pack with only the shared host/view
+lock, the same lock that any number of readers may hold at once.
+
+A finding of "nothing new" is cached for fast-fetch-ttl seconds, shared by
+all fetches of the repo on this host.
+
+Anything unexpected, and any fetch that finds something new, takes the
+full path, same as before.
+'''
+import json
+import os
+import time
+
+from P4 import P4Exception
+
+import p4gf_branch
+import p4gf_config
+import p4gf_const
+import p4gf_context
+import p4gf_create_p4
+from   p4gf_l10n      import NTR
+import p4gf_lock
+import p4gf_log
+import p4gf_util
+import p4gf_view_dirs
+
+LOG = p4gf_log.for_module()
+
+                        # Written by a full fetch, read by fast fetches.
+_STATE_FILE   = NTR('fast-fetch.json')
+
+                        # Touched by a fast fetch that found nothing new.
+_CHECKED_FILE = NTR('fast-fetch-checked')
+
+
+def _state_path(view_dirs):
+    '''
+    Where do we record what a fast fetch must check?
+    '''
+    return os.path.join(view_dirs.view_container, _STATE_FILE)
+
+
+def _checked_path(view_dirs):
+    '''
+    Where do we record when a fast fetch last found nothing new?
+    '''
+    return os.path.join(view_dirs.view_container, _CHECKED_FILE)
+
+
+def _config_path(view_name):
+    '''
+    Return the depot path of this repo's config files.
+    '''
+    return NTR('//{depot}/repos/{repo}/...').format(
+                                          depot = p4gf_const.P4GF_DEPOT
+                                        , repo  = view_name)
+
+
+def _tags_path(view_name):
+    '''
+    Return the depot path of this repo's tags.
+    See p4gf_tag.any_tags_since_last_copy().
+    '''
+    return NTR('{root}/repos/{repo}/tags/...').format(
+                                          root = p4gf_const.objects_root()
+                                        , repo = view_name)
+
+
+def _read_counter(p4, counter_name):
+    '''
+    Return a counter's value, '0' if unset.
+    '''
+    r = p4.run('counter', '-u', counter_name)
+    return p4gf_util.first_value_for_key(r, 'value') or '0'
+
+
+def _head_change(p4, path):
+    '''
+    Return the highest changelist number that touches path, 0 if none.
+    '''
+    r = p4.run('changes', '-m1', path)
+    return int(p4gf_util.first_value_for_key(r, 'change') or 0)
+
+
+def _union_depot_paths(ctx):
+    '''
+    Return the left-hand side of every include line in the union of all
+    branch views, or None if any line is one we cannot pass to 'p4 changes'.
+
+    Ignores exclude lines. That can only make us see changes where P2G
+    would see none, which sends the fetch down the full path.
+    '''
+    p4map = p4gf_branch.calc_branch_union_client_view( ctx.config.p4client
+                                                     , ctx.branch_dict())
+    paths = []
+    for lhs in p4map.lhs():
+        if lhs.startswith('-'):
+            continue
+        path = lhs.lstrip('+').strip('"')
+        if '%%' in path:
+            return None
+        paths.append(path)
+    return paths
+
+
+def _write_json(path, content):
+    '''
+    Replace a file's content all at once, so that concurrent readers see
+    either the old content or the new, never half of either.
+    '''
+    tmp_path = NTR('{}.{}').format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def _unlink(path):
+    '''
+    Remove a file if it exists.
+    '''
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def forget(view_name):
+    '''
+    Send all fetches of this repo down the full path until the next full
+    fetch records a new state.
+    '''
+    view_dirs = p4gf_view_dirs.from_p4gf_dir(p4gf_const.P4GF_HOME, view_name)
+    _unlink(_state_path(view_dirs))
+    _unlink(_checked_path(view_dirs))
+
+
+def record(ctx):
+    '''
+    Called with the view lock held, after copying from Perforce to Git:
+    record what a later fast fetch must check, or forget it if this repo
+    does not use fast fetch.
+
+    Assumes current working directory is the Git work tree.
+    '''
+    view_name = ctx.config.view_name
+    config = p4gf_config.get_repo(ctx.p4gf, view_name)
+    try:
+        enabled = config.getboolean( p4gf_config.SECTION_REPO
+                                   , p4gf_config.KEY_FAST_FETCH
+                                   , fallback = False )
+        ttl = config.getint( p4gf_config.SECTION_REPO
+                           , p4gf_config.KEY_FAST_FETCH_TTL
+                           , fallback = int(p4gf_config.VALUE_FAST_FETCH_TTL))
+    except ValueError:
+        LOG.warning('{} or {} config setting has invalid value, disabling fast fetch'
+                    .format(p4gf_config.KEY_FAST_FETCH, p4gf_config.KEY_FAST_FETCH_TTL))
+        enabled = False
+    paths = _union_depot_paths(ctx) if enabled else None
+    if not paths or p4gf_util.git_empty():
+        forget(view_name)
+        return
+
+    state = { NTR('paths')         : paths
+            , NTR('config_change') : _head_change(ctx.p4gf, _config_path(view_name))
+            , NTR('ttl')           : max(0, ttl) }
+    _write_json(_state_path(ctx.view_dirs), state)
+    _unlink(_checked_path(ctx.view_dirs))
+    LOG.debug('recorded fast fetch state for {}: {} paths, config @{}'
+              .format(view_name, len(paths), state[NTR('config_change')]))
+
+
+def _read_state(view_dirs):
+    '''
+    Return the state that the last full fetch recorded, or None.
+    '''
+    try:
+        with open(_state_path(view_dirs), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _recently_checked(view_dirs, ttl):
+    '''
+    Has some fetch found nothing new within the last ttl seconds?
+    '''
+    if not ttl:
+        return False
+    try:
+        return time.time() < os.stat(_checked_path(view_dirs)).st_mtime + ttl
+    except OSError:
+        return False
+
+
+def _nothing_new(p4, view_name, state):
+    '''
+    Return True if Perforce has no changelist since our last copy on any
+    path this repo copies, no new tags, and no change to repo config.
+    '''
+    server_id = p4gf_util.get_server_id()
+    last_change = _read_counter(p4,
+                    p4gf_context.calc_last_copied_change_counter_name(
+                        view_name, server_id))
+    if last_change == '0':
+        # Never copied, or counter deleted out from under us.
+        return False
+    last_tag = _read_counter(p4,
+                    p4gf_const.P4GF_COUNTER_LAST_COPIED_TAG.format(
+                        repo_name = view_name, server_id = server_id))
+
+    since_change = 1 + int(last_change)
+    paths = [NTR('{}@{},#head').format(path, since_change)
+             for path in state[NTR('paths')]]
+    paths.append(NTR('{}@{},#head').format(_tags_path(view_name), 1 + int(last_tag)))
+    paths.append(NTR('{}@{},#head').format( _config_path(view_name)
+                                         , 1 + state[NTR('config_change')]))
+    r = p4.run(['changes', '-m1'] + paths)
+    return not p4gf_util.first_value_for_key(r, 'change')
+
+
+def _touch(path):
+    '''
+    Set a file's modification time to now, creating it if necessary.
+    '''
+    with open(path, 'a'):
+        pass
+    os.utime(path, None)
+
+
+def _can_skip_copy(p4, view_name, view_dirs, state):
+    '''
+    Return True if Perforce has nothing new for this repo and no other
+    process holds its view lock.
+    '''
+    if _recently_checked(view_dirs, state[NTR('ttl')]):
+        LOG.debug('fast fetch {}: nothing new, cached'.format(view_name))
+    elif _nothing_new(p4, view_name, state):
+        LOG.debug('fast fetch {}: nothing new'.format(view_name))
+        _touch(_checked_path(view_dirs))
+    else:
+        LOG.debug('fast fetch {}: new changes, taking full path'.format(view_name))
+        return False
+
+    # A view lock holder might be copying into Git or pushing. Let it
+    # finish, and let it go first: queue up behind it on the full path.
+    if p4gf_lock.view_lock_exists(p4, view_name):
+        LOG.debug('fast fetch {}: view locked, taking full path'.format(view_name))
+        return False
+    return True
+
+
+def fetch(p4, view_name, git_caller, view_perm=None):
+    '''
+    If this repo uses fast fetch and Perforce has nothing new for it, run
+    git_caller() with only the shared host/view lock and return its exit
+    code.
+
+    Return None if the fetch must take the full path instead: no fast
+    fetch state recorded, something new to copy, or another process holds
+    the view lock.
+    '''
+    view_dirs = p4gf_view_dirs.from_p4gf_dir(p4gf_const.P4GF_HOME, view_name)
+    state = _read_state(view_dirs)
+    if not state or not os.path.isdir(view_dirs.GIT_DIR):
+        return None
+    try:
+        if not _can_skip_copy(p4, view_name, view_dirs, state):
+            return None
+    except (P4Exception, KeyError, TypeError, ValueError) as e:
+        # Broken state file or Perforce trouble. The full path will either
+        # succeed or report the problem properly.
+        LOG.warning('fast fetch {}: {}, taking full path'.format(view_name, e))
+        return None
+
+    # No first_acquire_func to switch the repo to --bare: we never touch
+    # the work tree or index, only git-upload-pack reads from the repo.
+    with p4gf_lock.shared_host_view_lock(p4, view_name):
+        # Any view lock holder that started copying into Git before we held
+        # our shared lock still holds its view lock. Any that starts after
+        # will see our shared lock and skip its copy.
+        if p4gf_lock.view_lock_exists(p4, view_name):
+            LOG.debug('fast fetch {}: view locked, taking full path'.format(view_name))
+            return None
+        if view_perm:
+            view_perm.write_if(p4)
+
+        os.chdir(view_dirs.GIT_WORK_TREE)
+        # call to git may take a while; no need to keep idle open connections
+        p4gf_create_p4.p4_disconnect(p4)
+        try:
+            return git_caller()
+        finally:
+            p4gf_create_p4.p4_connect(p4)
@@ -1,6 +1,10 @@
 #! /usr/bin/env python3.3
 """FastExport class"""
 
+import json
+import logging
+import os
+import pickle
 import re
 import tempfile
 
@@ -56,179 +60,354 @@ def _prune_missing_objects(sha1_list):
     missing from the local Git repository, returning the pruned list. Also
     removes duplicate entries from the list.
     """
-    p4gf_git.unpack_objects()
     found = [sha1 for sha1 in sha1_list if p4gf_git.object_exists(sha1)]
     return found
 
 
-class Parser:
-    """A parser for git fast-import/fast-export scripts"""
-    def __init__(self, text, marks):
-        self.text = text
-        self.marks = marks
-        self.offset = 0
+def _mark_line(mark_num, sha1):
+    """Return one line of a git-fast-export marks file, as bytes."""
+    return ":{} {}\n".format(mark_num, sha1).encode()
 
-    def at_end(self):
-        """return TRUE if at end of input, else FALSE"""
-        return self.offset == len(self.text)
 
-    def peek_token(self, separator):
-        """return the next token or None, without advancing position"""
-        sep = self.text.find(separator, self.offset)
-        if sep == -1:
-            return None
-        return p4gf_char.decode(self.text[self.offset:sep])
+class KnownCommitMarks:
+    """A git-fast-export marks file of every commit this repo knows about.
 
-    def get_token(self, separator):
-        """return the next token, advancing position
+    Kept in the repo's view directory and handed straight to
+    git-fast-export --import-marks. Listing every known commit and checking
+    that each exists in our Git repo costs time proportional to all history;
+    instead we append only the sha1s added to the commit index since the
+    last push, and check only those.
 
-        If no token available, raises error
+    A JSON state file beside the marks file records where we left off:
+    index generation and sequence number, mark count, marks file size, and
+    known commits that were missing from our Git repo last time (so we
+    check them again, they might since have arrived). Any mismatch or
+    surprise rebuilds from scratch.
+    """
+    VERSION = 1
 
-        If separator is more than one char, first char is the actual
-        separator and rest is lookahead, so offset will be left pointing
-        at second char of 'separator'.
-        """
-        sep = self.text.find(separator, self.offset)
-        if sep == -1:
-            raise RuntimeError(_("error parsing git-fast-export: expected '{}'")
-                               .format(separator.decode()))
-        token = p4gf_char.decode(self.text[self.offset:sep])
-        self.offset = sep + 1
-        return token
+    def __init__(self, ctx, index):
+        self.index      = index
+        self.path       = os.path.join( ctx.view_dirs.view_container
+                                      , p4gf_const.P4GF_FAST_EXPORT_MARKS)
+        self.state_path = self.path + NTR('.json')
 
-    def get_path_token(self, separator):
-        """return the next token with quotes removed, advancing position
+    def _read_state(self):
+        """Return our state dict, or None if missing or does not match
+        our marks file.
+        """
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if state[NTR('version')] != self.VERSION:
+                return None
+            size = os.path.getsize(self.path)
+            if size < state[NTR('size')]:
+                return None
+            if state[NTR('size')] < size:
+                # Appended, then died before recording it. Forget the extra.
+                with open(self.path, 'r+b') as f:
+                    f.truncate(state[NTR('size')])
+            return state
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
 
-        Paths may be quoted in fast-import/export scripts.
+    def _write_state(self, generation, seq, count, missing):
+        """Replace our state file all at once."""
+        tmp_path = NTR('{}.{}').format(self.state_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({ NTR('version')    : self.VERSION
+                      , NTR('generation') : generation
+                      , NTR('seq')        : seq
+                      , NTR('count')      : count
+                      , NTR('size')       : os.path.getsize(self.path)
+                      , NTR('missing')    : missing }, f)
+        os.replace(tmp_path, self.state_path)
+
+    def update(self):
+        """Bring the marks file up to date with the commit index.
+
+        Return the path to the marks file.
         """
-        # In git-fast-export, paths may be double-quoted and any double-quotes
-        # in the path are slash-escaped (e.g. "foo\"bar.txt").
-        offset = self.offset
-        if self.text[offset:offset + 1] != b'"':
-            return self.get_token(separator)
-        escaped = False
-        end = 0
-        for offset in range(self.offset + 1, len(self.text)):
-            if escaped:
-                escaped = False
-            elif self.text[offset:offset + 1] == b'\\':
-                escaped = True
-            elif self.text[offset:offset + 1] == b'"':
-                end = offset + 1
-                break
-        if self.text[end:end + len(separator)] != separator:
-            raise RuntimeError(_("error parsing git-fast-export: expected '{}'")
-                               .format(separator.decode()))
-        token = self.text[self.offset:end].strip(b'"')
-        self.offset = end + 1
-        # remove any slash-escapes since they are not needed from here on
-        # also undo any escaping of unicode chars that git-fast-export did
-        token = remove_backslash_escapes(token)
-        return token
-
-    def skip_optional_lf(self):
-        """skip next char if it's a LF"""
-        if self.text[self.offset:self.offset + 1] == LF:
-            self.offset = self.offset + 1
-
-    def get_data(self):
-        """read a git style string: <size> SP <string> [LF]"""
-        self.get_token(SP)
-        count = int(self.get_token(LF))
-        string = p4gf_char.decode(self.text[self.offset:self.offset + count])
-        self.offset += count
-        self.skip_optional_lf()
-        return string
-
-    def get_command(self):
-        """read a command
-
-        raises error if it's not an expected command
+        generation = self.index.generation
+        state = self._read_state()
+        if not state or state[NTR('generation')] != generation:
+            self.rebuild()
+            return self.path
+
+        new_sha1s = [sha1 for (_seq, sha1) in self.index.sha1s_since(state[NTR('seq')])]
+        seq = self.index.last_seq
+        if not new_sha1s and not state[NTR('missing')]:
+            LOG.debug2('fast-export marks current: count={}'.format(state[NTR('count')]))
+            return self.path
+
+        count = state[NTR('count')]
+        missing = []
+        with open(self.path, 'ab') as f:
+            for sha1 in state[NTR('missing')] + new_sha1s:
+                if p4gf_git.object_exists(sha1):
+                    count += 1
+                    f.write(_mark_line(count, sha1))
+                else:
+                    missing.append(sha1)
+        self._write_state(generation, seq, count, missing)
+        LOG.debug('fast-export marks updated: checked={} count={} missing={}'
+                  .format(len(state[NTR('missing')]) + len(new_sha1s), count, len(missing)))
+        return self.path
+
+    def rebuild(self):
+        """Write a new marks file from every commit in the commit index."""
+        generation = self.index.generation
+        seq        = self.index.last_seq
+        count      = 0
+        missing    = []
+        tmp_path   = NTR('{}.{}').format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            for sha1 in self.index.all_sha1s():
+                if p4gf_git.object_exists(sha1):
+                    count += 1
+                    f.write(_mark_line(count, sha1))
+                else:
+                    missing.append(sha1)
+        os.replace(tmp_path, self.path)
+        self._write_state(generation, seq, count, missing)
+        LOG.debug('fast-export marks rebuilt: count={} missing={}'
+                  .format(count, len(missing)))
+
+    def without(self, sha1, tempdir):
+        """Return a temporary copy of the marks file without sha1, or None
+        if sha1 is not in the marks file.
         """
-        command = self.get_token(SP)
-        if command == "reset":
-            return self.get_reset()
-        if command == "commit":
-            return self.get_commit()
-        raise RuntimeError(_("error parsing git-fast-export: unexpected command '{}'")
-                           .format(command))
-
-    def get_reset(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        key = b' ' + sha1.encode() + b'\n'
+        end = content.find(key)
+        if end < 0:
+            return None
+        start = content.rfind(b'\n', 0, end) + 1
+        marksfile = tempfile.NamedTemporaryFile(dir=tempdir, prefix='fastexport-')
+        marksfile.write(content[:start])
+        marksfile.write(content[end + len(key):])
+        marksfile.flush()
+        return marksfile
+
+# -- end class KnownCommitMarks -----------------------------------------------
+
+
+class Parser:
+    """A streaming parser for git-fast-export --no-data output.
+
+    Reads from a binary stream a line at a time, plus exactly <count> bytes
+    for each 'data' command, so that memory use depends on the size of one
+    commit, not the size of the whole export.
+    """
+    def __init__(self, stream, marks):
+        self.stream = stream
+        self.marks = marks
+        self.pending = None     # Line read but not yet consumed.
+
+    def _readline(self):
+        """return the next line, including its LF, or b'' at end of input"""
+        if self.pending is not None:
+            line = self.pending
+            self.pending = None
+            return line
+        return self.stream.readline()
+
+    def _unreadline(self, line):
+        """return a line to be read again by the next _readline()"""
+        self.pending = line
+
+    def commands(self):
+        """Generator: yield one dict per reset or commit command."""
+        while True:
+            line = self._readline()
+            if not line:
+                return
+            if line == LF:
+                continue
+            (command, _sp, rest) = line.rstrip(LF).partition(SP)
+            if command == b'commit':
+                yield self.get_commit(rest)
+            elif command == b'reset':
+                yield self.get_reset(rest)
+            else:
+                raise RuntimeError(_("error parsing git-fast-export: unexpected command '{}'")
+                                   .format(p4gf_char.decode(command)))
+
+    def get_data(self, count):
+        """read a git style string of count bytes"""
+        data = self.stream.read(count)
+        if len(data) != count:
+            raise RuntimeError(_("error parsing git-fast-export: expected '{}'")
+                               .format(count))
+        return p4gf_char.decode(data)
+
+    def get_reset(self, ref):
         """read the body of a reset command"""
-        ref = self.get_token(LF)
+        ref = p4gf_char.decode(ref)
         LOG.debug("get_reset ref={}".format(ref))
+        # Optional 'from' line, ignored along with the rest of the reset.
+        line = self._readline()
+        if not line.startswith(b'from '):
+            self._unreadline(line)
         return { 'command': NTR('reset')
                , 'ref'    : ref }
 
     # pylint: disable=R0912
-    # pylint: disable=R0915
     # R0912 Too many branches
-    # R0915 Too many statements
     #
     # get_commit is an obvious and easy-to-follow token dispatch, and breaking
     # it into multiple functions makes it harder to follow.
 
-    def get_commit(self):
+    def get_commit(self, ref):
         """read the body of a commit command"""
-        LOG.debug3("Commit text: {}".format(self.text[self.offset:300 + self.offset]))
-        ref = self.get_token(LF)
         result = { 'command': NTR('commit')
-                 , 'ref'    : ref
+                 , 'ref'    : p4gf_char.decode(ref)
                  , 'files'  : [] }
         while True:
-            next_token = self.peek_token(SP)
-            if next_token == "mark":
-                self.get_token(SP)
-                result["mark"] = self.get_token(LF)[1:]
+            line = self._readline()
+            if not line or line == LF:
+                break
+            (tag, _sp, rest) = line.rstrip(LF).partition(SP)
+            if tag == b'M':
+                (mode, sha1, path) = rest.split(SP, 2)
+                result["files"].append({ "action" : "M"
+                                       , "mode"   : p4gf_char.decode(mode)
+                                       , "sha1"   : p4gf_char.decode(sha1)
+                                       , "path"   : _path(path) })
+            elif tag == b'D':
+                result["files"].append({ "action" : "D"
+                                       , "path"   : _path(rest) })
+            elif tag == b'R' or tag == b'C':
+                (path, topath) = _split_paths(rest)
+                result["files"].append({ "action" : p4gf_char.decode(tag)
+                                       , "path"   : path
+                                       , "topath" : topath })
+            elif tag == b'mark':
+                result["mark"] = p4gf_char.decode(rest)[1:]
                 result["sha1"] = self.marks[result["mark"]]
-            elif next_token == "author" or next_token == "committer":
-                tag = self.get_token(SP)
-                value = {}
-                value["user"] = self.get_token(SPLT)
-                value["email"] = self.get_token(SP)
-                value["date"] = self.get_token(SP)
-                value["timezone"] = self.get_token(LF)
-                result[tag] = value
-            elif next_token == "data":
-                result["data"] = self.get_data()
-            elif next_token == "from":
-                self.get_token(SP)
-                result["from"] = self.get_token(LF)[1:]
-            elif next_token == "merge":
-                self.get_token(SP)
-                value = self.get_token(LF)[1:]
+            elif tag == b'author' or tag == b'committer':
+                result[p4gf_char.decode(tag)] = _person(rest)
+            elif tag == b'data':
+                result["data"] = self.get_data(int(rest))
+            elif tag == b'from':
+                result["from"] = p4gf_char.decode(rest)[1:]
+            elif tag == b'merge':
+                value = p4gf_char.decode(rest)[1:]
                 if "merge" not in result:
                     result["merge"] = [value]
                 else:
                     result["merge"].append(value)
-            elif next_token == "M":
-                value = {"action": self.get_token(SP)}
-                value["mode"] = self.get_token(SP)
-                value["sha1"] = self.get_token(SP)
-                value["path"] = self.get_path_token(LF)
-                result["files"].append(value)
-            elif next_token == "D":
-                value = {"action": self.get_token(SP)}
-                value["path"] = self.get_path_token(LF)
-                result["files"].append(value)
-            elif next_token == "R":
-                value = {"action": self.get_token(SP)}
-                value["path"] = self.get_path_token(SP)
-                value["topath"] = self.get_path_token(LF)
-                result["files"].append(value)
-            elif next_token == "C":
-                value = {"action": self.get_token(SP)}
-                value["path"] = self.get_path_token(SP)
-                value["topath"] = self.get_path_token(LF)
-                result["files"].append(value)
-            else:
+            elif tag == b'commit' or tag == b'reset':
+                # Next command, no blank line between. Leave it for commands().
+                self._unreadline(line)
                 break
-        self.skip_optional_lf()
+            else:
+                LOG.debug3("ignoring git-fast-export line: {}".format(line))
         LOG.debug3("Extracted commit: {}".format(result))
         return result
 
     # pylint: enable=R0912
-    # pylint: enable=R0915
+
+
+def _path(token):
+    """return a path token with any quotes and escapes removed
+
+    In git-fast-export, paths may be double-quoted, with any double-quotes
+    and special characters in the path slash-escaped (e.g. "foo\\"bar.txt").
+    """
+    if len(token) < 2 or token[:1] != b'"' or token[-1:] != b'"':
+        return p4gf_char.decode(token)
+    return remove_backslash_escapes(token[1:-1])
+
+
+def _split_paths(rest):
+    """split the two paths of an R or C file command"""
+    if rest[:1] != b'"':
+        (path, _sp, topath) = rest.partition(SP)
+        return (_path(path), _path(topath))
+    escaped = False
+    for offset in range(1, len(rest)):
+        c = rest[offset:offset + 1]
+        if escaped:
+            escaped = False
+        elif c == b'\\':
+            escaped = True
+        elif c == b'"':
+            if rest[offset + 1:offset + 2] != SP:
+                break
+            return (_path(rest[:offset + 1]), _path(rest[offset + 2:]))
+    raise RuntimeError(_("error parsing git-fast-export: expected '{}'")
+                       .format(SP.decode()))
+
+
+def _person(rest):
+    """read an author or committer value: name <email> date timezone"""
+    i = rest.find(SPLT)
+    (user, tail) = (rest[:i], rest[i + 1:]) if 0 <= i else (b'', rest)
+    (email, date, timezone) = tail.rsplit(SP, 2)
+    return { "user"     : p4gf_char.decode(user)
+           , "email"    : p4gf_char.decode(email)
+           , "date"     : p4gf_char.decode(date)
+           , "timezone" : p4gf_char.decode(timezone) }
+
+
+class CommitList:
+    """A sequence of fast-export commit dicts, kept in a temporary file.
+
+    Parsing appends each commit as it goes, so a large push does not hold
+    every commit, with every file action, in memory at once. Iterating or
+    indexing reads one commit back at a time.
+
+    Callers may add keys to a commit while iterating (G2P preflight adds
+    the author/pusher/owner Perforce users). We keep those added keys in
+    memory and merge them into the commit each time it is read back.
+    Changes to keys that came from git-fast-export are not kept.
+    """
+    def __init__(self, tempdir):
+        self._file    = tempfile.TemporaryFile(dir=tempdir, prefix='fe-commits-')
+        self._offsets = []
+        self._added   = {}      # index ==> {key: value} added by callers
+
+    def append(self, commit):
+        """Write one commit to our file."""
+        self._offsets.append(self._file.seek(0, os.SEEK_END))
+        pickle.dump(commit, self._file, pickle.HIGHEST_PROTOCOL)
+
+    def annotate(self, index, **kwargs):
+        """Add keys to a commit."""
+        if index < 0:
+            index += len(self._offsets)
+        self._added.setdefault(index, {}).update(kwargs)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._offsets)
+        if not 0 <= index < len(self._offsets):
+            raise IndexError(index)
+        self._file.seek(self._offsets[index])
+        commit = pickle.load(self._file)
+        commit.update(self._added.get(index, {}))
+        return commit
+
+    def __iter__(self):
+        for index in range(len(self._offsets)):
+            commit = self[index]
+            keys = set(commit)
+            yield commit
+            added = {k: v for k, v in commit.items() if k not in keys}
+            if added:
+                self._added.setdefault(index, {}).update(added)
+
+    def close(self):
+        """Delete our file."""
+        self._file.close()
+
+# -- end class CommitList -----------------------------------------------------
 
 
 class FastExport:
@@ -247,19 +426,42 @@ class FastExport:
             self.last_old_commit = None
         self.last_new_commit = last_new_commit
         self.tempdir = tempdir
-        self.script = None
         self.marks = {}
-        self.commits = None
+        self.commits = None     # CommitList
+
+                # Persistent marks file, if this repo has a commit index.
+        self.known_marks = None
 
                 # If true, forces git-fast-export to include at least
                 # last_new_commit, even if that commit already exists in Git
                 # history at or before last_old_commit.
         self.force_export_last_new_commit = False
 
+    def import_marks_path(self):
+        """Return (path, tempfile) for git-fast-export --import-marks.
+
+        Prefer our persistent, incrementally updated marks file. tempfile is
+        a temporary file that the caller must close, or None.
+        """
+        index = p4gf_object_type.known_commit_index(self.ctx)
+        if not index:
+            marksfile = self.write_marks()
+            return (marksfile.name, marksfile)
+
+        self.known_marks = KnownCommitMarks(self.ctx, index)
+        path = self.known_marks.update()
+        if self.force_export_last_new_commit:
+            marksfile = self.known_marks.without(self.last_new_commit, self.tempdir)
+            if marksfile:
+                return (marksfile.name, marksfile)
+        return (path, None)
+
     def write_marks(self):
         """Write a text file with list of every commit sha1 our Git Fusion
         repo already knows about. "Knows about" here also requires "and is
         copied to Perforce.".
+
+        Used only for repos without a commit index: see KnownCommitMarks.
         """
         log = LOG.getChild('marks')
         marksfile = tempfile.NamedTemporaryFile(dir=self.tempdir, prefix='fastexport-')
@@ -284,34 +486,59 @@ class FastExport:
     def read_marks(self, marksfile):
         """read list of sha1 from marks file created by git-fast-export"""
         log = LOG.getChild('marks')
-        marks = marksfile.readlines()
+        debug = log.isEnabledFor(logging.DEBUG)
         self.marks = {}
-        for mark in marks:
+        for mark in marksfile:
             parts = mark.decode().split(" ")
             marknum = parts[0][1:]
             sha1 = parts[1].strip()
             self.marks[marknum] = sha1
-            log.debug(mark)
-
-    def parse_commands(self):
-        """parse commands from script"""
-        p = Parser(self.script, self.marks)
-        self.commits = []
-        while not p.at_end():
-            cmd = p.get_command()
+            if debug:
+                log.debug(mark)
+
+    def parse_commands(self, stream):
+        """parse commands from git-fast-export output stream"""
+        p = Parser(stream, self.marks)
+        if self.commits is not None:
+            self.commits.close()
+        self.commits = CommitList(self.tempdir)
+        for cmd in p.commands():
             if cmd['command'] != 'commit':
                 # ignore 'reset' commands
                 continue
             del cmd['command']
             self.commits.append(cmd)
         if self.commits:
-            self.commits[-1]['last_commit'] = True
+            self.commits.annotate(-1, last_commit=True)
 
     def run(self):
         """Run git-fast-export"""
+        (import_marks_path, import_marks) = self.import_marks_path()
+        try:
+            result = self._run_fast_export( import_marks_path
+                                          , may_retry=bool(self.known_marks))
+            if result['ec'] and self.known_marks:
+                # Marks file lists a commit that's no longer in our Git repo?
+                # Rebuild it, checking every commit, and try once more.
+                LOG.warning('git-fast-export failed with persistent marks, rebuilding: {}'
+                            .format(result['err']))
+                if import_marks:
+                    import_marks.close()
+                    import_marks = None
+                self.known_marks.rebuild()
+                (import_marks_path, import_marks) = self.import_marks_path()
+                self._run_fast_export(import_marks_path)
+        finally:
+            if import_marks:
+                import_marks.close()
 
-        import_marks = self.write_marks()
+    def _run_fast_export(self, import_marks_path, may_retry=False):
+        """Run git-fast-export once, parse its output, return its result.
+
+        If may_retry, do not parse the output of a failed git-fast-export.
+        """
         export_marks = tempfile.NamedTemporaryFile(dir=self.tempdir, prefix='fe-marks-')
+        export_out   = tempfile.NamedTemporaryFile(dir=self.tempdir, prefix='fe-out-')
 
         # Note that we do not ask Git to attempt to detect file renames or
         # copies, as this seems to lead to several bugs, including one that
@@ -319,7 +546,7 @@ class FastExport:
         # operations exactly as they appear in the commit. This also makes the
         # round-trip conversion safer.
         cmd = ['git', 'fast-export', '--no-data']
-        cmd.append("--import-marks={}".format(import_marks.name))
+        cmd.append("--import-marks={}".format(import_marks_path))
         cmd.append("--export-marks={}".format(export_marks.name))
         if self.last_old_commit:
             cmd.append("{}..{}".format(self.last_old_commit, self.last_new_commit))
@@ -328,11 +555,15 @@ class FastExport:
         LOG.debug('cmd={}'.format(cmd))
 
         try:
-            # work around pylint bug where it doesn't know check_output() returns encoded bytes
-            result = p4gf_proc.popen_binary(cmd)
-            self.script = result['out']
+            # git-fast-export writes straight to export_out, which we then
+            # parse a commit at a time, never holding all of it in memory.
+            result = p4gf_proc.popen_to_file(cmd, export_out.name)
+            if result['ec'] and may_retry:
+                return result
             self.read_marks(export_marks)
-            self.parse_commands()
+            export_out.seek(0)
+            self.parse_commands(export_out)
         finally:
-            import_marks.close()
             export_marks.close()
+            export_out.close()
+        return result
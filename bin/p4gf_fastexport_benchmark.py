@@ -0,0 +1,129 @@
+#! /usr/bin/env python3.3
+'''
+Measure git-fast-export parser throughput: how many MB/s and commits/s can
+FastExport's streaming Parser read, and spill to a CommitList?
+
+Parses either the output of 'git fast-export --no-data' from a real repo,
+or a generated script of --commits commits with --files file actions each.
+
+For example
+
+    p4gf_fastexport_benchmark.py --commits 100000 --files 20
+    p4gf_fastexport_benchmark.py --git-dir /path/to/repo/.git --rev master
+'''
+import os
+import subprocess
+import tempfile
+import time
+
+from   p4gf_l10n      import _, NTR
+import p4gf_fastexport
+import p4gf_util
+
+
+def _write_synthetic(f, commit_count, file_count):
+    '''
+    Write a git-fast-export --no-data style script to f.
+    Return a marks dict for its commits.
+    '''
+    marks = {}
+    for c in range(1, 1 + commit_count):
+        sha1 = NTR('{:040x}').format(c)
+        marks[str(c)] = sha1
+        msg = NTR('Commit {}\n\nA longer description of commit {}.\n').format(c, c).encode()
+        lines = [ NTR('commit refs/heads/master')
+                , NTR('mark :{}').format(c)
+                , NTR('author Some Body <some.body@example.com> {} +0000').format(1400000000 + c)
+                , NTR('committer Some Body <some.body@example.com> {} +0000')
+                                                                .format(1400000000 + c)
+                , NTR('data {}').format(len(msg)) ]
+        f.write('\n'.join(lines).encode() + b'\n' + msg)
+        if 1 < c:
+            f.write(NTR('from :{}\n').format(c - 1).encode())
+        for i in range(file_count):
+            f.write(NTR('M 100644 {} dir{}/sub dir/file {}.txt\n')
+                    .format(sha1, i % 10, i).encode())
+        f.write(b'\n')
+    return marks
+
+
+def _write_git(f, git_dir, rev):
+    '''
+    Write 'git fast-export --no-data' output to f.
+    Return a marks dict for its commits.
+    '''
+    with tempfile.NamedTemporaryFile(prefix=NTR('fe-marks-')) as marks_file:
+        subprocess.check_call(
+              [ 'git', '--git-dir', git_dir, 'fast-export', '--no-data'
+              , NTR('--export-marks={}').format(marks_file.name), rev ]
+            , stdout = f )
+        marks = {}
+        for line in marks_file:
+            (mark, sha1) = line.decode().split()
+            marks[mark[1:]] = sha1.strip()
+    return marks
+
+
+def _measure(path, marks, spill):
+    '''
+    Parse path. Return (seconds, commit count).
+    '''
+    start = time.time()
+    with open(path, 'rb') as f:
+        p = p4gf_fastexport.Parser(f, marks)
+        if spill:
+            commits = p4gf_fastexport.CommitList(os.path.dirname(path))
+            for cmd in p.commands():
+                commits.append(cmd)
+            count = len(commits)
+            commits.close()
+        else:
+            count = sum(1 for _cmd in p.commands())
+    return (time.time() - start, count)
+
+
+def main():
+    '''
+    Generate or export a script, parse it, and report.
+    '''
+    parser = p4gf_util.create_arg_parser(
+        _('Measure git-fast-export parser throughput in MB/s.'))
+    parser.add_argument('--commits', type=int, default=10000,
+                        help=_('generated commits'))
+    parser.add_argument('--files', type=int, default=10,
+                        help=_('file actions per generated commit'))
+    parser.add_argument('--git-dir',
+                        help=_('parse fast-export output of this repo instead'))
+    parser.add_argument('--rev', default='HEAD',
+                        help=_('revision range to export from --git-dir'))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help=_('report the best of this many runs'))
+    args = parser.parse_args()
+
+    (fd, path) = tempfile.mkstemp(prefix=NTR('p4gf_fastexport_benchmark_'))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if args.git_dir:
+                marks = _write_git(f, args.git_dir, args.rev)
+            else:
+                marks = _write_synthetic(f, args.commits, args.files)
+        mb = os.path.getsize(path) / (1024.0 * 1024.0)
+
+        fmt = NTR('{name:<12} {mb:8.1f} MB {count:8,d} commits in {secs:7.3f}s'
+                  '  {mbps:8.1f} MB/s  {cps:10,.0f} commits/s')
+        for (name, spill) in [ (NTR('parse'),       False)
+                             , (NTR('parse+spill'), True ) ]:
+            runs = [_measure(path, marks, spill) for _i in range(max(1, args.repeat))]
+            (secs, count) = min(runs)
+            print(fmt.format( name  = name
+                            , mb    = mb
+                            , count = count
+                            , secs  = secs
+                            , mbps  = mb / secs if secs else 0
+                            , cps   = count / secs if secs else 0 ))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
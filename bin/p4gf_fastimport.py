@@ -410,6 +410,10 @@ class FastImport:
                     #read the exported marks from file and return result
                     with open(marks_file.name, "r") as marksfile:
                         marks = [l.strip() for l in marksfile.readlines()]
+                    # git-fast-import wrote commits, trees, and blobs that
+                    # sha1_exists() might remember as missing.
+                    p4gf_util.sha1_exists_invalidate()
+                    p4gf_util.note_sha1s_exist(l.split()[1] for l in marks if ' ' in l)
                     if LOG.getChild('marks').isEnabledFor(logging.DEBUG3):
                         LOG.getChild('marks').debug3('git-fast-import returned marks ct={}\n'
                                                      .format(len(marks))
@@ -14,6 +14,7 @@ import pygit2
 
 import p4gf_char
 import p4gf_const
+import p4gf_git_pack
 import p4gf_log
 from   p4gf_l10n    import _
 import p4gf_proc
@@ -59,6 +60,10 @@ def unpack_objects():
     Find all existing pack objects in the Git repository, unpack them,
     and then remove the now defunct pack and index files.
 
+    No longer required before object_exists(), cat_file(), or
+    link_object(): those read packs directly. Retained for code that truly
+    needs every object loose.
+
     Returns True if successful, False otherwise.
     """
     pack_dir = os.path.join(".git", "objects", "pack")
@@ -88,8 +93,19 @@ def cat_file_to_local_file(sha1, p4filetype, local_file):
     Perform the equivalent of the git-cat-file command on the given object.
     Write content to given local_file path.
 
-    Assumes .git/objects hierarchy stored completely loose, no packed objects.
+    Streams loose objects. Packed objects are read into memory whole.
     """
+    if _cat_file_sha1_to_path(sha1) is None:
+        (_type, data) = read_object(sha1)
+        if data is None:
+            raise RuntimeError(_('object not found: {}').format(sha1))
+        if p4filetype == 'symlink':
+            os.symlink(data, local_file)
+        else:
+            with open(local_file, 'wb') as fout:
+                fout.write(data)
+        return
+
     chunksize      = 64 * 1024
     decompressor   = zlib.decompressobj()
     header         = None
@@ -131,17 +147,14 @@ def cat_file_to_local_file(sha1, p4filetype, local_file):
 def _cat_file_sha1_to_path(sha1):
     '''
     Error-checking code common to cat_file() and cat_file_to_local_file().
-    Return path to local .git/objects/xxx file if exists, None if not.
+    Return path to local .git/objects/xxx file if exists, None if not
+    (not found, or packed).
     '''
     if len(sha1) != 40:
         raise RuntimeError(_('malformed SHA1: {}').format(sha1))
     if not os.path.exists(".git"):
         LOG.error("No Git repository found in {}".format(os.getcwd()))
-    path = object_path(sha1)
-    if path is None:
-        LOG.warn("cat_file() file {} not found".format(sha1))
-        return None
-    return path
+    return object_path(sha1)
 
 
 def cat_file(sha1):
@@ -152,12 +165,77 @@ def cat_file(sha1):
     Operates in memory, so please do not call this for blobs of unusual size.
     Use only for commit and tree and other small objects.
 
-    Assumes .git/objects hierarchy stored completely loose, no packed objects.
+    Returns the object's "type size\0" header followed by its content,
+    whether stored loose or packed.
+    """
+    path = _cat_file_sha1_to_path(sha1)
+    if path is not None:
+        with open(path, 'rb') as f:
+            blob = f.read()
+        data = zlib.decompress(blob)
+        return data
+    (type_name, data) = _packs().read(sha1)
+    if data is None:
+        return b''
+    return _loose_header(type_name, data) + data
+
+
+def read_object(sha1):
+    """
+    Return (type name, content bytes) for a Git object, loose or packed.
+    Content excludes the "type size\0" header.
+    Return (None, None) if not found.
+    """
+    path = object_path(sha1)
+    if path is None:
+        return _packs().read(sha1)
+    with open(path, 'rb') as f:
+        data = zlib.decompress(f.read())
+    i = data.index(b'\x00')
+    return (data[:i].split(b' ')[0].decode(), data[i+1:])
+
+
+def link_object(sha1, dst):
+    """
+    Place a copy of a Git object, in loose object format (zlib'd header +
+    content), at dst.
+
+    Hardlink loose objects. Packed objects get written out: this is how we
+    mirror objects to Perforce without first exploding every pack.
+    """
+    path = object_path(sha1)
+    if path is not None:
+        os.link(path, dst)
+        return
+    (type_name, data) = _packs().read(sha1)
+    if data is None:
+        raise RuntimeError(_('object not found: {}').format(sha1))
+    with open(dst, 'wb') as f:
+        f.write(zlib.compress(_loose_header(type_name, data) + data))
+
+
+def _loose_header(type_name, data):
+    """
+    Return the b"type size\0" header that precedes content in a loose object.
+    """
+    return '{} {}\0'.format(type_name, len(data)).encode()
+
+
+# .git/objects/pack path ==> p4gf_git_pack.Packs
+_PACKS = {}
+
+
+def _packs():
+    """
+    Return a p4gf_git_pack.Packs for the current working directory's repo.
+    Shared, so that each pack's index is mapped at most once per process.
     """
-    with open(_cat_file_sha1_to_path(sha1), 'rb') as f:
-        blob = f.read()
-    data = zlib.decompress(blob)
-    return data
+    key = os.path.abspath(p4gf_git_pack.pack_dir())
+    packs = _PACKS.get(key)
+    if packs is None:
+        packs = p4gf_git_pack.Packs(key)
+        _PACKS[key] = packs
+    return packs
 
 
 def get_commit(sha1):
@@ -172,15 +250,15 @@ def get_commit(sha1):
 
 def object_exists(sha1):
     """
-    Check if a Git object exists. Caller should invoke unpack_objects() first.
+    Check if a Git object exists, loose or packed.
     """
-    return object_path(sha1) is not None
+    return object_path(sha1) is not None or _packs().contains(sha1)
 
 
 def object_path(sha1):
     """
-    Get the path to a Git object, returning None if it does not exist.
-    Caller should invoke unpack_objects() first.
+    Get the path to a loose Git object, returning None if it does not exist
+    as a loose object. It might still exist in a pack: see object_exists().
     """
     # Files may be named de/adbeef... or de/ad/beef... in .git/objects directory
     base = os.path.join(".git", "objects")
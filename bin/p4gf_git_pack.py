@@ -0,0 +1,539 @@
+#! /usr/bin/env python3.3
+'''
+Read and write Git packfiles without launching git.
+
+Git Fusion historically exploded every pack into loose objects so that the
+rest of the code could find any object at .git/objects/xx/x{38}. On large
+repos that means millions of inodes. This module lets us leave objects in
+packs:
+
+    Packs           Look up and read (and undeltify) objects from every
+                    .git/objects/pack/*.idx + *.pack pair.
+
+    PackWriter      Append objects, compressed, to a new packfile, then
+                    write its version 2 .idx so that Git and Packs can
+                    find them.
+
+Pack and index formats: see Git's Documentation/technical/pack-format.txt.
+'''
+import binascii
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from   p4gf_l10n      import _, NTR
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # Object type numbers, as stored in pack entry headers.
+OBJ_COMMIT    = 1
+OBJ_TREE      = 2
+OBJ_BLOB      = 3
+OBJ_TAG       = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAME = { OBJ_COMMIT : NTR('commit')
+            , OBJ_TREE   : NTR('tree')
+            , OBJ_BLOB   : NTR('blob')
+            , OBJ_TAG    : NTR('tag') }
+TYPE_NUM  = { v : k for k, v in TYPE_NAME.items() }
+
+_IDX_V2_MAGIC = b'\377tOc'
+_PACK_MAGIC   = b'PACK'
+
+                        # Read compressed pack data this many bytes at a time.
+_CHUNK_SIZE   = 64 * 1024
+
+                        # Start a new pack once the current one grows this big.
+PACK_MAX_BYTES = 512 * 1024 * 1024
+
+
+def pack_dir(git_dir='.git'):
+    '''Return .git/objects/pack'''
+    return os.path.join(git_dir, 'objects', 'pack')
+
+
+# -- reading ------------------------------------------------------------------
+
+class _PackIndex:
+    '''
+    One .idx file, memory-mapped. Binary search for sha1 → pack offset.
+    '''
+
+    def __init__(self, idx_path):
+        self.idx_path  = idx_path
+        self.pack_path = idx_path[:-4] + NTR('.pack')
+        with open(idx_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, 'rb') as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:4] == _IDX_V2_MAGIC:
+            self.version   = 2
+            fanout_start   = 8
+        else:
+            self.version   = 1
+            fanout_start   = 0
+        self._fanout = struct.unpack( NTR('>256I')
+                                    , self._mm[fanout_start:fanout_start + 1024])
+        self.count   = self._fanout[255]
+        table_start  = fanout_start + 1024
+        if self.version == 2:
+            self._names_start = table_start
+            self._off32_start = table_start + 24 * self.count   # names + crc
+            self._off64_start = self._off32_start + 4 * self.count
+        else:
+            self._names_start = table_start     # (4-byte offset, name) pairs
+
+    def close(self):
+        '''Unmap.'''
+        self._mm.close()
+        self._pack.close()
+
+    def _name(self, i):
+        '''Return the i'th sorted binary sha1.'''
+        if self.version == 2:
+            start = self._names_start + 20 * i
+        else:
+            start = self._names_start + 24 * i + 4
+        return self._mm[start:start + 20]
+
+    def offset(self, bin_sha1):
+        '''
+        Return pack offset of the given 20-byte binary sha1, or None if
+        not in this pack.
+        '''
+        first = bin_sha1[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self._name(mid)
+            if name < bin_sha1:
+                lo = mid + 1
+            elif bin_sha1 < name:
+                hi = mid
+            else:
+                return self._offset_at(mid)
+        return None
+
+    def _offset_at(self, i):
+        '''Return the pack offset for the i'th sorted object.'''
+        if self.version == 1:
+            start = self._names_start + 24 * i
+            return struct.unpack(NTR('>I'), self._mm[start:start + 4])[0]
+        start = self._off32_start + 4 * i
+        off = struct.unpack(NTR('>I'), self._mm[start:start + 4])[0]
+        if off & 0x80000000:
+            start = self._off64_start + 8 * (off & 0x7fffffff)
+            off = struct.unpack(NTR('>Q'), self._mm[start:start + 8])[0]
+        return off
+
+    def read(self, offset, packs):
+        '''
+        Return (type_num, data) for the object at pack offset.
+        Resolves deltas, recursively if necessary.
+        '''
+        (type_num, size, pos) = self._entry_header(offset)
+        if type_num == OBJ_OFS_DELTA:
+            (base_rel, pos) = _read_ofs_delta_offset(self._pack, pos)
+            (type_num, base) = self.read(offset - base_rel, packs)
+            delta = self._inflate(pos, size)
+            return (type_num, _apply_delta(base, delta))
+        if type_num == OBJ_REF_DELTA:
+            base_sha1 = self._pack[pos:pos + 20]
+            (type_num, base) = packs.read_binary(base_sha1)
+            if base is None:
+                raise RuntimeError(_('missing delta base {} in {}')
+                                   .format( binascii.hexlify(base_sha1).decode()
+                                          , self.pack_path))
+            delta = self._inflate(pos + 20, size)
+            return (type_num, _apply_delta(base, delta))
+        return (type_num, self._inflate(pos, size))
+
+    def _entry_header(self, offset):
+        '''
+        Decode a pack entry's type+size varint.
+        Return (type_num, uncompressed size, offset of following byte).
+        '''
+        c = self._pack[offset]
+        type_num = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = offset + 1
+        while c & 0x80:
+            c = self._pack[pos]
+            size |= (c & 0x7f) << shift
+            shift += 7
+            pos += 1
+        return (type_num, size, pos)
+
+    def _inflate(self, pos, size):
+        '''
+        Decompress the zlib stream that starts at pos. Stop as soon as the
+        stream ends: we do not know its compressed length up front.
+        '''
+        d = zlib.decompressobj()
+        out = []
+        end = len(self._pack)
+        while not d.eof and pos < end:
+            chunk = self._pack[pos:pos + _CHUNK_SIZE]
+            pos += len(chunk)
+            out.append(d.decompress(chunk))
+        data = b''.join(out)
+        if len(data) != size:
+            raise RuntimeError(_('corrupt pack entry in {}: expected {} bytes, got {}')
+                               .format(self.pack_path, size, len(data)))
+        return data
+
+# -- end class _PackIndex -----------------------------------------------------
+
+
+class Packs:
+    '''
+    Every pack in one .git/objects/pack directory.
+
+    Rescans the directory only upon a lookup miss, so that packs created
+    since our last scan (git-fast-import, git-receive-pack, PackWriter) are
+    found without paying for a directory listing on every lookup.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._index    = {}     # idx path ==> _PackIndex
+        self._lock     = threading.Lock()
+
+    def _rescan(self):
+        '''
+        Open any .idx we have not yet opened. Forget any that have vanished
+        (git gc, git repack).
+        '''
+        with self._lock:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+            current = { os.path.join(self.directory, n) for n in names
+                        if n.endswith(NTR('.idx')) }
+            for path in list(self._index.keys()):
+                if path not in current:
+                    self._index.pop(path).close()
+            for path in current - set(self._index.keys()):
+                try:
+                    self._index[path] = _PackIndex(path)
+                except (OSError, ValueError) as e:
+                    LOG.warn('cannot open pack index {}: {}'.format(path, e))
+            return list(self._index.values())
+
+    def _find(self, bin_sha1):
+        '''
+        Return (_PackIndex, offset) that holds bin_sha1, or (None, None).
+        '''
+        for scan in (False, True):
+            indexes = self._rescan() if scan else list(self._index.values())
+            for idx in indexes:
+                off = idx.offset(bin_sha1)
+                if off is not None:
+                    return (idx, off)
+        return (None, None)
+
+    def contains(self, sha1):
+        '''Is this hex sha1 in any pack?'''
+        return self._find(binascii.unhexlify(sha1))[0] is not None
+
+    def read(self, sha1):
+        '''
+        Return (type name, content bytes) for hex sha1,
+        or (None, None) if not in any pack.
+        '''
+        (type_num, data) = self.read_binary(binascii.unhexlify(sha1))
+        if data is None:
+            return (None, None)
+        return (TYPE_NAME[type_num], data)
+
+    def read_binary(self, bin_sha1):
+        '''
+        Return (type number, content bytes) for binary sha1,
+        or (None, None) if not in any pack.
+        '''
+        (idx, off) = self._find(bin_sha1)
+        if idx is None:
+            return (None, None)
+        return idx.read(off, self)
+
+    def close(self):
+        '''Unmap all indexes.'''
+        with self._lock:
+            for idx in self._index.values():
+                idx.close()
+            self._index = {}
+
+# -- end class Packs ----------------------------------------------------------
+
+
+def _read_ofs_delta_offset(buf, pos):
+    '''
+    Decode an OFS_DELTA's negative base offset.
+    Return (offset, position of following byte).
+    '''
+    c = buf[pos]
+    pos += 1
+    off = c & 0x7f
+    while c & 0x80:
+        c = buf[pos]
+        pos += 1
+        off = ((off + 1) << 7) | (c & 0x7f)
+    return (off, pos)
+
+
+def _read_delta_size(delta, pos):
+    '''
+    Decode a little-endian base-128 size from a delta header.
+    Return (size, position of following byte).
+    '''
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return (size, pos)
+
+
+def _apply_delta(base, delta):
+    '''
+    Apply a Git delta to base content, return the result.
+    '''
+    (base_size,   pos) = _read_delta_size(delta, 0)
+    (result_size, pos) = _read_delta_size(delta, pos)
+    if base_size != len(base):
+        raise RuntimeError(_('delta base size mismatch: expected {}, got {}')
+                           .format(base_size, len(base)))
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+                        # Copy from base.
+            cp_off = 0
+            cp_size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    cp_off |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    cp_size |= delta[pos] << (8 * i)
+                    pos += 1
+            if cp_size == 0:
+                cp_size = 0x10000
+            out += base[cp_off:cp_off + cp_size]
+        elif op:
+                        # Insert literal bytes from delta.
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise RuntimeError(_('corrupt delta: opcode 0'))
+    if len(out) != result_size:
+        raise RuntimeError(_('delta result size mismatch: expected {}, got {}')
+                           .format(result_size, len(out)))
+    return bytes(out)
+
+
+# -- writing ------------------------------------------------------------------
+
+class PackWriter:
+    '''
+    Append objects to a new packfile, then write its index.
+
+    Objects are stored whole, never deltified: we trade a larger pack for
+    not having to search for delta bases while printing. A later 'git gc'
+    or 'git repack' can deltify if the space matters.
+
+    Thread-safe: multiple PrintPool workers may share one PackWriter.
+
+    Objects are not visible to Git (or to Packs) until finish() writes the
+    .idx. Call finish() before anything (such as git-fast-import) needs to
+    read the objects.
+    '''
+
+    def __init__(self, git_dir='.git', max_bytes=PACK_MAX_BYTES):
+        self.directory  = pack_dir(git_dir)
+        self.max_bytes  = max_bytes
+        self._lock      = threading.Lock()
+
+        self._body      = None  # temp file of entries, no header yet
+        self._body_size = 0
+        self._entries   = []    # (bin_sha1, crc32, offset)
+        self._sha1s     = set() # bin_sha1, to avoid duplicate entries
+
+                        # Instrumentation
+        self.pack_count   = 0
+        self.object_count = 0
+
+    def add(self, sha1, type_name, size, compressed):
+        '''
+        Append one object.
+
+        compressed is a readable file object positioned at the start of the
+        zlib-compressed content. Content only: no "blob {size}\\0" loose
+        object header. size is the uncompressed content size.
+
+        Return False if this pack already holds sha1, True if added.
+        '''
+        bin_sha1 = binascii.unhexlify(sha1)
+        header = _entry_header(TYPE_NUM[type_name], size)
+        with self._lock:
+            if bin_sha1 in self._sha1s:
+                return False
+            if self._body is None:
+                p4gf_util.ensure_dir(self.directory)
+                self._body = tempfile.NamedTemporaryFile(
+                                  dir    = self.directory
+                                , prefix = NTR('tmp_pack_')
+                                , delete = False )
+                        # +12 for the 'PACK' header we'll prepend in finish().
+            offset = 12 + self._body_size
+            crc = zlib.crc32(header)
+            self._body.write(header)
+            length = len(header)
+            while True:
+                chunk = compressed.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                self._body.write(chunk)
+                length += len(chunk)
+            self._body_size += length
+            self._entries.append((bin_sha1, crc & 0xffffffff, offset))
+            self._sha1s.add(bin_sha1)
+            self.object_count += 1
+            if self.max_bytes <= self._body_size:
+                self._finish_locked()
+        return True
+
+    def finish(self):
+        '''
+        Write the current pack and its index. NOP if nothing added since the
+        last finish(). Safe to continue add()ing afterwards: subsequent
+        objects go to a new pack.
+        '''
+        with self._lock:
+            self._finish_locked()
+        p4gf_util.sha1_exists_invalidate()
+
+    def _finish_locked(self):
+        '''
+        Prepend the 'PACK' header to our body, checksum it all, write .idx.
+        Caller must hold self._lock.
+        '''
+        if self._body is None:
+            return
+        body_path = self._body.name
+        self._body.close()
+        self._body = None
+
+                        # pylint:disable=E1101
+                        # Module 'hashlib' has no 'sha1' member
+        pack_sha1 = hashlib.sha1()
+                        # pylint:enable=E1101
+        pack_tmp = tempfile.NamedTemporaryFile( dir    = self.directory
+                                              , prefix = NTR('tmp_pack_')
+                                              , delete = False )
+        with pack_tmp:
+            header = _PACK_MAGIC + struct.pack( NTR('>II')
+                                              , 2, len(self._entries))
+            pack_sha1.update(header)
+            pack_tmp.write(header)
+            with open(body_path, 'rb') as body:
+                while True:
+                    chunk = body.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    pack_sha1.update(chunk)
+                    pack_tmp.write(chunk)
+            pack_digest = pack_sha1.digest()
+            pack_tmp.write(pack_digest)
+        os.unlink(body_path)
+
+        name = NTR('pack-{}').format(binascii.hexlify(pack_digest).decode())
+        pack_path = os.path.join(self.directory, name + NTR('.pack'))
+        idx_path  = os.path.join(self.directory, name + NTR('.idx'))
+        os.rename(pack_tmp.name, pack_path)
+        p4gf_util.chmod_644_minimum(pack_path)
+
+                        # Index last: Git discovers packs by their .idx.
+        idx_tmp = idx_path + NTR('.tmp')
+        with open(idx_tmp, 'wb') as f:
+            f.write(_index_v2(self._entries, pack_digest))
+        os.rename(idx_tmp, idx_path)
+        p4gf_util.chmod_644_minimum(idx_path)
+
+        LOG.debug('wrote {} objects to {}'.format(len(self._entries), pack_path))
+        self.pack_count += 1
+        self._entries   = []
+        self._sha1s     = set()
+        self._body_size = 0
+
+# -- end class PackWriter -----------------------------------------------------
+
+
+def _entry_header(type_num, size):
+    '''
+    Encode a pack entry's type+size varint.
+    '''
+    c = (type_num << 4) | (size & 15)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    out.append(c)
+    return bytes(out)
+
+
+def _index_v2(entries, pack_digest):
+    '''
+    Return the bytes of a version 2 .idx for the given
+    (bin_sha1, crc32, offset) entries.
+    '''
+    entries = sorted(entries)
+    names = [e[0] for e in entries]
+    fanout = []
+    for i in range(256):
+        fanout.append(bisect.bisect_right(names, bytes([i]) + b'\xff' * 19))
+
+    off32 = []
+    off64 = []
+    for e in entries:
+        if e[2] < 0x80000000:
+            off32.append(e[2])
+        else:
+            off32.append(0x80000000 | len(off64))
+            off64.append(e[2])
+
+    parts = [ _IDX_V2_MAGIC
+            , struct.pack(NTR('>I'), 2)
+            , struct.pack(NTR('>256I'), *fanout)
+            , b''.join(names)
+            , b''.join(struct.pack(NTR('>I'), e[1]) for e in entries)
+            , b''.join(struct.pack(NTR('>I'), o) for o in off32)
+            , b''.join(struct.pack(NTR('>Q'), o) for o in off64)
+            , pack_digest ]
+    body = b''.join(parts)
+                        # pylint:disable=E1101
+                        # Module 'hashlib' has no 'sha1' member
+    return body + hashlib.sha1(body).digest()
+                        # pylint:enable=E1101
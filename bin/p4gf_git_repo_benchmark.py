@@ -0,0 +1,89 @@
+#! /usr/bin/env python3.3
+'''
+Measure the per-call cost of p4gf_util's pygit2 helpers: opening a new
+pygit2.Repository on every call, as they once did, versus the shared
+Repository and object-existence cache.
+
+Run from within a Git work tree or repo, or pass --git-dir.
+
+For example
+
+    p4gf_git_repo_benchmark.py --git-dir /path/to/repo/.git --count 10000
+'''
+import os
+import subprocess
+import time
+
+import pygit2
+
+from   p4gf_l10n      import _, NTR
+import p4gf_util
+
+
+def _uncached_sha1_exists(sha1):
+    '''
+    sha1_exists() as it was: discover and open the repo every call.
+    '''
+    path = pygit2.discover_repository('.')
+    repo = pygit2.Repository(path)
+    return sha1 in repo
+
+
+def _shared_repo_sha1_exists(sha1):
+    '''
+    Shared Repository, no existence cache.
+    '''
+    return sha1 in p4gf_util.git_repo()
+
+
+def _sample_sha1s(count):
+    '''
+    Return up to count sha1s of objects in the current repo.
+    '''
+    out = subprocess.check_output(['git', 'rev-list', '--objects', '--all'])
+    sha1s = [line.split()[0].decode() for line in out.splitlines()[:count]]
+    return sha1s
+
+
+def _measure(func, sha1_list):
+    '''
+    Call func once per sha1, twice over. Return microseconds per call.
+    '''
+    start = time.time()
+    for _i in range(2):
+        for sha1 in sha1_list:
+            func(sha1)
+    return (time.time() - start) * 1000000.0 / (2 * len(sha1_list))
+
+
+def main():
+    '''
+    Time each variant against present and missing sha1s, and report.
+    '''
+    parser = p4gf_util.create_arg_parser(
+        _('Measure per-call cost of p4gf_util pygit2 helpers.'))
+    parser.add_argument('--git-dir',
+                        help=_('Git repo to test, default current directory'))
+    parser.add_argument('--count', type=int, default=1000,
+                        help=_('number of present and of missing sha1s to test'))
+    args = parser.parse_args()
+
+    if args.git_dir:
+        os.chdir(args.git_dir)
+    present = _sample_sha1s(args.count)
+    if not present:
+        print(_('No objects in repo.'))
+        return
+    missing = [NTR('{:040x}').format(i + 1) for i in range(len(present))]
+
+    fmt = NTR('{name:<26} present:{present:9.2f}us  missing:{missing:9.2f}us')
+    for (name, func) in [ (NTR('open repo per call'),    _uncached_sha1_exists)
+                        , (NTR('shared repo'),           _shared_repo_sha1_exists)
+                        , (NTR('sha1_exists() cached'),  p4gf_util.sha1_exists) ]:
+        print(fmt.format( name    = name
+                        , present = _measure(func, present)
+                        , missing = _measure(func, missing) ))
+
+
+if __name__ == "__main__":
+    main()
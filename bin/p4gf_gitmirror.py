@@ -5,14 +5,18 @@ import atexit
 import configparser
 import copy
 import functools
+import logging
 import os
+import queue
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 
 import p4gf_config
 import p4gf_const
+import p4gf_create_p4
 from   p4gf_fastimport_mark import Mark
 import p4gf_git
 from   p4gf_l10n            import _, NTR
@@ -274,6 +278,194 @@ def _copy_commit_trees(view_name, commits):
             pipe.write("---\n")
 
 
+def _pipeline_depth(ctx):
+    '''
+    How many bites of commit objects may be submitting on a separate
+    connection while we extract the next bite? 0 to submit each bite
+    before extracting the next.
+    '''
+    config = p4gf_config.get_repo(ctx.p4gf, ctx.config.view_name)
+    try:
+        return max(0, config.getint( p4gf_config.SECTION_REPO
+                                   , p4gf_config.KEY_MIRROR_PIPELINE_DEPTH
+                                   , fallback = 0 ))
+    except ValueError:
+        LOG.warning('{} config setting has invalid value, defaulting to 0'
+                    .format(p4gf_config.KEY_MIRROR_PIPELINE_DEPTH))
+        return 0
+
+
+class _NoTimer:
+    '''
+    Stand-in for p4gf_profiler.Timer in threads other than the main thread.
+    p4gf_profiler keeps one global stack of active timers, so two threads
+    cannot both time their work.
+    '''
+    def __init__(self, _name):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        return False
+
+
+class _SubmitContext:
+    '''
+    A Context stand-in for _SubmitPipeline's thread. Same as the real
+    Context, except that p4gf, p4gfrun(), and numbered_change_gf use the
+    pipeline's own connection, leaving the real ctx.p4gf to the main
+    thread.
+    '''
+    def __init__(self, ctx, p4gf):
+        self._ctx               = ctx
+        self.p4gf               = p4gf
+        self.numbered_change_gf = None
+
+    def __getattr__(self, name):
+        return getattr(self._ctx, name)
+
+    def p4gfrun(self, cmd
+               , log_warnings = logging.WARNING
+               , log_errors   = logging.ERROR):
+        '''
+        Run a command on our connection, with logging.
+        '''
+        return p4gf_util.p4run_logged( self.p4gf, cmd
+                                     , log_warnings    = log_warnings
+                                     , log_errors      = log_errors
+                                     , numbered_change = self.numbered_change_gf )
+
+
+                        # Sentinel that tells _SubmitPipeline's thread to exit.
+_STOP = None
+
+
+class _SubmitPipeline:
+    '''
+    'p4 add' and 'p4 submit' bites of extracted commit objects on a separate
+    connection, in a background thread, so that the main thread can extract
+    bite N+1 while bite N is added and submitted.
+
+    At most depth bites wait or submit at a time: put() blocks until an
+    earlier bite completes.
+
+    Each bite gets its own NumberedChangelist with the same retry and
+    revert-on-failure behavior as the non-pipelined path. Once a bite is
+    submitted, the main thread updates ObjectType indexes and queues the
+    bite's commits for tree mirroring, in the order bites were put().
+    '''
+
+    def __init__(self, mirror, ctx, depth):
+        self.mirror       = mirror
+        self.ctx          = ctx
+        self.depth        = depth
+        self._work_queue  = queue.Queue(maxsize=depth)
+        self._done_queue  = queue.Queue()
+        self._in_flight   = 0
+        self._abort       = False
+
+        self._p4gf = p4gf_create_p4.create_p4( port   = ctx.config.p4port
+                                             , user   = ctx.config.p4user
+                                             , client = ctx.config.p4client_gf )
+        if not self._p4gf:
+            raise RuntimeError(_('GitMirror: unable to connect submit pipeline'))
+        if ctx.p4gf.charset:
+            self._p4gf.charset = ctx.p4gf.charset
+        self._sctx = _SubmitContext(ctx, self._p4gf)
+
+        self._thread = threading.Thread( target = self._run
+                                       , name   = NTR('p4gf-mirror-submit')
+                                       , daemon = True )
+        self._thread.start()
+        LOG.debug('started mirror submit pipeline depth={}'.format(depth))
+
+    def put(self, add_files, commit_shas):
+        '''
+        Queue one bite of extracted objects for add and submit.
+        Blocks while depth bites are already in flight.
+        '''
+        while self.depth <= self._in_flight:
+            self._collect_one()
+        self._work_queue.put((add_files, commit_shas))
+        self._in_flight += 1
+
+    def finish(self):
+        '''
+        Wait for every queued bite to complete. Raise the first failure.
+        '''
+        while self._in_flight:
+            self._collect_one()
+
+    def close(self):
+        '''
+        Stop our thread, skipping any bites not yet started, and disconnect.
+        '''
+        if self._in_flight:
+            self._abort = True
+        self._work_queue.put(_STOP)
+        self._thread.join()
+        if self._p4gf.connected():
+            p4gf_create_p4.p4_disconnect(self._p4gf)
+        p4gf_create_p4.unregister(self._p4gf)
+
+    def _collect_one(self):
+        '''
+        Wait for the oldest in-flight bite to complete, then finish its
+        bookkeeping in this, the main, thread.
+        '''
+        (commit_shas, r, err) = self._done_queue.get()
+        self._in_flight -= 1
+        if err:
+            self._abort = True
+            raise err
+        if r:
+            ObjectType.update_indexes(self.ctx, r)
+        ObjectType.reset_cache()
+        _copy_commit_trees(self.mirror.view_name, commit_shas)
+
+    def _run(self):
+        '''
+        Add and submit each bite we pull from the work queue. Report the
+        result, or the exception that prevented it, to the done queue.
+        '''
+        while True:
+            item = self._work_queue.get()
+            if item is _STOP:
+                return
+            (add_files, commit_shas) = item
+            if self._abort:
+                continue
+                        # pylint:disable=W0703
+                        # Catching too general exception
+                        # Must report every failure back to the main thread,
+                        # otherwise it waits forever.
+            try:
+                r = self._submit_with_retry(add_files)
+                self._done_queue.put((commit_shas, r, None))
+            except Exception as e:
+                LOG.error('mirror submit pipeline failed: {}'.format(e))
+                self._done_queue.put((commit_shas, None, e))
+                        # pylint:enable=W0703
+
+    def _submit_with_retry(self, add_files):
+        '''
+        Same as GitMirror._add_commits_to_p4(): retry once upon P4Exception.
+        '''
+        for i in range(2):
+            try:
+                        # pylint:disable=W0212
+                        # Access to a protected member
+                return self.mirror._submit_objects(self._sctx, add_files, _NoTimer)
+                        # pylint:enable=W0212
+            except P4Exception:
+                if i:
+                    raise
+
+# -- end class _SubmitPipeline ------------------------------------------------
+
+
 def _queue_dir(view_name):
     '''return dir containing queue files'''
     return os.path.join(p4gf_const.P4GF_HOME, "views", view_name, "tree-queue")
@@ -342,11 +534,15 @@ class GitMirror:
                     Can be None if branch_id encoded in mark lines.
         ctx:        P4GF context
         """
+        pipeline = None
         try:
             with Timer(OVERALL):
-                # Unpack the received packs so we can work with loose objects.
-                p4gf_git.unpack_objects()
+                        # No need to unpack received packs into loose
+                        # objects: p4gf_git.link_object() reads packs.
                 with ProgressReporter.Indeterminate():
+                    depth = _pipeline_depth(ctx)
+                    if depth:
+                        pipeline = _SubmitPipeline(self, ctx, depth)
                     with Timer(BUILD):
                         commit_shas = []
                         for mark_line in marks:
@@ -368,16 +564,27 @@ class GitMirror:
                             commit_shas.append(sha1)
                             if len(self.commits) >= _BITE_SIZE:
                                 # now that we have a few commits, submit them to P4
-                                self._add_commits_to_p4(ctx)
-                                _copy_commit_trees(self.view_name, commit_shas)
-                                commit_shas.clear()
+                                if pipeline:
+                                    # ...while we extract the next few
+                                    pipeline.put(self._extract_commits(ctx), commit_shas)
+                                    commit_shas = []
+                                else:
+                                    self._add_commits_to_p4(ctx)
+                                    _copy_commit_trees(self.view_name, commit_shas)
+                                    commit_shas.clear()
                                 self.commits.clear()
 
                     # submit the remaining objects to P4
-                    self._add_commits_to_p4(ctx)
-                    with Timer(BUILD):
-                        _copy_commit_trees(self.view_name, commit_shas)
+                    if pipeline:
+                        pipeline.put(self._extract_commits(ctx), commit_shas)
+                        pipeline.finish()
+                    else:
+                        self._add_commits_to_p4(ctx)
+                        with Timer(BUILD):
+                            _copy_commit_trees(self.view_name, commit_shas)
         finally:
+            if pipeline:
+                pipeline.close()
             # Let my references go!
             self.commits.clear()
 
@@ -398,16 +605,31 @@ class GitMirror:
 
     def _really_add_commits_to_p4(self, ctx):
         """actually run p4 add, submit to create mirror files in .git-fusion"""
+        with Timer(ADD_SUBMIT):
+            add_files = self._extract_commits(ctx)
+        r = self._submit_objects(ctx, add_files)
+        if r:
+            ObjectType.update_indexes(ctx, r)
+
+    def _extract_commits(self, ctx):
+        """build list of objects to add, extracting them from git"""
+        LOG.debug("adding {0} commits to .git-fusion...".
+                  format(len(self.commits.commits)))
+        return [self.__add_object_to_p4(ctx, go)
+                for go in self.commits.commits.values()]
+
+    def _submit_objects(self, ctx, add_files, timer=Timer):
+        """p4 add, submit extracted objects to create mirror files in .git-fusion
+
+        Return the submit result, or None if nothing submitted.
+
+        timer is p4gf_profiler.Timer, or _NoTimer when called from any thread
+        other than the main thread.
+        """
         desc = _("Git Fusion '{view}' copied to Git.").format(view=ctx.config.view_name)
         with p4gf_util.NumberedChangelist(gfctx=ctx, description=desc) as nc:
-            with Timer(ADD_SUBMIT):
-                LOG.debug("adding {0} commits to .git-fusion...".
-                          format(len(self.commits.commits)))
-
-                # build list of objects to add, extracting them from git
-                add_files = [self.__add_object_to_p4(ctx, go)
-                             for go in self.commits.commits.values()]
-                add_files = GitMirror.optimize_objects_to_add_to_p4(ctx, add_files)
+            with timer(ADD_SUBMIT):
+                add_files = GitMirror.optimize_objects_to_add_to_p4(ctx, add_files, timer)
 
                 if not (   len(add_files)
                         or self.depot_branch_info_list
@@ -415,9 +637,9 @@ class GitMirror:
                     # Avoid a blank line in output by printing something
                     ProgressReporter.write(_('No Git objects to submit to Perforce'))
                     LOG.debug("_really_add_objects_to_p4() nothing to add...")
-                    return
+                    return None
 
-                with Timer(P4_ADD):
+                with timer(P4_ADD):
                     files_added = self.add_objects_to_p4_2(ctx, add_files)
 
                     depot_branch_infos_added = \
@@ -427,29 +649,29 @@ class GitMirror:
 
                     cldfs_added = self._add_cldfs_to_p4(ctx)
 
-                with Timer(P4_SUBMIT):
+                with timer(P4_SUBMIT):
                     if (   files_added
                         or depot_branch_infos_added
                         or config2_added
                         or cldfs_added ):
                         ProgressReporter.increment(
                                _('Submitting new Git commit objects to Perforce'))
-                        r = nc.submit()
-                        ObjectType.update_indexes(ctx, r)
+                        return nc.submit()
                     else:
                         ProgressReporter.write(
                                _('No new Git objects to submit to Perforce'))
                         LOG.debug("ignoring empty change list...")
+        return None
 
     @staticmethod
-    def optimize_objects_to_add_to_p4(ctx, add_files):
+    def optimize_objects_to_add_to_p4(ctx, add_files, timer=Timer):
         """if many files to add, filter out those which are already added
         Only do this if the number of files is large enough to justify
         the cost of the fstat"""
         enough_files_to_use_fstat = 100
         if len(add_files) < enough_files_to_use_fstat:
             return add_files
-        with Timer(P4_FSTAT):
+        with timer(P4_FSTAT):
             LOG.debug("using fstat to optimize add")
             original_count = len(add_files)
             ctx.p4gf.handler = FilterAddFstatHandler()
@@ -710,9 +932,9 @@ class GitMirror:
                 except OSError as e:
                     raise e
 
-            # Hardlink the Git object into the Perforce workspace
-            op = p4gf_git.object_path(go.sha1)
-            os.link(op, dst)
+            # Hardlink (or if packed, write) the Git object into the
+            # Perforce workspace
+            p4gf_git.link_object(go.sha1, dst)
             LOG.debug2("adding new object: " + dst)
 
             return dst
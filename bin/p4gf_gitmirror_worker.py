@@ -5,6 +5,7 @@ import atexit
 import os
 import re
 import sys
+import time
 
 import p4gf_env_config  # pylint: disable=W0611
 import p4gf_context
@@ -21,6 +22,11 @@ from P4 import P4Exception
 
 LOG = p4gf_log.for_module()
 
+                        # Walk trees in-process with pygit2 rather than one
+                        # 'git ls-tree'/'git diff-tree' subprocess per commit.
+                        # Set False to compare against the subprocess path.
+USE_PYGIT2 = True
+
 def main():
     '''
     Parse command line arguments and do the work of mirroring Git objects.
@@ -51,10 +57,13 @@ def __do_trees(view_name, path):
         os.chdir(ctx.view_dirs.GIT_WORK_TREE)
         LOG.debug("processing trees for view {}".format(view_name))
 
+        repo = ctx.get_view_repo() if USE_PYGIT2 else None
         with open(path, "r") as f:
             with Timer(p4gf_gitmirror.ADD_SUBMIT):
                 trees = set()
                 last_tree = None
+                commit_count = 0
+                start = time.time()
                 while True:
                     line = f.readline().strip()
                     LOG.debug("processing line '{}'".format(line))
@@ -63,15 +72,76 @@ def __do_trees(view_name, path):
                     elif line == '---':
                         last_tree = None
                     else:
-                        if not last_tree:
+                        commit_count += 1
+                        if repo:
+                            if not last_tree:
+                                last_tree = __walk_snapshot_trees(repo, line, trees)
+                            else:
+                                last_tree = __walk_delta_trees(repo, last_tree, line, trees)
+                        elif not last_tree:
                             last_tree = __get_snapshot_trees(line, trees)
                         else:
                             last_tree = __get_delta_trees(last_tree, line, trees)
+                elapsed = time.time() - start
+                LOG.info('discovered {} trees in {} commits in {:.2f}s'
+                         ' ({:.0f} trees/sec) via {}'
+                         .format( len(trees), commit_count, elapsed
+                                , len(trees) / elapsed if elapsed else 0
+                                , NTR('pygit2') if repo else NTR('git subprocess')))
                 if trees:
                     LOG.debug("submitting trees for {}".format(view_name))
                     __add_trees_to_p4(ctx, trees)
 
 
+def __walk_snapshot_trees(repo, commit, trees):
+    """get all tree objects for a given commit, in-process
+        commit: SHA1 of commit
+
+    each tree is added to the set to be mirrored
+    return the commit's top-level pygit2.Tree
+    """
+    commit_tree = p4gf_util.treeish_to_tree(repo, commit)
+    __walk_new_trees(repo, None, commit_tree, trees)
+    return commit_tree
+
+def __walk_delta_trees(repo, commit_tree1, commit2, trees):
+    """get all tree objects new in one commit vs the previous, in-process
+        commit_tree1: pygit2.Tree of first commit
+        commit2: SHA1 of second commit
+
+    each tree is added to the set to be mirrored
+    return the second commit's top-level pygit2.Tree
+    """
+    commit_tree2 = p4gf_util.treeish_to_tree(repo, commit2)
+    __walk_new_trees(repo, commit_tree1, commit_tree2, trees)
+    return commit_tree2
+
+def __walk_new_trees(repo, old_tree, new_tree, trees):
+    """add new_tree and each of its subtrees that differ from old_tree's
+
+    Same result as 'git diff-tree -r -t old_tree new_tree' (or 'git ls-tree
+    -r -t new_tree' if old_tree is None), but without the subprocess, and
+    without descending into any subtree already in trees: every tree in
+    trees came from a commit whose trees were all added, so that subtree's
+    own subtrees are already there.
+    """
+    work = [(old_tree, new_tree)]
+    while work:
+        (old, new) = work.pop()
+        if new.hex in trees:
+            continue
+        trees.add(new.hex)
+        old_subtrees = {}
+        if old is not None:
+            old_subtrees = {e.name: e.hex for e in old if e.filemode == 0o040000}
+        for e in new:
+            if e.filemode != 0o040000 or e.hex in trees:
+                continue
+            old_hex = old_subtrees.get(e.name)
+            if old_hex == e.hex:
+                continue
+            work.append((repo[old_hex] if old_hex else None, repo[e.oid]))
+
 # line is: mode SP type SP sha TAB path
 # we only want the sha from lines with type "tree"
 TREE_REGEX = re.compile("^[0-7]{6} tree ([0-9a-fA-F]{40})\t.*")
@@ -198,10 +268,9 @@ def __add_tree_to_p4(ctx, sha1):
         except OSError as e:
             raise e
 
-    # Hardlink the Git object into the Perforce workspace
+    # Hardlink (or if packed, write) the Git object into the Perforce workspace
     LOG.debug2("adding new object: " + dst)
-    op = p4gf_git.object_path(sha1)
-    os.link(op, dst)
+    p4gf_git.link_object(sha1, dst)
 
     return dst
 
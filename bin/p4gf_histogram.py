@@ -10,6 +10,11 @@ import math
 # non-gettext-ed string
 # This is a debug dump, no L10N required.
 
+# Upper end of each latency histogram bucket, in milliseconds.
+# Slower values land in the last bucket.
+LATENCY_BUCKET_MS = [ 1, 2, 5, 10, 25, 50, 100, 250, 500
+                    , 1000, 2500, 5000, 10000, 60000, 3600000 ]
+
 def _round(val):
     '''
     Return some round-ish integer number like 5, 10, 25, etc.
@@ -109,3 +114,33 @@ def to_lines(histo):
         lines.append(s)
         bb = be + 1
     return lines
+
+
+def latency_histogram():
+    '''
+    Return an empty latency histogram: bucket end in milliseconds ==> count.
+    '''
+    return {be: 0 for be in LATENCY_BUCKET_MS}
+
+
+def add_latency(hist, secs):
+    '''
+    Count one more value in whichever latency bucket holds secs.
+    '''
+    ms = secs * 1000.0
+    for be in LATENCY_BUCKET_MS:
+        if ms <= be:
+            hist[be] += 1
+            return
+    hist[LATENCY_BUCKET_MS[-1]] += 1
+
+
+def latency_lines(hist):
+    '''
+    Return a latency histogram's lines, omitting empty buckets past the
+    last non-empty one.
+    '''
+    used = [be for be in LATENCY_BUCKET_MS if hist[be]]
+    if not used:
+        return []
+    return to_lines({be: hist[be] for be in LATENCY_BUCKET_MS if be <= used[-1]})
@@ -0,0 +1,168 @@
+#! /usr/bin/env python3.3
+'''
+Load-test a Git Fusion HTTP server: how many requests per second can it
+serve for one repo?
+
+Two phases, each run by --concurrency client threads at once:
+
+    info/refs   GET {url}/{repo}/info/refs?service=git-upload-pack,
+                the ref advertisement that starts every fetch and clone.
+    clone       'git clone --bare {url}/{repo}' into a scratch directory.
+
+For example, against a server started with
+
+    p4gf_http_server.py --user bob --port 8000 --workers 8
+
+run
+
+    p4gf_http_load_test.py --url http://localhost:8000 --repo myrepo \\
+        --concurrency 8 --requests 200 --clones 16
+'''
+import base64
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from   p4gf_l10n      import _, NTR
+import p4gf_util
+
+
+def _percentile(sorted_secs, fraction):
+    '''
+    Return the value below which fraction of sorted_secs fall.
+    '''
+    if not sorted_secs:
+        return 0.0
+    index = min(len(sorted_secs) - 1, int(fraction * len(sorted_secs)))
+    return sorted_secs[index]
+
+
+def _run_phase(count, concurrency, func):
+    '''
+    Call func(i) for i in range(count), concurrency calls at a time.
+    Return (wall seconds, sorted list of per-call seconds, failure count).
+    '''
+    lock     = threading.Lock()
+    pending  = list(range(count))
+    secs     = []
+    failures = [0]
+
+    def _worker():
+        '''Take the next call until none remain.'''
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i = pending.pop()
+            start = time.time()
+            try:
+                ok = func(i)
+            # pylint:disable=W0703
+            # Catching too general exception
+            # Count any failure against the server, keep loading it.
+            except Exception as e:
+                sys.stderr.write('{}\n'.format(e))
+                ok = False
+            # pylint:enable=W0703
+            elapsed = time.time() - start
+            with lock:
+                secs.append(elapsed)
+                if not ok:
+                    failures[0] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=_worker) for _i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (time.time() - start, sorted(secs), failures[0])
+
+
+def _report(name, count, wall_secs, secs, failures):
+    '''
+    Print one phase's requests/sec and latency.
+    '''
+    fmt = NTR('{name:<10} {count:6,d} in {wall:7.2f}s  {rate:8.2f}/s'
+              '  p50:{p50:7.3f}s  p95:{p95:7.3f}s  max:{max:7.3f}s  failed:{failed}')
+    print(fmt.format( name   = name
+                    , count  = count
+                    , wall   = wall_secs
+                    , rate   = count / wall_secs if wall_secs else 0
+                    , p50    = _percentile(secs, 0.50)
+                    , p95    = _percentile(secs, 0.95)
+                    , max    = secs[-1] if secs else 0
+                    , failed = failures ))
+
+
+def main():
+    '''
+    Run each phase and report.
+    '''
+    parser = p4gf_util.create_arg_parser(
+        _('Measure Git Fusion HTTP requests/sec for info/refs and full clones.'))
+    parser.add_argument('--url', required=True,
+                        help=_('server URL, such as http://localhost:8000'))
+    parser.add_argument('--repo', required=True,
+                        help=_('repo to fetch'))
+    parser.add_argument('--user', help=_('HTTP basic authentication user'))
+    parser.add_argument('--password', help=_('HTTP basic authentication password'))
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help=_('simultaneous clients'))
+    parser.add_argument('--requests', type=int, default=100,
+                        help=_('info/refs requests, 0 to skip'))
+    parser.add_argument('--clones', type=int, default=8,
+                        help=_('full clones, 0 to skip'))
+    args = parser.parse_args()
+
+    base_url = NTR('{}/{}').format(args.url.rstrip('/'), args.repo)
+    headers = {}
+    if args.user:
+        token = NTR('{}:{}').format(args.user, args.password or '')
+        headers[NTR('Authorization')] = NTR('Basic {}').format(
+            base64.b64encode(token.encode('utf-8')).decode('ascii'))
+
+    def _info_refs(_i):
+        '''One ref advertisement.'''
+        req = urllib.request.Request(
+              base_url + NTR('/info/refs?service=git-upload-pack')
+            , headers = headers )
+        with urllib.request.urlopen(req) as resp:
+            body = resp.read()
+        return resp.status == 200 and b'git-upload-pack' in body
+
+    scratch = tempfile.mkdtemp(prefix=NTR('p4gf_http_load_test_'))
+    clone_url = base_url
+    if args.user:
+        (scheme, rest) = base_url.split('://', 1)
+        clone_url = NTR('{}://{}:{}@{}').format(
+            scheme, args.user, args.password or '', rest)
+
+    def _clone(i):
+        '''One full bare clone, deleted once done.'''
+        dest = os.path.join(scratch, str(i))
+        try:
+            return 0 == subprocess.call(
+                  ['git', 'clone', '--bare', '--quiet', clone_url, dest]
+                , stdout = subprocess.DEVNULL )
+        finally:
+            shutil.rmtree(dest, ignore_errors=True)
+
+    try:
+        if args.requests:
+            (wall, secs, failed) = _run_phase(args.requests, args.concurrency, _info_refs)
+            _report(NTR('info/refs'), args.requests, wall, secs, failed)
+        if args.clones:
+            (wall, secs, failed) = _run_phase(args.clones, args.concurrency, _clone)
+            _report(NTR('clone'), args.clones, wall, secs, failed)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,14 @@ WSGI/CGI script in Python for interfacing with Git HTTP backend.
 """
 # pylint:disable=W0201
 
+import atexit
 from contextlib import closing, contextmanager
 import functools
 import logging
 import os
 import shutil
 import signal
+import socketserver
 import subprocess
 import sys
 import tempfile
@@ -28,6 +30,13 @@ except ImportError:
     import p4gf_version
 
 import p4gf_env_config    # pylint: disable=W0611
+import p4gf_daemon_client
+if __name__ == "__main__" and len(sys.argv) == 1:
+    # Running as a CGI script: let a running p4gf_daemon.py serve this
+    # request, if there is one, before we pay to import everything else.
+    p4gf_daemon_client.serve(p4gf_daemon_client.ENTRY_HTTP_SERVER)
+# pylint:disable=C0413
+# Import not at top of module: deliberately after the daemon hand-off.
 import p4gf_atomic_lock
 import p4gf_call_git
 import p4gf_const
@@ -48,9 +57,18 @@ import p4gf_proc
 import p4gf_server_common
 import p4gf_translate
 import p4gf_util
+# pylint:enable=C0413
 
 LOG = p4gf_log.for_module()
 
+                        # Bytes per read when copying a request body
+                        # from the client to git-http-backend.
+_BODY_BLOCK_SIZE = 64 * 1024
+
+                        # Longest chunk-size line we accept in a
+                        # "Transfer-Encoding: chunked" request body.
+_MAX_CHUNK_LINE = 1024
+
 
 class OutputSink(object):
     """
@@ -139,18 +157,111 @@ def _get_command(environ):
     return None
 
 
+class _RequestBody:
+    """
+    The body of one HTTP request, read from the client connection only as
+    git-http-backend consumes it, instead of spooled to a temporary file
+    before we do anything.
+
+    Decodes "Transfer-Encoding: chunked". Otherwise reads exactly
+    Content-Length bytes, so that we never block waiting for bytes the
+    client will not send (which also permits HTTP/1.1 keep-alive).
+    """
+
+    def __init__(self, rfile, environ):
+        self.rfile = rfile
+        self.chunked = NTR('chunked') in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+        try:
+            self.content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self.content_length = 0
+        if environ['REQUEST_METHOD'] not in ('POST', 'PUT'):
+            self.chunked = False
+            self.content_length = 0
+        self.consumed = False
+        self.byte_count = 0
+
+    def blocks(self):
+        """
+        Yield the body as a sequence of bytes blocks. Only once.
+        """
+        if self.consumed:
+            return
+        self.consumed = True
+        if self.chunked:
+            gen = self._chunked_blocks()
+        else:
+            gen = self._fixed_blocks(self.content_length)
+        for block in gen:
+            self.byte_count += len(block)
+            yield block
+
+    def _fixed_blocks(self, length):
+        """
+        Yield exactly length bytes, fewer if the client hangs up first.
+        """
+        while length > 0:
+            block = self.rfile.read(min(_BODY_BLOCK_SIZE, length))
+            if not block:
+                LOG.warning('client sent {} fewer body bytes than promised'
+                            .format(length))
+                return
+            length -= len(block)
+            yield block
+
+    def _chunked_blocks(self):
+        """
+        Yield the decoded data of each chunk, then discard any trailer.
+        """
+        while True:
+            line = self.rfile.readline(_MAX_CHUNK_LINE)
+            if not line:
+                LOG.warning('client hung up in chunked request body')
+                return
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise RuntimeError(_('Malformed chunk size in request body: {}')
+                                   .format(line))
+            if not size:
+                break
+            for block in self._fixed_blocks(size):
+                yield block
+            self.rfile.readline(_MAX_CHUNK_LINE)   # CRLF after chunk data
+        while self.rfile.readline(_MAX_CHUNK_LINE) not in (b'\r\n', b'\n', b''):
+            pass
+
+    def copy_to(self, fobj):
+        """
+        Write the body to fobj. Return byte count written.
+        """
+        for block in self.blocks():
+            fobj.write(block)
+        return self.byte_count
+
+    def discard(self):
+        """
+        Read and discard any unconsumed body so the client is not left
+        blocked sending it.
+        """
+        for _block in self.blocks():
+            pass
+
+
 @contextmanager
 def deleting(path):
     """
-    Delete the named file upon exit.
+    Delete the named file upon exit. NOP if given a _RequestBody rather
+    than a file path.
     """
     try:
         yield
     finally:
-        try:
-            os.unlink(path)
-        except OSError:
-            LOG.warn("@deleting failed to delete file {}".format(path))
+        if not isinstance(path, _RequestBody):
+            try:
+                os.unlink(path)
+            except OSError:
+                LOG.warn("@deleting failed to delete file {}".format(path))
 
 
 @contextmanager
@@ -181,7 +292,9 @@ _OPTIONAL_ENVARS = (
     p4gf_const.P4GF_PROTECTS_HOST,
     p4gf_const.P4GF_TEST_LOG_CONFIG_PATH,
     'P4GF_P4D_VERSION_FORCE_ACCEPTABLE',
-    p4gf_const.P4GF_ENV_NAME
+    p4gf_const.P4GF_ENV_NAME,
+    # git-http-backend inflates gzip-encoded request bodies itself.
+    'HTTP_CONTENT_ENCODING'
     )
 
 def _call_git(input_name, environ, ctx):
@@ -192,7 +305,8 @@ def _call_git(input_name, environ, ctx):
     directed back to the client.
 
     Arguments:
-        input_name -- file path of input for git-http-backend.
+        input_name -- file path of input for git-http-backend,
+                      or a _RequestBody to stream to it.
         environ -- environment variables.
         ctx -- context object.
     """
@@ -309,10 +423,12 @@ def _wsgi_app(environ, start_response):
             return [b"Perforce connection failed\n"]
         LOG.debug("connected to P4: %s", p4)
 
-        p4gf_server_common.check_readiness(p4)
-        p4gf_server_common.check_lock_perm(p4)
-        if not p4gf_server_common.check_protects(p4):
-            p4gf_server_common.raise_p4gf_perm()
+        # A p4gf_daemon.py parent may have run these checks for us.
+        if not p4gf_server_common.checks_passed():
+            p4gf_server_common.check_readiness(p4)
+            p4gf_server_common.check_lock_perm(p4)
+            if not p4gf_server_common.check_protects(p4):
+                p4gf_server_common.raise_p4gf_perm()
 
         user = environ['REMOTE_USER']
         if p4gf_server_common.run_special_command(view_name, p4, user):
@@ -351,7 +467,8 @@ def _wsgi_app(environ, start_response):
             return [str(ce).encode('UTF-8')]
 
         # Create Git Fusion server depot, user, config. NOPs if already created.
-        p4gf_init.init(p4)
+        if not p4gf_server_common.checks_passed():
+            p4gf_init.init(p4)
 
         before_lock_time = time.time()
         with p4gf_lock.view_lock(p4, view_name) as view_lock:
@@ -586,61 +703,44 @@ def _app_wrapper(user, environ, start_response):
         will be directed to our socket rather than the console. Need
         to use subprocess directly so the file descriptor will be
         inherited by the child.
+
+        Stream the request body from the client connection into Git's
+        standard input as Git reads it.
         """
-        stdout = environ['wsgi.output']
-        fobj = None
-        if 'stdin' in kwargs:
-            fobj = open(kwargs['stdin'], 'rb')
-            kwargs['stdin'] = fobj
+        body = kwargs.pop('stdin', None)
         kwargs['close_fds'] = False
-        kwargs['stdout'] = stdout
+        kwargs['stdout'] = environ['wsgi.output']
+        kwargs['stdin'] = subprocess.PIPE
+        kwargs['bufsize'] = 0
+        # Git client is not happy without the status line. Since we are
+        # the origin server, output the first few lines that are
+        # expected in a standard HTTP response.
+        handler = environ['wsgi.handler']
+        handler.send_response(200, 'OK')
+        handler.flush_headers()
+        p = subprocess.Popen(*args, **kwargs)
         try:
-            # Git client is not happy without the status line. Since we are
-            # the origin server, output the first few lines that are
-            # expected in a standard HTTP response.
-            handler = environ['wsgi.handler']
-            handler.send_response(200, 'OK')
-            handler.flush_headers()
-            return subprocess.call(*args, **kwargs)
+            try:
+                if body:
+                    body.copy_to(p.stdin)
+                    LOG.debug('_app_wrapper() streamed {} bytes to {}'
+                              .format(body.byte_count, args[0]))
+            except BrokenPipeError:
+                LOG.debug('_app_wrapper() {} closed its input early'.format(args[0]))
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
         finally:
-            if fobj:
-                fobj.close()
+            ec = p.wait()
+        return ec
     environ['proc.caller'] = proc_caller
 
-    def _read_input():
-        """
-        Read from the client connection and return the name of a temporary
-        file containing the contents of what was read. If the request method
-        was not POST or PUT, or the Content-Length was zero (or undefined),
-        then nothing is read from the connection, resulting in an empty file.
-        """
-        # For more information on the idiosyncrasies within WSGI 1.0, see
-        # http://blog.dscpl.com.au/2009/10/details-on-wsgi-10-amendmentsclarificat.html
-        stdin = environ['wsgi.input']
-        try:
-            content_length = int(environ.get('CONTENT_LENGTH', 0))
-        except ValueError:
-            content_length = 0
-        method = environ['REQUEST_METHOD']
-        stdin_fd, stdin_name = tempfile.mkstemp(prefix='http-client-input-')
-        # TODO: need to handle case of "Transfer-Encoding: chunked"
-        if content_length and (method == "POST" or method == "PUT"):
-            LOG.debug('_app_wrapper() writing stdin to {}'.format(stdin_name))
-            with closing(open(stdin_fd, 'wb')) as stdin_fobj:
-                # To avoid blocking forever reading input from the client, must
-                # read _only_ the number of bytes specified in the request
-                # (which coincidently permits HTTP/1.1 keep-alive connections)
-                while content_length > 0:
-                    length = min(16 * 1024, content_length)
-                    buf = stdin.read(length)
-                    if not buf:
-                        break
-                    stdin_fobj.write(buf)
-                    content_length -= len(buf)
-        return stdin_name
-
-    # Read the input from the client.
-    environ['wsgi.input'] = _read_input()
+    # Stream the input from the client as Git reads it, rather than
+    # reading it all before we start.
+    body = _RequestBody(environ['wsgi.input'], environ)
+    environ['wsgi.input'] = body
 
 # pylint:disable=W0703
     try:
@@ -648,6 +748,8 @@ def _app_wrapper(user, environ, start_response):
     except Exception:
         LOG.error(traceback.format_exc())
         result = [b'Error, see the Git Fusion log']
+    # Requests rejected before reaching Git leave their body unread.
+    body.discard()
     return result
 # pylint:enable=R0912,W0703
 
@@ -714,6 +816,39 @@ class GitFusionRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
 # pylint:enable=R0904
 
 
+class GitFusionForkingServer(socketserver.ForkingMixIn,
+                             wsgiref.simple_server.WSGIServer):
+    """
+    Serve each request in its own forked child process, at most
+    max_children at a time, so that one long clone does not block
+    every other client.
+
+    Processes, not threads: each request chdir()s into its repo, sets
+    os.environ, and starts its own gitmirror worker and ProcessRunner,
+    all process-wide state. The forked child inherits every module
+    already imported.
+    """
+
+    def __init__(self, server_address, handler_class):
+        wsgiref.simple_server.WSGIServer.__init__(self, server_address, handler_class)
+        self.parent_pid = os.getpid()
+
+    def finish_request(self, request, client_address):
+        """
+        Serve one request. ForkingMixIn ends the child with os._exit(),
+        which skips atexit handlers such as the one that closes the
+        gitmirror pipe. Run them here, as a normal exit would.
+        """
+        try:
+            wsgiref.simple_server.WSGIServer.finish_request(self, request, client_address)
+        finally:
+            if os.getpid() != self.parent_pid:
+                # pylint:disable=W0212
+                # Access to a protected member
+                atexit._run_exitfuncs()
+                # pylint:enable=W0212
+
+
 def main():
     """
     Parse command line arguments and decide what should be done.
@@ -727,7 +862,9 @@ performing a pull or push operation.
     epilog = _("""If the --user argument is given then a simple HTTP server
 will be started, listening on the port specified by --port. The
 REMOTE_USER value will be set to the value given to the --user
-argument. To stop the server, send a terminating signal to the process.
+argument. With --workers N, the server forks a child process for each
+request, up to N at a time; otherwise it serves one request at a time.
+To stop the server, send a terminating signal to the process.
 """)
     log_l10n()
     parser = p4gf_util.create_arg_parser(desc, epilog=epilog)
@@ -735,13 +872,22 @@ argument. To stop the server, send a terminating signal to the process.
                         help=_('value for REMOTE_USER variable'))
     parser.add_argument('-p', '--port', type=int, default=8000,
                         help=_('port on which to listen (default 8000)'))
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help=_('serve up to this many requests at once, each in'
+                               ' its own process (default 0: one at a time)'))
     args = parser.parse_args()
     if args.user:
-        LOG.debug("Listening for HTTP requests on port {} as user {}, pid={}".format(
-            args.port, args.user, os.getpid()))
+        LOG.debug("Listening for HTTP requests on port {} as user {}, workers={}, pid={}"
+                  .format(args.port, args.user, args.workers, os.getpid()))
         wrapper = functools.partial(_app_wrapper, args.user)
-        httpd = wsgiref.simple_server.make_server('', args.port, wrapper,
-            handler_class=GitFusionRequestHandler)
+        if 0 < args.workers:
+            httpd = wsgiref.simple_server.make_server('', args.port, wrapper,
+                server_class=GitFusionForkingServer,
+                handler_class=GitFusionRequestHandler)
+            httpd.max_children = args.workers
+        else:
+            httpd = wsgiref.simple_server.make_server('', args.port, wrapper,
+                handler_class=GitFusionRequestHandler)
         print(_('Serving on port {}...').format(args.port))
 
         def _signal_handler(signum, _frame):
@@ -765,7 +911,11 @@ argument. To stop the server, send a terminating signal to the process.
         _handle_cgi()
 
 
-if __name__ == "__main__":
+def run_main():
+    """
+    Serve one request from sys.argv, os.environ, and stdin/stdout.
+    Run as __main__, or in a p4gf_daemon.py child.
+    """
     # Get the logging configured properly...
     with p4gf_log.ExceptionLogger(squelch=False, write_to_stderr_=True):
         try:
@@ -774,3 +924,7 @@ if __name__ == "__main__":
         except Exception:
             LOG.error(traceback.format_exc())
         # pylint:enable=W0703
+
+
+if __name__ == "__main__":
+    run_main()
@@ -0,0 +1,314 @@
+#! /usr/bin/env python3.3
+'''
+Line up processes on this Git Fusion host that wait for the same lock, so
+that only the process at the head of the line asks Perforce for it.
+
+p4gf_lock's locks live in Perforce counters, the only place that Git
+Fusion servers on different hosts can all see. A process that wants a
+lock someone else holds must poll Perforce until the lock is free. With
+dozens of processes waiting on one repo, that is dozens of processes
+polling Perforce, and whichever happens to poll first after a release
+wins, not whichever has waited longest.
+
+Processes on the same host first line up here, under
+{P4GF_HOME}/locks/{lock name}/, using flock(2):
+
+  Ticket    A first-come, first-served line. Each process takes the next
+            number and holds an exclusive flock on its own numbered file
+            until it leaves the line. To wait, it blocks in flock() on the
+            file of the number before its own. No polling: the kernel
+            wakes it when that process leaves the line or dies.
+
+  HostLock  A readers/writer lock for this host alone, entered through a
+            Ticket line so that a waiting writer holds back readers that
+            arrive after it.
+
+These only reduce Perforce traffic and order waiters. The Perforce
+counter remains the lock: a process that skips or loses its place in
+line still cannot take a counter that someone else holds.
+
+Also records, per lock name, a histogram of how long processes waited
+for that lock.
+'''
+import fcntl
+import json
+import os
+import random
+import time
+
+import p4gf_const
+import p4gf_histogram
+from   p4gf_l10n      import NTR
+import p4gf_util
+
+                        # Largest ticket number we expect to read from a
+                        # file, in bytes of decimal text.
+_NUMBER_SIZE = 32
+
+_TAIL_FILE = NTR('tail')
+_RW_FILE   = NTR('rw')
+_WAIT_FILE = NTR('wait-ms.json')
+
+
+def _lock_dir(name):
+    '''
+    Return the directory that holds the line for lock name, creating
+    it if necessary.
+    '''
+    path = os.path.join( p4gf_const.P4GF_HOME
+                       , p4gf_const.P4GF_LOCAL_LOCK_DIR
+                       , name.replace(os.sep, '_'))
+    p4gf_util.ensure_dir(path)
+    return path
+
+
+def _open(path, flags=os.O_RDWR | os.O_CREAT):
+    '''
+    Open a file descriptor that no exec()ed child inherits.
+    '''
+    return os.open(path, flags | os.O_CLOEXEC, 0o644)
+
+
+def _flock(fd, operation, deadline=None):
+    '''
+    Acquire a flock.
+
+    deadline None means wait forever. Otherwise give up at time.time()
+    deadline, after at least one attempt. Return True if acquired.
+    '''
+    if deadline is None:
+        while True:
+            try:
+                fcntl.flock(fd, operation)
+                return True
+            except InterruptedError:
+                continue
+
+    backoff = Backoff()
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return True
+        except (BlockingIOError, InterruptedError):
+            pass
+        if deadline <= time.time():
+            return False
+        backoff.sleep(deadline)
+
+
+def _unlink(path):
+    '''
+    Remove a file if it exists.
+    '''
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _read_number(fd):
+    '''
+    Return the decimal number in an open file, 0 if empty or garbage.
+    '''
+    data = os.pread(fd, _NUMBER_SIZE, 0)
+    try:
+        return int(data.decode('ascii') or 0)
+    except ValueError:
+        return 0
+
+
+def _write_number(fd, number):
+    '''
+    Replace an open file's content with a decimal number.
+    '''
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, str(number).encode('ascii'), 0)
+
+
+class Backoff:
+    '''
+    Exponentially growing sleep periods, each randomly shortened by up to
+    half so that processes that started waiting together do not all wake
+    together.
+    '''
+
+    def __init__(self, initial=0.025, maximum=2.0):
+        self.period  = initial
+        self.maximum = maximum
+
+    def sleep(self, deadline=None):
+        '''
+        Sleep for our next period, but not past time.time() deadline.
+        '''
+        secs = self.period * random.uniform(0.5, 1.0)
+        self.period = min(self.maximum, 2 * self.period)
+        if deadline is not None:
+            secs = min(secs, deadline - time.time())
+        if 0 < secs:
+            time.sleep(secs)
+
+
+class Ticket:
+    '''
+    One process's place in the line of processes on this host waiting
+    for the same lock.
+
+        ticket = Ticket(name)
+        ticket.join()
+        if ticket.wait(deadline):
+            ... at head of line ...
+        ticket.leave()
+
+    Each numbered file holds the number of the process its owner waits
+    behind. An owner that reaches the head of the line removes its file as
+    it leaves. An owner that gives up or dies first leaves its file
+    behind, and whoever waits behind it reads that file to see whom to
+    wait behind next.
+    '''
+
+    def __init__(self, name):
+        self.dir          = _lock_dir(name)
+        self.number       = None
+        self.waiting_for  = None
+        self.at_head      = False
+        self.fd           = None
+
+    def _path(self, number):
+        '''
+        Return the path of a numbered file in our line.
+        '''
+        return os.path.join(self.dir, str(number))
+
+    def join(self):
+        '''
+        Take the next number in line.
+        '''
+        tail_fd = _open(os.path.join(self.dir, _TAIL_FILE))
+        try:
+            _flock(tail_fd, fcntl.LOCK_EX)
+            self.number = 1 + _read_number(tail_fd)
+            _write_number(tail_fd, self.number)
+            # Lock our own file before anyone else can take the next
+            # number and start waiting on it.
+            self.fd = _open(self._path(self.number), os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            _flock(self.fd, fcntl.LOCK_EX)
+            self.waiting_for = self.number - 1
+            _write_number(self.fd, self.waiting_for)
+        finally:
+            fcntl.flock(tail_fd, fcntl.LOCK_UN)
+            os.close(tail_fd)
+
+    def wait(self, deadline=None):
+        '''
+        Block until every process ahead of us in line has left.
+
+        deadline None means wait forever. Otherwise give up at time.time()
+        deadline. Return True if we are now at the head of the line.
+        '''
+        while not self.at_head:
+            if not self.waiting_for:
+                self.at_head = True
+                break
+            try:
+                fd = _open(self._path(self.waiting_for), os.O_RDONLY)
+            except FileNotFoundError:
+                # Already left.
+                self.at_head = True
+                break
+            try:
+                if not _flock(fd, fcntl.LOCK_SH, deadline):
+                    return False
+                if os.fstat(fd).st_nlink:
+                    # It gave up or died without reaching the head of the
+                    # line. Wait for whoever it was waiting for.
+                    abandoned = self.waiting_for
+                    self.waiting_for = _read_number(fd)
+                    _write_number(self.fd, self.waiting_for)
+                    _unlink(self._path(abandoned))
+                else:
+                    self.at_head = True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        return True
+
+    def leave(self):
+        '''
+        Leave the line, letting whoever waits behind us move up.
+        '''
+        if self.fd is None:
+            return
+        if self.at_head:
+            _unlink(self._path(self.number))
+        # Explicitly unlock: a fork()ed child may share our descriptor.
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+class HostLock:
+    '''
+    A readers/writer lock shared by all processes on this host, granted
+    in the order requested.
+    '''
+
+    def __init__(self, name, shared):
+        self.name   = name
+        self.shared = shared
+        self.fd     = None
+
+    def acquire(self, deadline=None):
+        '''
+        Wait our turn in line, then for any conflicting holders to release.
+
+        deadline None means wait forever. Otherwise give up at time.time()
+        deadline. Return True if acquired.
+        '''
+        ticket = Ticket(self.name)
+        ticket.join()
+        try:
+            if not ticket.wait(deadline):
+                return False
+            fd = _open(os.path.join(ticket.dir, _RW_FILE))
+            operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            if not _flock(fd, operation, deadline):
+                os.close(fd)
+                return False
+            self.fd = fd
+            return True
+        finally:
+            # Holding the lock, or giving up on it, either way let the
+            # next process in line at it.
+            ticket.leave()
+
+    def release(self):
+        '''
+        Release the lock if we hold it.
+        '''
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def record_wait(name, secs):
+    '''
+    Add one wait of secs seconds to lock name's wait histogram, shared by
+    all processes on this host. Return the updated histogram.
+    '''
+    path = os.path.join(_lock_dir(name), _WAIT_FILE)
+    with os.fdopen(_open(path), 'r+') as f:
+        _flock(f.fileno(), fcntl.LOCK_EX)
+        hist = p4gf_histogram.latency_histogram()
+        try:
+            for (be, count) in json.loads(f.read() or '{}').items():
+                if int(be) in hist:
+                    hist[int(be)] = int(count)
+        except (ValueError, AttributeError):
+            pass
+        p4gf_histogram.add_latency(hist, secs)
+        f.seek(0)
+        f.truncate()
+        json.dump(hist, f)
+    return hist
@@ -4,7 +4,6 @@
 
 import logging
 import math
-import multiprocessing
 import os
 import sys
 import time
@@ -14,17 +13,22 @@ from P4 import P4, P4Exception
 
 import p4gf_create_p4
 import p4gf_const
+import p4gf_histogram
 from   p4gf_l10n      import _, NTR
+import p4gf_local_lock
 import p4gf_proc
 import p4gf_util
 
 LOG = logging.getLogger(__name__)
+LOG_WAIT = LOG.getChild(NTR('wait'))
 
 # time.sleep() accepts a float, which is how you get sub-second sleep durations.
 MS = 1.0 / 1000.0
 
-# How often we retry to acquire the lock.
-_RETRY_PERIOD = 500 * MS
+# How often we retry to acquire the lock: first after _RETRY_PERIOD_MIN,
+# doubling each time up to _RETRY_PERIOD_MAX, with jitter.
+_RETRY_PERIOD_MIN = 25 * MS
+_RETRY_PERIOD_MAX = 2000 * MS
 
 # Number of seconds after which we assume the process holding the lock has
 # exited without deleting the counter. That is, if the heartbeat counter
@@ -71,6 +75,7 @@ class CounterLock:
         self.__auto_beat         = False
         self.__event             = None
         self.__stolen__          = False
+        self.__ticket            = None
 
     def __enter__(self):
         self.acquire(self.__timeout_secs__)
@@ -118,9 +123,52 @@ class CounterLock:
             return
 
         start_time = time.time()
+        counter_name = self.counter_name()
+        deadline = _deadline(start_time, timeout_secs)
+
+        # Line up behind any other processes on this host that want this
+        # lock. Only the head of the line polls Perforce.
+        ticket = p4gf_local_lock.Ticket(counter_name)
+        ticket.join()
+        try:
+            alerted_user = False
+            if not ticket.wait(start_time):
+                self._alert_user()
+                alerted_user = True
+                if not ticket.wait(deadline):
+                    raise RuntimeError(self._unable_to_acquire_msg(None))
+
+            self._acquire_counter(start_time, timeout_secs, alerted_user)
+            # Hold our place at the head of the line until release().
+            self.__ticket = ticket
+        finally:
+            if not self.__ticket:
+                ticket.leave()
+        _record_wait(counter_name, time.time() - start_time)
+
+    @staticmethod
+    def _alert_user():
+        """Let the client know we're waiting for a lock."""
+        sys.stderr.write(_('Waiting for access to repository...\n'))
+        sys.stderr.flush()
+
+    def _unable_to_acquire_msg(self, heartbeat):
+        """Tell the git user who's hogging the lock."""
+        msg = _('Unable to acquire lock: {}').format(self.counter_name())
+        if heartbeat:
+            msg += _('\nLock holder: {}').format(heartbeat)
+        timeout = int(math.ceil(HEARTBEAT_TIMEOUT_SECS / 60.0))
+        msg += _('\nPlease try again after {0:d} minute(s).').format(timeout)
+        return msg
+
+    def _acquire_counter(self, start_time, timeout_secs, alerted_user):
+        """Poll Perforce until we increment the lock counter from 0 to 1
+        or run out of time.
+        """
+        poll_start_time = time.time()
         start_heart = self.get_heartbeat()
         counter_name = self.counter_name()
-        alerted_user = False
+        backoff = p4gf_local_lock.Backoff(_RETRY_PERIOD_MIN, _RETRY_PERIOD_MAX)
         while True:
             self.__has__ = self._acquire_attempt()
             if self.__has__:
@@ -133,16 +181,15 @@ class CounterLock:
                 self._create_log_timer()
                 return
 
-            # Let the client know we're waiting for a lock.
             if not alerted_user:
-                sys.stderr.write(_('Waiting for access to repository...\n'))
-                sys.stderr.flush()
+                self._alert_user()
                 alerted_user = True
 
             # Check on the lock holder's status, maybe clear the lock.
             heartbeat = self.get_heartbeat()
             elapsed = time.time() - start_time
-            if heartbeat == start_heart and elapsed > HEARTBEAT_TIMEOUT_SECS:
+            if      heartbeat == start_heart \
+                and time.time() - poll_start_time > HEARTBEAT_TIMEOUT_SECS:
                 LOG.debug("releasing the abandoned lock {}".format(counter_name))
                 # Pretend we have the lock so we can release it.
                 self.__has__ = True
@@ -154,30 +201,25 @@ class CounterLock:
             # Stop waiting if run out of time. Tell the git user
             # who's hogging the lock.
             if timeout_secs and timeout_secs <= elapsed:
-                msg = _('Unable to acquire lock: {}').format(counter_name)
-                if heartbeat:
-                    msg += _('\nLock holder: {}').format(heartbeat)
-                timeout = int(math.ceil(HEARTBEAT_TIMEOUT_SECS / 60.0))
-                msg += _('\nPlease try again after {0:d} minute(s).').format(timeout)
-                raise RuntimeError(msg)
+                raise RuntimeError(self._unable_to_acquire_msg(heartbeat))
 
-            time.sleep(_RETRY_PERIOD)
+            backoff.sleep()
 
     def _start_pacemaker(self):
         """If the lock has been acquired and it is configured to have
-        automatic updates of the heartbeat counter, then set up a child
-        process to regularly update the heartbeat.
+        automatic updates of the heartbeat counter, then set up a
+        thread to regularly update the heartbeat.
         """
         if self.__auto_beat and self.__event is None:
-            LOG.debug('launching pacemaker process for {}, pid={}'.format(
+            LOG.debug('launching pacemaker thread for {}, pid={}'.format(
                 self.__counter_name__, os.getpid()))
-            # Set up event flag for signaling subprocess to exit.
-            self.__event = multiprocessing.Event()
+            # Set up event flag for signaling thread to exit.
+            self.__event = threading.Event()
             # Start the pacemaker to beat the heart automatically.
-            p = multiprocessing.Process(target=pacemaker,
+            t = threading.Thread(target=pacemaker,
                     args=[self.__counter_name__, self.__event])
-            p.daemon = True
-            p.start()
+            t.daemon = True
+            t.start()
 
     def _stop_pacemaker(self):
         """If the pacemaker has been set up, signal it to stop.
@@ -221,6 +263,9 @@ class CounterLock:
             # and cleaned up just as we were attempting to remove it.
             LOG.warn("lock counter deletion failed: {}".format(counter_name))
         self.__has__ = False
+        if self.__ticket:
+            self.__ticket.leave()
+            self.__ticket = None
 
         return True
 
@@ -369,10 +414,9 @@ def pacemaker(view_name, event):
     """
     As long as event flag is clear, update heartbeat of named lock.
     """
-    # Running in a separate process, need to establish our own P4 connection
+    # Running in a separate thread, need to establish our own P4 connection
     # and set up a heartbeat-only lock to update the heartbeat of the lock
     # associated with the view.
-    p4gf_proc.install_stack_dumper()
     LOG.getChild("pacemaker").debug("starting for lock {}".format(view_name))
     p4 = None
     try:
@@ -418,6 +462,32 @@ def check_process_alive(pid, args):
     return False
 
 
+def _deadline(start_time, timeout_secs):
+    '''
+    Convert a lock timeout to a time.time() by which to give up, or None
+    to wait forever.
+    '''
+    if not timeout_secs:
+        return None
+    return start_time + timeout_secs
+
+
+def _record_wait(lock_name, seconds):
+    '''
+    Add one acquisition of lock_name to its wait histogram, shared by all
+    processes on this host.
+    '''
+    try:
+        hist = p4gf_local_lock.record_wait(lock_name, seconds)
+    except OSError as e:
+        LOG_WAIT.debug('cannot record wait for {}: {}'.format(lock_name, e))
+        return
+    if LOG_WAIT.isEnabledFor(logging.DEBUG2):
+        LOG_WAIT.debug2('{} waited {:.0f} ms, all waits ms:\n\t'
+                        .format(lock_name, 1000 * seconds)
+                        + '\n\t'.join(p4gf_histogram.latency_lines(hist)))
+
+
 _timer_id = 0
 
 
@@ -473,6 +543,18 @@ def view_lock_heartbeat_only(p4, view_name):
                       , heartbeat_only=True)
 
 
+def view_lock_exists(p4, view_name):
+    '''
+    Does any process hold this view's lock right now?
+
+    Does not check for, or steal, a stale lock: a process that needs the
+    lock must still acquire it.
+    '''
+    value = p4gf_util.first_value_for_key(
+            p4.run('counter', '-u', view_lock_name(view_name)), 'value')
+    return bool(value) and value != '0'
+
+
 def host_view_lock_name(host_name, view_name):
     '''
     Return a name for a counter that we use to coordinate access to
@@ -512,6 +594,29 @@ def shared_host_view_lock_exists(p4, view_name):
 
 SHARED    = NTR('shared')
 EXCLUSIVE = NTR('exclusive')
+VIEW      = NTR('view')
+
+# Time this process has spent waiting to acquire locks, by kind of lock:
+# VIEW, SHARED, or EXCLUSIVE ==> (acquisition count, total seconds waited)
+_LOCK_WAIT = {}
+
+
+def record_lock_wait(kind, seconds):
+    '''
+    Add one lock acquisition, and how long we waited for it, to this
+    process's lock wait totals.
+    '''
+    (count, total) = _LOCK_WAIT.get(kind, (0, 0.0))
+    _LOCK_WAIT[kind] = (count + 1, total + seconds)
+
+
+def lock_wait_totals():
+    '''
+    Return a dict of lock kind ==> (acquisition count, total seconds waited)
+    for every lock this process has acquired.
+    '''
+    return dict(_LOCK_WAIT)
+
 
 def get_shared_host_view_lock_state(p4, host_name, view_name):
     '''Does any process already hold this shared host+view lock?
@@ -582,6 +687,7 @@ class SharedViewLock:
         self.__host_name = host_name
         self.__view_name = view_name
         self.__has = False
+        self.__host_lock = None
         self.__timeout_secs = timeout
         self.__first_acquire_func = first_acquire_func
         self.__last_release_func = last_release_func
@@ -597,10 +703,29 @@ class SharedViewLock:
     def acquire(self):
         """Attempt to acquire a shared lock.
         """
+        shared_name = shared_host_view_name(self.__host_name, self.__view_name)
+        start_time = time.time()
+        # Wait our turn among processes on this host, and for any
+        # conflicting holders to release, before asking Perforce.
+        host_lock = p4gf_local_lock.HostLock(shared_name, shared=True)
+        if not host_lock.acquire(_deadline(start_time, self.__timeout_secs)):
+            raise RuntimeError(_('Unable to acquire lock: {}').format(shared_name))
+        try:
+            self._acquire_counter(start_time)
+        finally:
+            if not self.__has:
+                host_lock.release()
+        self.__host_lock = host_lock
+        record_lock_wait(SHARED, time.time() - start_time)
+        _record_wait(shared_name, time.time() - start_time)
+
+    def _acquire_counter(self, start_time):
+        """Poll Perforce until the shared lock counter lets us in.
+        """
         counter_name = host_view_lock_name(self.__host_name, self.__view_name)
         counter_lock = CounterLock(self.__p4, counter_name, self.__timeout_secs)
         shared_name = shared_host_view_name(self.__host_name, self.__view_name)
-        start_time = time.time()
+        backoff = p4gf_local_lock.Backoff(_RETRY_PERIOD_MIN, _RETRY_PERIOD_MAX)
         while not self.__has:
             with counter_lock:
                 # Get the current value for the shared lock.
@@ -637,7 +762,7 @@ class SharedViewLock:
                     raise RuntimeError(msg)
                 # Having released the lock and not acquired the shared lock,
                 # pause briefly before trying again.
-                time.sleep(_RETRY_PERIOD)
+                backoff.sleep()
 
     def release(self):
         """Release a previously acquired hold on the shared lock. Does nothing
@@ -666,6 +791,8 @@ class SharedViewLock:
                     except P4Exception:
                         LOG.warn("lock counter deletion failed: {}".format(shared_name))
         self.__has = False
+        self.__host_lock.release()
+        self.__host_lock = None
 
     def has(self):
         """Returns True if the lock is currently held by this instance,
@@ -691,6 +818,7 @@ class ExclusiveViewLock:
         self.__host_name = host_name
         self.__view_name = view_name
         self.__has = False
+        self.__host_lock = None
         self.__timeout_secs = timeout
 
     def __enter__(self):
@@ -702,12 +830,31 @@ class ExclusiveViewLock:
         return False    # False = do not squelch exception
 
     def acquire(self):
-        """Attempt to acquire a shared lock.
+        """Attempt to acquire an exclusive lock.
+        """
+        shared_name = shared_host_view_name(self.__host_name, self.__view_name)
+        start_time = time.time()
+        # Wait our turn among processes on this host, and for any
+        # conflicting holders to release, before asking Perforce.
+        host_lock = p4gf_local_lock.HostLock(shared_name, shared=False)
+        if not host_lock.acquire(_deadline(start_time, self.__timeout_secs)):
+            raise RuntimeError(_('Unable to acquire lock: {}').format(shared_name))
+        try:
+            self._acquire_counter(start_time)
+        finally:
+            if not self.__has:
+                host_lock.release()
+        self.__host_lock = host_lock
+        record_lock_wait(EXCLUSIVE, time.time() - start_time)
+        _record_wait(shared_name, time.time() - start_time)
+
+    def _acquire_counter(self, start_time):
+        """Poll Perforce until the exclusive lock counter lets us in.
         """
         counter_name = host_view_lock_name(self.__host_name, self.__view_name)
         counter_lock = CounterLock(self.__p4, counter_name, self.__timeout_secs)
         shared_name = shared_host_view_name(self.__host_name, self.__view_name)
-        start_time = time.time()
+        backoff = p4gf_local_lock.Backoff(_RETRY_PERIOD_MIN, _RETRY_PERIOD_MAX)
         while not self.__has:
             with counter_lock:
                 # Get the current value for the lock.
@@ -743,7 +890,7 @@ class ExclusiveViewLock:
                     raise RuntimeError(msg)
                 # Having released the lock and not acquired the shared lock,
                 # pause briefly before trying again.
-                time.sleep(_RETRY_PERIOD)
+                backoff.sleep()
 
     def release(self):
         """Release a previously acquired hold on the shared lock. Does nothing
@@ -766,6 +913,8 @@ class ExclusiveViewLock:
             else:
                 LOG.warn("Lock {0} does not belong to us, not releasing".format(shared_name))
         self.__has = False
+        self.__host_lock.release()
+        self.__host_lock = None
 
     def has(self):
         """Returns True if the lock is currently held by this instance,
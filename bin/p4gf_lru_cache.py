@@ -0,0 +1,184 @@
+#! /usr/bin/env python3.3
+'''
+A bounded least-recently-used cache with O(1) lookup, insert, and eviction.
+
+Run this module to benchmark it at various sizes:
+
+    p4gf_lru_cache.py --sizes 10000,100000,1000000
+'''
+from   collections import OrderedDict
+import logging
+import time
+
+from   p4gf_l10n      import _, NTR
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # Unique "not found" value so that None can be cached.
+_MISSING = object()
+
+
+class LRUCache:
+    '''
+    Map keys to values, holding at most max_size entries. Once full, each
+    new entry evicts the least recently used (read or written) entry.
+
+    Counts hits, misses, and evictions for instrumentation.
+
+    Not thread-safe.
+    '''
+
+    def __init__(self, max_size, name=None):
+        if max_size < 1:
+            raise ValueError(_('LRUCache max_size must be positive: {}')
+                             .format(max_size))
+        self.max_size = max_size
+        self.name     = name
+        self._dict    = OrderedDict()
+
+                        # Instrumentation
+        self.hit_count      = 0
+        self.miss_count     = 0
+        self.eviction_count = 0
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __contains__(self, key):
+        '''Membership test. Neither counts as a hit/miss nor refreshes key.'''
+        return key in self._dict
+
+    def __str__(self):
+        return NTR('LRUCache {name} size={size}/{max_size}'
+                   ' hit={hit} miss={miss} evict={evict}').format(
+                      name     = self.name
+                    , size     = len(self._dict)
+                    , max_size = self.max_size
+                    , hit      = self.hit_count
+                    , miss     = self.miss_count
+                    , evict    = self.eviction_count )
+
+    def get(self, key, default=None):
+        '''
+        Return key's value and mark it most recently used.
+        Return default if not cached.
+        '''
+        value = self._dict.get(key, _MISSING)
+        if value is _MISSING:
+            self.miss_count += 1
+            return default
+        self.hit_count += 1
+        self._dict.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        '''
+        Cache key's value, mark it most recently used. If that makes us too
+        big, evict the least recently used entry.
+        '''
+        if key in self._dict:
+            self._dict.move_to_end(key)
+        self._dict[key] = value
+        if self.max_size < len(self._dict):
+            self._dict.popitem(last=False)
+            self.eviction_count += 1
+
+    def setdefault(self, key, default):
+        '''
+        If key is cached, mark it most recently used and return its value.
+        If not, cache and return default. Neither counts as a hit/miss.
+        '''
+        value = self._dict.get(key, _MISSING)
+        if value is _MISSING:
+            self.put(key, default)
+            return default
+        self._dict.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        '''Remove key, return its value, or default if not cached.'''
+        return self._dict.pop(key, default)
+
+    def items(self):
+        '''(key, value) pairs, least recently used first.'''
+        return self._dict.items()
+
+    def clear(self):
+        '''Remove all entries. Counters are retained.'''
+        self._dict.clear()
+
+    def resize(self, max_size):
+        '''
+        Change our capacity. Evicts least recently used entries if we now
+        hold more than the new max_size.
+        '''
+        if max_size < 1:
+            raise ValueError(_('LRUCache max_size must be positive: {}')
+                             .format(max_size))
+        self.max_size = max_size
+        while self.max_size < len(self._dict):
+            self._dict.popitem(last=False)
+            self.eviction_count += 1
+
+# -- end class LRUCache -------------------------------------------------------
+
+
+def _bench_one(size):
+    '''
+    Fill a cache of the given size, then hit every entry, then miss as
+    many times, then push in as many new entries (each one an eviction).
+    Return per-operation microseconds for (insert, hit, miss, evict).
+    '''
+    cache = LRUCache(size)
+    keys = [NTR('{:040x}').format(i) for i in range(2 * size)]
+
+    start = time.time()
+    for k in keys[:size]:
+        cache.put(k, True)
+    insert_secs = time.time() - start
+
+    start = time.time()
+    for k in keys[:size]:
+        cache.get(k)
+    hit_secs = time.time() - start
+
+    start = time.time()
+    for k in keys[size:]:
+        cache.get(k)
+    miss_secs = time.time() - start
+
+    start = time.time()
+    for k in keys[size:]:
+        cache.put(k, True)
+    evict_secs = time.time() - start
+    assert cache.eviction_count == size
+
+    us = 1000000.0 / size
+    return (insert_secs * us, hit_secs * us, miss_secs * us, evict_secs * us)
+
+
+def main():
+    '''
+    Benchmark LRUCache per-operation cost at various sizes.
+    Constant cost across sizes is the point.
+    '''
+    parser = p4gf_util.create_arg_parser(
+        _('Benchmark LRUCache insert, lookup, and eviction at various sizes.'))
+    parser.add_argument('--sizes', default=NTR('10000,100000,1000000'),
+                        help=_('comma-separated list of cache sizes'))
+    args = parser.parse_args()
+
+    fmt = NTR('{size:>10,d}  insert:{insert:6.2f}us  hit:{hit:6.2f}us'
+              '  miss:{miss:6.2f}us  evict:{evict:6.2f}us')
+    for size in [int(s) for s in args.sizes.split(',')]:
+        (insert, hit, miss, evict) = _bench_one(size)
+        print(fmt.format( size   = size
+                        , insert = insert
+                        , hit    = hit
+                        , miss   = miss
+                        , evict  = evict ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#! /usr/bin/env python3.3
+'''
+Bulk restore of Git commit and tree objects from //P4GF_DEPOT/objects/...
+
+When rebuilding a repo, P2G._fast_import_from_gitmirror() copies each
+changelist's commit, and every tree below it, out of our mirror with one
+'p4 files' and one 'p4 print -o' per object. For a large repo that is
+millions of tiny requests.
+
+MirrorRestore does the same work in bulk, before P2G walks the changelists:
+
+    1. Find every mirrored commit for the changelists to copy in the local
+       commit index, itself synchronized with a single wildcard 'p4 files'.
+    2. 'p4 print' commits, then trees one tree depth at a time, many depot
+       paths per request. A tree that is not in the mirror simply fails to
+       print, no separate 'p4 files' required.
+    3. Verify each printed object's sha1 on a pool of threads.
+    4. Write each verified tree into .git/objects, or into a pack if the
+       repo prints to packs, as soon as it is verified. Then write each
+       commit whose entire tree is now in Git.
+
+P2G then finds each restored commit already in Git and moves on. Commits
+we could not restore completely go through the usual per-commit code.
+'''
+import binascii
+from   concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+
+import p4gf_config
+import p4gf_const
+import p4gf_git
+from   p4gf_git_pack       import PackWriter
+from   p4gf_l10n           import NTR
+from   p4gf_object_type    import ObjectType
+import p4gf_object_type
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # Depot paths per 'p4 print' request.
+_PRINT_CHUNK_SIZE = 1000
+
+                        # Threads that decompress and hash printed objects.
+_VERIFY_WORKER_COUNT = min(8, multiprocessing.cpu_count())
+
+_GITLINK_MODE = b'160000'
+_TREE_MODE    = b'40000'
+
+
+def is_enabled(ctx):
+    '''
+    Does this repo's config permit bulk restore?
+    '''
+    config = p4gf_config.get_repo(ctx.p4gf, ctx.config.view_name)
+    return config.getboolean( p4gf_config.SECTION_REPO
+                            , p4gf_config.KEY_MIRROR_BULK_RESTORE
+                            , fallback = True )
+
+
+def _to_str(value):
+    '''
+    'p4 print' under RawEncoding might return bytes for tagged values.
+    '''
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def _verify(sha1, compressed):
+    '''
+    Decompress a loose object and check that its content hashes to sha1.
+
+    Return (sha1, type name, content), or (sha1, None, None) if corrupt.
+    '''
+    try:
+        data = zlib.decompress(compressed)
+    except zlib.error:
+        return (sha1, None, None)
+    if hashlib.sha1(data).hexdigest() != sha1:
+        return (sha1, None, None)
+    i = data.index(b'\x00')
+    return (sha1, data[:i].split(b' ')[0].decode(), data[i+1:])
+
+
+def _tree_entries(content):
+    '''
+    Generator: yield (mode, sha1) for each entry in a tree object's content.
+    mode is bytes, such as b'100644' or b'40000'.
+    '''
+    i   = 0
+    end = len(content)
+    while i < end:
+        sp  = content.index(b' ', i)
+        nul = content.index(b'\x00', sp)
+        yield ( content[i:sp]
+              , binascii.hexlify(content[nul + 1:nul + 21]).decode() )
+        i = nul + 21
+
+
+class MirrorRestore:
+    '''
+    Restore mirrored commits and trees for a range of changelists, in bulk.
+    '''
+    def __init__(self, ctx):
+        self.ctx      = ctx
+        self.repo     = ctx.view_repo
+        self.git_dir  = ctx.view_dirs.GIT_DIR
+
+        self.pack_writer = None
+        config = p4gf_config.get_repo(ctx.p4gf, ctx.config.view_name)
+        if config.getboolean( p4gf_config.SECTION_REPO
+                            , p4gf_config.KEY_PRINT_TO_PACK
+                            , fallback = False ):
+            self.pack_writer = PackWriter(git_dir = self.git_dir)
+
+                        # sha1 ==> list of subtree sha1s, for each tree
+                        # we restored, or None if one of its blobs is not
+                        # in Git. Just the parts of the tree that
+                        # _is_tree_complete() needs, not its content.
+        self._subtrees      = {}
+                        # sha1 ==> True/False: is this tree, and
+                        # everything below it, in Git?
+        self._tree_complete = {}
+
+                        # Commits we restored, and those we could not.
+        self.restored_sha1s   = set()
+        self.incomplete_sha1s = set()
+
+                        # Instrumentation
+        self.print_request_count = 0
+        self.object_count        = 0
+
+    def restore(self, change_nums):
+        '''
+        Restore every mirrored commit for the given changelists, along
+        with their trees.
+
+        Return the number of Git objects written.
+        '''
+        start = time.time()
+        commits = self._find_commits(change_nums)
+        if not commits:
+            return 0
+        LOG.info('Restoring {} commits from //{}/objects/...'
+                 .format(len(commits), p4gf_const.P4GF_DEPOT))
+
+        # Print and verify commits.
+        commit_content = self._print_objects(
+            { sha1 : ObjectType.create_commit( sha1
+                                             , self.ctx.config.view_name
+                                             , change
+                                             , branch_id ).to_depot_path()
+              for (sha1, change, branch_id) in commits }, NTR('commit'))
+
+        # Print, verify and write trees, one depth at a time.
+        commit_tree = {}
+        for sha1, content in commit_content.items():
+            tree_sha1 = p4gf_git.tree_from_commit(content)
+            if tree_sha1:
+                commit_tree[sha1] = tree_sha1
+        self._restore_trees(set(commit_tree.values()))
+
+        # Write each commit whose tree we now have in full.
+        for (sha1, _change, _branch_id) in commits:
+            tree_sha1 = commit_tree.get(sha1)
+            if tree_sha1 and self._is_tree_complete(tree_sha1):
+                self._write(sha1, NTR('commit'), commit_content[sha1])
+                self.restored_sha1s.add(sha1)
+            else:
+                self.incomplete_sha1s.add(sha1)
+        if self.pack_writer:
+            self.pack_writer.finish()
+        p4gf_util.sha1_exists_invalidate()
+        p4gf_util.note_sha1s_exist(self.restored_sha1s)
+
+        secs = time.time() - start
+        LOG.info('Restored {commit_ct} commits and {tree_ct} trees'
+                 ' ({object_ct} objects) with {req_ct} p4 print requests'
+                 ' in {secs:.1f}s: {rate:.0f} objects/sec.'
+                 ' {incomplete_ct} commits left to copy one at a time.'
+                 .format( commit_ct     = len(self.restored_sha1s)
+                        , tree_ct       = len(self._subtrees)
+                        , object_ct     = self.object_count
+                        , req_ct        = self.print_request_count
+                        , secs          = secs
+                        , rate          = self.object_count / secs if secs else 0
+                        , incomplete_ct = len(self.incomplete_sha1s) ))
+        return self.object_count
+
+    def _find_commits(self, change_nums):
+        '''
+        Return a list of (sha1, change, branch_id) for every mirrored commit
+        not yet in Git, for changelists in change_nums, ordered by change.
+        '''
+        index = p4gf_object_type.known_commit_index(self.ctx)
+        if not index or not change_nums:
+            return []
+        wanted = set(int(c) for c in change_nums)
+        seen   = set()
+        result = []
+        for (change, branch_id, sha1) in index.commits_between(min(wanted), max(wanted)):
+            if change not in wanted or sha1 in seen or sha1 in self.repo:
+                continue
+            seen.add(sha1)
+            result.append((sha1, change, branch_id))
+        return result
+
+    def _restore_trees(self, tree_sha1s):
+        '''
+        Print and write, breadth first, every tree at or below tree_sha1s
+        that is not already in Git.
+        '''
+        level = tree_sha1s
+        while level:
+            need = {sha1 : ObjectType.tree_p4_path(sha1)
+                    for sha1 in level
+                    if sha1 not in self._subtrees and sha1 not in self.repo}
+            printed = self._print_objects(need, NTR('tree'))
+            level = set()
+            for sha1, content in printed.items():
+                self._write(sha1, NTR('tree'), content)
+                subtrees = []
+                for (mode, child) in _tree_entries(content):
+                    if mode == _TREE_MODE:
+                        subtrees.append(child)
+                    elif mode == _GITLINK_MODE:
+                        continue
+                    elif child not in self.repo:
+                        LOG.debug2('_restore_trees() {} missing blob {}'
+                                   .format( p4gf_util.abbrev(sha1)
+                                          , p4gf_util.abbrev(child)))
+                        subtrees = None
+                        break
+                self._subtrees[sha1] = subtrees
+                if subtrees:
+                    level.update(subtrees)
+            LOG.debug('_restore_trees() need={} printed={} next={}'
+                      .format(len(need), len(printed), len(level)))
+
+    def _print_objects(self, sha1_to_depot_path, type_name):
+        '''
+        'p4 print' a batch of mirrored objects and verify them.
+
+        Return a dict of sha1 ==> content, without loose object header, for
+        every object printed and verified as type_name. Silently omit
+        objects missing from the mirror, report corrupt ones.
+        '''
+        depot_path_to_sha1 = {v : k for k, v in sha1_to_depot_path.items()}
+        depot_paths = sorted(depot_path_to_sha1.keys())
+        result = {}
+        with ThreadPoolExecutor(max_workers=_VERIFY_WORKER_COUNT) as pool:
+            futures = []
+            for i in range(0, len(depot_paths), _PRINT_CHUNK_SIZE):
+                chunk = depot_paths[i:i + _PRINT_CHUNK_SIZE]
+                for (depot_path, compressed) in self._print(chunk):
+                    sha1 = depot_path_to_sha1.get(depot_path)
+                    if sha1:
+                        futures.append(pool.submit(_verify, sha1, compressed))
+            for future in futures:
+                (sha1, got_type, content) = future.result()
+                if got_type != type_name:
+                    LOG.warning('mirrored {} {} failed verification'
+                                .format(type_name, sha1))
+                    continue
+                result[sha1] = content
+        return result
+
+    def _print(self, depot_paths):
+        '''
+        Generator: run one 'p4 print' for depot_paths, and yield
+        (depot path, content bytes) for each file printed.
+        '''
+        cmd = ['print'] + depot_paths
+        p4gf_util.log_p4_request(cmd)
+        self.print_request_count += 1
+        with p4gf_util.RawEncoding(self.ctx.p4gf):
+            r = self.ctx.p4gf.run(cmd)
+        depot_path = None
+        chunks     = []
+        for item in r:
+            if isinstance(item, dict):
+                if depot_path and chunks:
+                    yield (depot_path, b''.join(chunks))
+                depot_path = _to_str(item.get('depotFile'))
+                chunks     = []
+                if 'delete' in _to_str(item.get('action', '')):
+                    depot_path = None
+            elif depot_path:
+                chunks.append(item if isinstance(item, bytes) else item.encode())
+        if depot_path and chunks:
+            yield (depot_path, b''.join(chunks))
+
+    def _is_tree_complete(self, sha1):
+        '''
+        Is this tree, and every tree and blob below it, in Git?
+        '''
+        done = self._tree_complete.get(sha1)
+        if done is not None:
+            return done
+        if sha1 in self._subtrees:
+            subtrees = self._subtrees[sha1]
+            done = subtrees is not None and all(self._is_tree_complete(child)
+                                                for child in subtrees)
+        else:
+                        # Not restored: either already in Git before we
+                        # started, or missing from our mirror.
+            done = sha1 in self.repo
+        self._tree_complete[sha1] = done
+        return done
+
+    def _write(self, sha1, type_name, content):
+        '''
+        Write one object into Git: append to our pack, or write a loose
+        object file.
+        '''
+        self.object_count += 1
+        if self.pack_writer:
+            self.pack_writer.add( sha1, type_name, len(content)
+                                , io.BytesIO(zlib.compress(content)) )
+            return
+        path = os.path.join( self.git_dir
+                           , p4gf_util.sha1_to_git_objects_path(sha1) )
+        if os.path.exists(path):
+            return
+        p4gf_util.ensure_parent_dir(path)
+        tmp_path = NTR('{}.{}').format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(NTR('{} {}\0').format(type_name, len(content)).encode()
+                                  + content))
+        os.replace(tmp_path, path)
+
+# -- end class MirrorRestore --------------------------------------------------
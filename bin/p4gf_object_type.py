@@ -6,15 +6,16 @@ Checks only the local filesystem for .git-fusion/...
 '''
 
 import binascii
-import bisect
-from collections import namedtuple, MutableSequence, Sequence
+from collections import namedtuple, Sequence
 import logging
-import random
+import os
 import re
 
+from   p4gf_commit_index import CommitIndex
 import p4gf_const
-from   p4gf_l10n      import _, NTR
+from   p4gf_l10n      import NTR
 import p4gf_log
+from   p4gf_lru_cache import LRUCache
 import p4gf_util
 
 LOG = p4gf_log.for_module()
@@ -76,47 +77,18 @@ class TreeCache:
     '''
     MAX_SIZE = 10000
 
-    def __init__(self):
-        self._tree_cache = [None]*TreeCache.MAX_SIZE
-        self._tree_cache_size = 0
+    def __init__(self, max_size=MAX_SIZE):
+        # binary sha1 ==> True
+        self._cache = LRUCache(max_size, NTR('tree'))
+
+    def __str__(self):
+        return str(self._cache)
 
     def clear(self):
         '''
         remove all elements from this cache
         '''
-        self._tree_cache = [None]*TreeCache.MAX_SIZE
-        self._tree_cache_size = 0
-
-    def _tree_cache_insert(self, j, bsha1):
-        '''
-        Insert an entry in the cache of tree sha1 values.
-        If the cache is already full, remove one entry at random first.
-        '''
-        # NOP if already in list
-        if j < self._tree_cache_size and self._tree_cache[j] == bsha1:
-            return
-
-        # just insert if not at capacity
-        if self._tree_cache_size < TreeCache.MAX_SIZE:
-            self._tree_cache = self._tree_cache[:j] \
-                             + [bsha1] \
-                             + self._tree_cache[j:TreeCache.MAX_SIZE-1]
-            self._tree_cache_size += 1
-            return
-
-        # remove a random entry and insert new entry
-        i = random.randrange(TreeCache.MAX_SIZE)
-        if i == j:
-            self._tree_cache[i] = bsha1
-        elif i < j:
-            self._tree_cache = self._tree_cache[:i] \
-                             + self._tree_cache[i+1:j] \
-                             + [bsha1] + self._tree_cache[j:]
-        else:
-            self._tree_cache = self._tree_cache[:j] \
-                             + [bsha1] \
-                             + self._tree_cache[j:i] \
-                             + self._tree_cache[i+1:]
+        self._cache.clear()
 
     def tree_exists(self, p4, sha1):
         '''
@@ -125,8 +97,7 @@ class TreeCache:
         # convert to binary rep for space savings
         bsha1 = binascii.a2b_hex(sha1)
         # test if already in cache
-        j = bisect.bisect_left(self._tree_cache, bsha1, hi=self._tree_cache_size)
-        if j < self._tree_cache_size and self._tree_cache[j] == bsha1:
+        if self._cache.get(bsha1):
             LOG.debug2('tree cache hit for {}'.format(sha1))
             return True
         # not in cache, check server
@@ -142,180 +113,90 @@ class TreeCache:
         found_sha1 = m.group('slashed_sha1').replace('/', '')
         if not sha1 == found_sha1:
             return False
-        self._tree_cache_insert(j, bsha1)
+        self._cache.put(bsha1, True)
         return True
 
 class ChangeToCommitCache:
     '''
     Maintains a limited size cache of changelist-to-commit mappings
     for different branches.
+
+    Bounded by changelist count: all of one changelist's branch mappings
+    are cached or evicted together.
     '''
     MAX_SIZE = 10000
 
-    def __init__(self):
-        self._branches = {}
-        self._count = 0
+    def __init__(self, max_size=MAX_SIZE):
+        # changelist ==> {branch_id : commit sha1}
+        self._cache = LRUCache(max_size, NTR('change_to_commit'))
+
+    def __str__(self):
+        return str(self._cache)
 
     def clear(self):
         '''
         remove all elements from this cache
         '''
-        self._branches = {}
-        self._count = 0
-
-    def _remove_one(self):
-        '''
-        remove a randomly selected element
-        '''
-        assert self._count == ChangeToCommitCache.MAX_SIZE
-        self._count -= 1
-        i = random.randrange(ChangeToCommitCache.MAX_SIZE)
-        for j in self._branches.values():
-            if len(j) <= i:
-                i -= len(j)
-                continue
-            key = list(j.keys())[i]
-            del j[key]
+        self._cache.clear()
 
     def append(self, changelist, branch_id, sha1):
         '''
         add an entry mapping changelist on branch_id to commit sha1
         '''
-        if self._count == ChangeToCommitCache.MAX_SIZE:
-            self._remove_one()
-
-        if not branch_id in self._branches:
-            self._branches[branch_id] = {}
-        self._branches[branch_id][changelist] = sha1
-        self._count += 1
+        self._cache.setdefault(changelist, {})[branch_id] = sha1
 
     def get(self, changelist, branch_id):
         '''
         return matching (branch_id, commit_sha1) if in cache, else None
         if branch_id is None, returns first matching element, or None
         '''
-        if not branch_id:
-            return self._get_any_branch(changelist)
-        branch_commits = self._branches.get(branch_id)
+        branch_commits = self._cache.get(changelist)
         if not branch_commits:
             return None
-        sha1 = branch_commits.get(changelist)
+        if not branch_id:
+            for branch_id, sha1 in branch_commits.items():
+                return branch_id, sha1
+        sha1 = branch_commits.get(branch_id)
         if not sha1:
             return None
         return branch_id, sha1
 
-    def _get_any_branch(self, changelist):
-        '''
-        return first matching (branch_id,commit_sha1) or None
-        '''
-        for branch_id, changes in self._branches.items():
-            if changelist in changes:
-                return branch_id, changes[changelist]
-        return None
-
-class ObjectTypeCache(MutableSequence):
+class ObjectTypeCache:
     """
-    Maintains a limited number of sorted ObjectTypeList objects. When more
-    objects than MAX_LEN have been appended, a random selection of elements
-    will be removed to make room for any new additions. The objects are
-    sorted according to their natural order.
-
-    Insertion into the sequence is always done in a sorted manner (i.e.
-    index is ignored). Because the list is backed by an array, insertions
-    incur a O(N) complexity cost.
+    Maintains a limited number of ObjectTypeList objects, keyed by sha1.
+    When more than MAX_LEN have been appended, the least recently used
+    ones are removed to make room for any new additions.
     """
     MAX_LEN = 1000
 
-    def __init__(self):
-        self.__count = 0
-        self.__array = [None] * ObjectTypeCache.MAX_LEN
+    def __init__(self, max_len=MAX_LEN):
+        # sha1 ==> ObjectTypeList
+        self._cache = LRUCache(max_len, NTR('object_type'))
 
     def __len__(self):
-        return self.__count
+        return len(self._cache)
 
     def __contains__(self, value):
-        if isinstance(value, str):
-            value = ObjectTypeList(value, None)
-        i = bisect.bisect_left(self.__array, value, hi=self.__count)
-        if i != self.__count and self.__array[i] == value:
-            return True
-        return False
-
-    def index(self, value):
-        i = bisect.bisect_left(self.__array, value, hi=self.__count)
-        if i != self.__count and self.__array[i] == value:
-            return i
-        raise ValueError
-
-    def __getitem__(self, index):
-        if index == self.__count or abs(index) > self.__count:
-            # pylint disable R0801 (similar lines) does not work?
-            raise IndexError(_('index out of bounds'))
-        if index < 0:
-            # special case for negative indices
-            return self.__array[self.__count + index]
-        return self.__array[index]
+        if not isinstance(value, str):
+            value = value.sha1
+        return value in self._cache
 
     def get(self, sha1):
         """Retrieve item based on the given SHA1 value. Returns None if not found."""
-        value = ObjectTypeList(sha1, None)
-        i = bisect.bisect_left(self.__array, value, hi=self.__count)
-        if i != self.__count and self.__array[i] == value:
-            return self.__array[i]
-        return None
-
-    def __setitem__(self, index, value):
-        raise IndexError(_('only append operations allowed'))
-
-    def __delitem__(self, index):
-        # pylint disable R0801 (similar lines) does not work?
-        raise IndexError(_('special list type, no deletions'))
+        return self._cache.get(sha1)
 
     def __str__(self):
-        return str(self.__array[:self.__count])
+        return str(self._cache)
 
     def clear(self):
         """Remove all elements from this cache."""
-        self.__count = 0
-        for i in range(len(self.__array)):
-            self.__array[i] = None
-
-    def insert(self, index, value):
-        raise IndexError(_('only append operations allowed'))
+        self._cache.clear()
 
     def append(self, value):
         """
-        Add the given value to the list, maintaining length and order.
+        Add the given ObjectTypeList, evicting the least recently used if full.
         """
-        idx = bisect.bisect_left(self.__array, value, hi=self.__count)
-        # pylint disable R0801 (similar lines) does not work?
-        if self.__count == len(self.__array):
-            # reached size limit, remove a random element
-            mark = random.randrange(self.__count)
-            if idx == self.__count:
-                # inserting beyond the end
-                idx -= 1
-            if mark < idx:
-                for i in range(mark, idx - 1):
-                    self.__array[i] = self.__array[i + 1]
-            else:
-                # pylint disable R0801 (similar lines) does not work?
-                for i in range(mark, idx, -1):
-                    self.__array[i] = self.__array[i - 1]
-            self.__array[idx] = value
-        else:
-            # there is room enough for more
-            if idx == self.__count:
-                # goes at the end
-                self.__array[idx] = value
-                # pylint disable R0801 (similar lines) does not work?
-            else:
-                # goes somewhere other than the end
-                for i in range(self.__count, idx, -1):
-                    self.__array[i] = self.__array[i - 1]
-                # pylint disable R0801 (similar lines) does not work?
-                self.__array[idx] = value
-            self.__count += 1
+        self._cache.put(value.sha1, value)
 
 
 # pylint:disable=R0924
@@ -376,6 +257,11 @@ class ObjectType:
     last_commits_cache = {}
     last_commits_cache_complete = False
     change_to_commit_cache = ChangeToCommitCache()
+    # Persistent local commit index, one per repo: db path ==> CommitIndex.
+    commit_index = {}
+    # db paths of commit indexes checked against the server's high-water
+    # mark since the last reset_cache().
+    commit_index_validated = set()
 
     def __init__(self, sha1, otype, details=None):
         self.sha1 = sha1
@@ -404,11 +290,18 @@ class ObjectType:
         After gitmirror submits new ObjectCache files to Perforce, our cache
         is no longer correct.
         '''
+        LOG.debug2('clearing caches: {}, {}, {}'
+                   .format( ObjectType.object_cache
+                          , ObjectType.tree_cache
+                          , ObjectType.change_to_commit_cache ))
         ObjectType.object_cache.clear()
         ObjectType.tree_cache.clear()
         ObjectType.last_commits_cache = {}
         ObjectType.last_commits_cache_complete = False
         ObjectType.change_to_commit_cache.clear()
+        # Do not discard the persistent commit index, just check it against
+        # the server again before next use.
+        ObjectType.commit_index_validated = set()
         LOG.debug2("cache cleared")
 
     @staticmethod
@@ -500,6 +393,25 @@ class ObjectType:
         If must_exist_local is True, only commits which also exist in the
         repo are considered in the search.
         '''
+        index = _commit_index(ctx)
+        if index:
+            best = None
+            for branch_id in branch_ids:
+                last = index.last_for_branch(_branch_id_to_path(branch_id))
+                if not last:
+                    continue
+                change, sha1 = last
+                if must_exist_local and not p4gf_util.sha1_exists(sha1):
+                    continue
+                if not best or best[0] < change:
+                    best = (change, sha1, branch_id)
+            if not best:
+                return None
+            return ObjectType.create_commit(best[1],
+                                            ctx.config.view_name,
+                                            best[0],
+                                            best[2])
+
         # if only one branch_id given, don't fetch them all
         if len(branch_ids) == 1:
             branch_id = branch_ids[0]
@@ -559,8 +471,16 @@ class ObjectType:
         if otl:
             otl = otl.ot_list
         else:
-            path = _commit_p4_path(sha1, '*', ctx.config.view_name, '*')
-            otl = _otl_for_p4path(ctx.p4gf, path)
+            index = _commit_index(ctx)
+            if index:
+                otl = [ObjectType.create_commit(sha1,
+                                                ctx.config.view_name,
+                                                str(change),
+                                                branch)
+                       for branch, change in index.commits_for_sha1(sha1)]
+            else:
+                path = _commit_p4_path(sha1, '*', ctx.config.view_name, '*')
+                otl = _otl_for_p4path(ctx.p4gf, path)
             ObjectType.object_cache.append(ObjectTypeList(sha1, otl))
         if not branch_id:
             return otl
@@ -596,7 +516,21 @@ class ObjectType:
                                             change,
                                             from_cache[0])
 
-        # not in cache, use index to find commit(s)
+        # not in cache, try local index
+        index = _commit_index(ctx)
+        if index:
+            result = None
+            for found_branch, found_sha1 in index.commits_for_change(change):
+                ObjectType.change_to_commit_cache.append(change, found_branch, found_sha1)
+                if branch_id and found_branch != _branch_id_to_path(branch_id):
+                    continue
+                if not result:
+                    result = (branch_id or found_branch, found_sha1)
+            if not result:
+                return None
+            return ObjectType.create_commit(result[1], ctx.config.view_name, change, result[0])
+
+        # no local index, use p4 keys to find commit(s)
         if not branch_id:
             branch_id = '*'
         key = "git-fusion-index-branch-{repo},{change},{branch}".format(repo=ctx.config.view_name,
@@ -625,8 +559,10 @@ class ObjectType:
     def update_indexes(ctx, r):
         '''
         Call with result of submit to update indexes in p4 keys
+        and our local commit index.
         Ignore trees, but update for any commits.
         '''
+        index = _commit_index(ctx, validate=False)
         for rr in r:
             if not 'depotFile' in rr:
                 continue
@@ -634,6 +570,12 @@ class ObjectType:
             commit = ObjectType.commit_from_filepath(depot_file)
             if commit:
                 ObjectType.update_last_change(ctx, commit)
+                if index:
+                    index.add(commit.sha1,
+                              commit.details.branch_id,
+                              commit.details.changelist)
+        if index:
+            index.commit()
 
     @staticmethod
     def update_last_change(ctx, commit):
@@ -730,9 +672,92 @@ def known_commit_sha1_list(ctx):
     '''
     Return a list of every known commit sha1 for the current repo.
     '''
+    index = _commit_index(ctx)
+    if index:
+        return index.all_sha1s()
     path = _commit_p4_path('*', '*', ctx.config.view_name, '*')
     return [_depot_path_to_commit_sha1(f) for f in _run_p4files(ctx.p4gf, path)]
 
+def known_commit_index(ctx):
+    '''
+    Return this repo's CommitIndex, up to date with the server, or None if
+    ctx has no view directory.
+    '''
+    return _commit_index(ctx)
+
+def _branch_id_to_path(branch_id):
+    '''
+    Return branch_id as it appears in a commit object's depot path.
+    '''
+    return branch_id.replace('/', '-')
+
+def _commit_index(ctx, validate=True):
+    '''
+    Return this repo's CommitIndex, or None if ctx has no view directory.
+
+    If validate, and we have not done so since the last reset_cache(),
+    bring the index up to date with the server's high-water mark.
+    '''
+    view_dirs = getattr(ctx, 'view_dirs', None)
+    if not view_dirs:
+        return None
+    path = os.path.join(view_dirs.view_container, NTR('commit_index.db'))
+    index = ObjectType.commit_index.get(path)
+    if not index:
+        index = CommitIndex(path)
+        ObjectType.commit_index[path] = index
+    if validate and path not in ObjectType.commit_index_validated:
+        _sync_commit_index(ctx, index)
+        ObjectType.commit_index_validated.add(path)
+    return index
+
+def _sync_commit_index(ctx, index):
+    '''
+    Compare the index's high-water mark to the highest changelist that
+    touched this repo's commit objects. If the server has newer commit
+    objects, add just those. If the server is somehow older (obliterated
+    and rebuilt?), rebuild the index from scratch.
+    '''
+    root = _commit_p4_path('*', '*', ctx.config.view_name, '*')
+    r = p4gf_util.p4run_logged(ctx.p4gf, ['changes', '-m1', '-s', 'submitted', root])
+    rr = p4gf_util.first_dict_with_key(r, 'change')
+    server_hwm = int(rr['change']) if rr else 0
+    local_hwm = index.high_water_mark
+    if server_hwm == local_hwm:
+        LOG.debug2('commit index current @{}'.format(local_hwm))
+        return
+    if server_hwm < local_hwm:
+        LOG.warning('commit index @{} newer than server @{}, rebuilding'
+                    .format(local_hwm, server_hwm))
+        index.clear()
+        local_hwm = 0
+    if local_hwm:
+        path = '{}@{},@{}'.format(root, local_hwm + 1, server_hwm)
+    else:
+        path = '{}@{}'.format(root, server_hwm)
+
+    added = removed = 0
+    r = p4gf_util.p4run_logged(ctx.p4gf, ['files', path], log_warnings=logging.DEBUG)
+    for rr in r:
+        if not (isinstance(rr, dict) and 'depotFile' in rr):
+            continue
+        m = OBJPATH_COMMIT_REGEX.search(rr['depotFile'])
+        if not m:
+            continue
+        args = ( m.group('slashed_sha1').replace('/', '')
+               , m.group('branch_id')
+               , m.group('changelist') )
+        if 'delete' in rr.get('action', ''):
+            index.remove(*args)
+            removed += 1
+        else:
+            index.add(*args)
+            added += 1
+    index.set_high_water_mark(server_hwm)
+    index.commit()
+    LOG.debug('commit index @{} ==> @{}: added={} removed={}'
+              .format(local_hwm, server_hwm, added, removed))
+
 def _otl_for_p4path(p4, path):
     '''
     Return list of ObjectType for files reported by p4 files <path>
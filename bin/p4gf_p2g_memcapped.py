@@ -4,18 +4,20 @@ from   collections import namedtuple, deque
 import logging
 
 #mport gc
-import hashlib
 import os
 import pygit2
 import re
-import shutil
-import tempfile
-import zlib
 
+from   p4gf_blob_writer   import BlobWriter, size_if_streamable
+from   p4gf_git_pack      import PackWriter
 import p4gf_branch
+import p4gf_config
 import p4gf_gc
 from   p4gf_p4changelist  import P4Changelist
 from   p4gf_p4file        import P4File
+from   p4gf_p2g_print_pool import PrintPool
+from   p4gf_print_digest_cache import PrintDigestCache
+from   p4gf_printed_rev_index import PrintedRevIndex
 import p4gf_proc
 import p4gf_progress_reporter as ProgressReporter
 import p4gf_tag
@@ -56,9 +58,9 @@ class P2GMemcapped:
     memory only while copying that one changelist, then forgotten to make room
     for the next changelist.
 
-    Record individual file revision ==> blob sha1 links as filesystem symbolic
-    links rather than in memory. Huge histories will have more file revisions
-    than we can hold in memory.
+    Record individual file revision ==> blob sha1 links in an on-disk
+    PrintedRevIndex rather than in memory. Huge histories will have more file
+    revisions than we can hold in memory.
     '''
 
     def __init__(self, p2g):
@@ -66,10 +68,18 @@ class P2GMemcapped:
         self.ctx = p2g.ctx
         self.p2g = p2g
 
-                        # Temp directory under which we store all
-                        # depot/dir/file#1 symlinks to 'p4 print'ed-and-blobbed
-                        # content.
-        self.symlink_dir = os.path.join(self.ctx.tempdir.name, 'printed_symlinks')
+                        # Temp file that records every depot/dir/file#1
+                        # we've 'p4 print'ed-and-blobbed, and its blob sha1.
+        self.printed_rev_index_path = os.path.join( self.ctx.tempdir.name
+                                                  , 'printed_revs.db' )
+        self.printed_rev_index      = None
+
+                        # (digest, size) ==> blob sha1, persists across runs.
+                        # Lazy-opened by _digest_cache() only if repo config
+                        # says print-dedup.
+        self.digest_cache      = None
+        self.digest_cache_path = os.path.join( self.ctx.view_dirs.view_container
+                                             , 'print_digests.db' )
 
                         # List of ChangeNumOnBranch
                         # Sorted by change_num, descending
@@ -81,6 +91,16 @@ class P2GMemcapped:
 
         self.print_handler = None
 
+                        # PrintPool of N connections, each with its own
+                        # PrintHandlerMC. Lazy-created by _print_pool() only
+                        # if repo config asks for more than one connection.
+        self.print_pool    = None
+
+                        # PackWriter shared by all PrintHandlerMC instances,
+                        # or None to write loose objects. Lazy-created by
+                        # _pack_writer() if repo config says print-to-pack.
+        self.pack_writer   = None
+
                         # int. Ratchets forward during _copy_one().
         self.highest_copied_change_num = 0
 
@@ -88,6 +108,7 @@ class P2GMemcapped:
         self.cnob_count         = 0
         self.printed_rev_count  = 0
         self.printed_byte_count = 0
+        self.deduped_rev_count  = 0     # blobbed from digest cache, not printed
 
                         # mark number (? real, fake ?) to ?
         self.mark_to_branch_id  = {}
@@ -146,7 +167,7 @@ class P2GMemcapped:
                 return
 
                         # Prepare for the loop over each changelist x branch.
-            p4gf_util.ensure_dir(self.symlink_dir)
+            self.printed_rev_index = PrintedRevIndex(self.printed_rev_index_path)
             self.p2g._fill_head_marks_from_current_heads()
             self.mark_to_branch_id = {}
             self.branch_id_to_temp_name \
@@ -180,6 +201,34 @@ class P2GMemcapped:
                 self.printed_byte_count = self.print_handler.total_byte_count
                 self.printed_rev_count  = self.print_handler.printed_rev_count
                 self.print_handler      = None
+            if self.print_pool:
+                self.printed_byte_count += self.print_pool.total_byte_count
+                self.printed_rev_count  += self.print_pool.printed_rev_count
+                self.print_pool.close()
+                self.print_pool         = None
+
+                        # git-fast-import cannot see our printed blobs
+                        # until their pack has an index.
+            if self.pack_writer:
+                self.pack_writer.finish()
+                LOG.debug('Printed {} blobs to {} packs.'
+                          .format( self.pack_writer.object_count
+                                 , self.pack_writer.pack_count ))
+                self.pack_writer        = None
+
+            LOG.debug('Recorded printed revisions in {}'
+                      .format(self.printed_rev_index_path))
+            self.printed_rev_index.close()
+            self.printed_rev_index      = None
+            if self.digest_cache:
+                LOG.debug('Digest cache: revs_deduped={} hits={} misses={}'
+                          ' stale={}'
+                          .format( self.deduped_rev_count
+                                 , self.digest_cache.hit_count
+                                 , self.digest_cache.miss_count
+                                 , self.digest_cache.stale_count ))
+                self.digest_cache.close()
+                self.digest_cache       = None
 
             self.p2g._log_memory(        'P2G_MC.copy() loop')
             p4gf_gc.report_growth ('after P2G_MC.copy() loop')
@@ -302,8 +351,10 @@ class P2GMemcapped:
             # +++ (and thus repsponse time) in generating incremental file
             # +++ revisions from any files stored using RCS deltas (aka most
             # +++ files).
+            #
+            # Skip any revision whose content we've already blobbed under
+            # some other depot path: same digest, same blob.
             with self.p2g.perf.timer[CALC_PRINT]:
-                depot_path_rev_list = []
                 for rr in filelog_results:
                     if (   (not isinstance(rr, dict))
                         or ('depotFile' not in rr)
@@ -312,12 +363,16 @@ class P2GMemcapped:
                     p4file = P4File.create_from_filelog(rr)
                     p4changelist.files.append(p4file)
 
-                    depot_path = rr['depotFile']
-                    rev        = rr['rev'][0]
-                    if self._already_printed(depot_path, rev):
+                digests = self._fstat_digests(p4changelist.files)
+                depot_path_rev_list = []
+                for p4file in p4changelist.files:
+                    if self._already_printed(p4file.depot_path, p4file.revision):
+                        continue
+                    if self._blob_from_digest(p4file, digests):
                         continue
                     depot_path_rev_list.append('{}#{},head'
-                                               .format(depot_path, rev))
+                                               .format( p4file.depot_path
+                                                      , p4file.revision ))
 
             rev_total = len(p4changelist.files)
             _debug2('Printing files.'
@@ -332,26 +387,35 @@ class P2GMemcapped:
 
             if depot_path_rev_list:
                 with self.p2g.perf.timer[PRINT2]:
-                    printhandler = self._print_handler()
                     server_can_unexpand = self.ctx.p4.server_level > 32
                     args = ["-a"]
                     if server_can_unexpand:
                         args.append("-k")
-                    cmd = ['print'] + args + depot_path_rev_list
-                    with p4gf_util.RawEncoding(self.ctx.p4)             \
-                    ,    p4gf_util.Handler(self.ctx.p4, printhandler)   \
-                    ,    self.ctx.p4.at_exception_level(P4.RAISE_ALL):
-                        self.ctx.p4run(cmd)
-                    printhandler.flush()
+                        # Multiple connections? Shard the print across them.
+                        # print_revs() returns only after all shards are
+                        # blobbed, so the index lookups below still see
+                        # every revision.
+                    if 1 < self._print_worker_count():
+                        self._print_pool().print_revs(args, depot_path_rev_list)
+                    else:
+                        printhandler = self._print_handler()
+                        cmd = ['print'] + args + depot_path_rev_list
+                        with p4gf_util.RawEncoding(self.ctx.p4)             \
+                        ,    p4gf_util.Handler(self.ctx.p4, printhandler)   \
+                        ,    self.ctx.p4.at_exception_level(P4.RAISE_ALL):
+                            self.ctx.p4run(cmd)
+                        printhandler.flush()
 
             # Find each file revision's blob sha1.
             for p4file in p4changelist.files:
-                symlink_path = _depot_rev_to_symlink(
-                                              depot_path  = p4file.depot_path
-                                            , rev         = p4file.revision
-                                            , symlink_dir = self.symlink_dir )
-                blob_path   = os.readlink(symlink_path)
-                p4file.sha1 = _blob_path_to_sha1(blob_path)
+                p4file.sha1 = self.printed_rev_index.get( p4file.depot_path
+                                                        , p4file.revision )
+                if not p4file.sha1:
+                    raise RuntimeError('no blob printed for {}#{}'
+                                       .format(p4file.depot_path, p4file.revision))
+                digest = digests.get(p4file.rev_path())
+                if digest:
+                    self.digest_cache.add(digest.md5, digest.size, p4file.sha1)
 
             # If we can copy the Git commit and its tree objects from
             # our gitmirror, do so.
@@ -483,20 +547,126 @@ class P2GMemcapped:
             self.print_handler = PrintHandlerMC(
                                       need_unexpand = not server_can_unexpand
                                     , tempdir       = self.ctx.tempdir.name
-                                    , symlink_dir   = self.symlink_dir
-                                    , p4            = self.ctx.p4 )
+                                    , rev_index     = self.printed_rev_index
+                                    , p4            = self.ctx.p4
+                                    , pack_writer   = self._pack_writer() )
         return self.print_handler
 
+    def _pack_writer(self):
+        '''
+        If repo config says print-to-pack, lazy create and return our
+        PackWriter. If not, return None to write loose objects.
+        '''
+        if not self.pack_writer:
+            config = p4gf_config.get_repo(self.ctx.p4gf, self.ctx.config.view_name)
+            if config.getboolean( p4gf_config.SECTION_REPO
+                                , p4gf_config.KEY_PRINT_TO_PACK
+                                , fallback = False ):
+                self.pack_writer = PackWriter()
+        return self.pack_writer
+
+    def _print_worker_count(self):
+        '''
+        How many concurrent connections should 'p4 print' use?
+        From repo config, defaulting to global config, defaulting to 1.
+        '''
+        config = p4gf_config.get_repo(self.ctx.p4gf, self.ctx.config.view_name)
+        try:
+            return config.getint( p4gf_config.SECTION_REPO
+                                , p4gf_config.KEY_PRINT_WORKER_COUNT
+                                , fallback = 1 )
+        except ValueError:
+            LOG.warn('{} config setting has invalid value, defaulting to 1'
+                     .format(p4gf_config.KEY_PRINT_WORKER_COUNT))
+            return 1
+
+    def _print_pool(self):
+        '''
+        Lazy create our PrintPool, one PrintHandlerMC per connection.
+        '''
+        if not self.print_pool:
+            server_can_unexpand = self.ctx.p4.server_level > 32
+
+            def handler_factory(p4):
+                '''Each worker connection gets its own handler.'''
+                return PrintHandlerMC( need_unexpand = not server_can_unexpand
+                                     , tempdir       = self.ctx.tempdir.name
+                                     , rev_index     = self.printed_rev_index
+                                     , p4            = p4
+                                     , pack_writer   = self._pack_writer() )
+
+            self.print_pool = PrintPool( ctx             = self.ctx
+                                       , worker_count    = self._print_worker_count()
+                                       , handler_factory = handler_factory )
+        return self.print_pool
+
+    def _digest_cache(self):
+        '''
+        If repo config says print-dedup, lazy open and return our
+        PrintDigestCache. If not, return None.
+        '''
+        if not self.digest_cache:
+            config = p4gf_config.get_repo(self.ctx.p4gf, self.ctx.config.view_name)
+            if config.getboolean( p4gf_config.SECTION_REPO
+                                , p4gf_config.KEY_PRINT_DEDUP
+                                , fallback = True ):
+                self.digest_cache = PrintDigestCache(self.digest_cache_path)
+        return self.digest_cache
+
+    def _fstat_digests(self, p4file_list):
+        '''
+        Return a dict of depot_path#rev ==> DigestSize for every file
+        revision whose digest can stand in for its printed content.
+
+        One 'p4 fstat -Ol' for the whole list. Return an empty dict if
+        print-dedup is disabled.
+        '''
+        if not self._digest_cache():
+            return {}
+        rev_paths = [p4file.rev_path() for p4file in p4file_list
+                     if _digest_matches_content(p4file)]
+        if not rev_paths:
+            return {}
+        cmd = [ 'fstat', '-Ol'
+              , '-T', 'depotFile,headRev,digest,fileSize'
+              ] + rev_paths
+        with self.ctx.p4.at_exception_level(P4.RAISE_NONE):
+            r = self.ctx.p4run(cmd)
+        result = {}
+        for rr in r:
+            if (   (not isinstance(rr, dict))
+                or ('digest'   not in rr)
+                or ('fileSize' not in rr)):
+                continue
+            rev_path = '{}#{}'.format(rr['depotFile'], rr['headRev'])
+            result[rev_path] = DigestSize( md5  = rr['digest']
+                                         , size = int(rr['fileSize']) )
+        _debug2('fstat -Ol digests: {} of {}', len(result), len(p4file_list))
+        return result
+
+    def _blob_from_digest(self, p4file, digests):
+        '''
+        If we've already blobbed content with this file revision's digest,
+        record that blob as this revision's blob and return True.
+        Return False if we must print this revision.
+        '''
+        digest = digests.get(p4file.rev_path())
+        if not digest:
+            return False
+        sha1 = self.digest_cache.get(digest.md5, digest.size)
+        if not sha1:
+            return False
+        self.printed_rev_index.add(p4file.depot_path, p4file.revision, sha1)
+        self.deduped_rev_count += 1
+        _debug3('Deduped {} {}', sha1, p4file.rev_path())
+        return True
+
     def _already_printed(self, depot_path, rev):
         '''
         Have we already printed this file revision?
         '''
-        symlink_path = _depot_rev_to_symlink(
-                                      depot_path  = depot_path
-                                    , rev         = rev
-                                    , symlink_dir = self.symlink_dir )
-        e = os.path.islink(symlink_path)
-        _debug3('_already_printed={} {}', 1 if e else 0, symlink_path)
+        e = self.printed_rev_index.contains(depot_path, rev)
+        _debug3('_already_printed={} {}#{}', 1 if e else 0, depot_path, rev)
         return e
 
 # -- end class P2GMemCapped ---------------------------------------------------
@@ -509,18 +679,20 @@ class P2GMemcapped:
 class PrintHandlerMC(OutputHandler):
 
     """OutputHandler for p4 print, hashes files into git repo"""
-    def __init__(self, need_unexpand, tempdir, symlink_dir, p4):
+    def __init__(self, need_unexpand, tempdir, rev_index, p4, pack_writer=None):
         OutputHandler.__init__(self)
         self.rev = None
         self.need_unexpand = need_unexpand
-        self.tempfile = None
+        self.blob_writer = None
+        self.pack_writer = pack_writer
         self.tempdir = tempdir
-        self.symlink_dir = symlink_dir
+        self.rev_index = rev_index
         self.p4 = p4
 
                         # Instrumentation
-        self.total_byte_count  = 0
-        self.printed_rev_count = 0
+        self.total_byte_count   = 0
+        self.printed_rev_count  = 0
+        self.streamed_rev_count = 0     # hashed as received, never spooled
 
     def outputBinary(self, h):
         """assemble file content, then pass it to hasher via temp file"""
@@ -558,95 +730,47 @@ class PrintHandlerMC(OutputHandler):
         return OutputHandler.HANDLED
 
     def appendContent(self, h):
-        """append a chunk of content to the temp file
+        """append a chunk of content to the blob writer
 
         if server is 12.1 or older it may be sending expanded ktext files
         so we need to unexpand them.  Note that ktext can come through
         either outputBinary or outputText.
 
-        It would be nice to incrementally compress and hash the file
-        but that requires knowing the size up front, which p4 print does
-        not currently supply.  If/when it does, this can be reworked to
-        be more efficient with large files.  As it is, as long as the
-        TemporaryFile doesn't rollover, it won't make much of a difference.
-
-        So with that limitation, the incoming content is stuffed into
-        a TemporaryFile.
+        When outputStat() found a usable fileSize, the BlobWriter is
+        already hashing and compressing as content arrives. Otherwise it
+        spools content until flush().
         """
         if not len(h):
             return
         if self.need_unexpand and self.rev.is_k_type():
             h = unexpand(h)
-        self.tempfile.write(h)
+        self.blob_writer.write(h)
 
     def flush(self):
-        """compress the last file, hash it and stick it in the repo
+        """finish the last file's blob and stick it in the repo
 
-        Now that we've got the complete file contents, the header can be
-        created and used along with the spooled content to create the sha1
-        and zlib compressed blob content.  Finally that is written into
-        the .git/objects dir.
+        Now that we've got the complete file contents, the BlobWriter can
+        finish its sha1 and zlib compressed blob content, and write that
+        into the .git/objects dir.
         """
         if not self.rev:
             return
-        size = self.tempfile.tell()
-        if size > 0 and self.rev.is_symlink():
+        if self.rev.is_symlink():
             # p4 print adds a trailing newline, which is no good for symlinks.
-            self.tempfile.seek(-1, 2)
-            b = self.tempfile.read(1)
-            if b[0] == 10:
-                size = self.tempfile.truncate(size - 1)
-        self.tempfile.seek(0)
-        self.total_byte_count += size
+            self.blob_writer.trim_trailing_newline()
+        self.total_byte_count += self.blob_writer.byte_count
         self.printed_rev_count += 1
-        compressed = tempfile.NamedTemporaryFile(delete=False, dir=self.tempdir,
-                                                 prefix='p2g-blob-')
-        compress = zlib.compressobj()
-        # pylint doesn't understand dynamic definition of sha1 in hashlib
-        # pylint: disable=E1101
-        sha1 = hashlib.sha1()
-
-        # pylint:disable=W1401
-        # disable complaints about the null. We need that.
-        # add header first
-        header = ("blob " + str(size) + "\0").encode()
-        compressed.write(compress.compress(header))
-        sha1.update(header)
-
-        # then actual contents
-        chunksize = 4096
-        while True:
-            chunk = self.tempfile.read(chunksize)
-            if chunk:
-                compressed.write(compress.compress(chunk))
-                sha1.update(chunk)
-            else:
-                break
-        # pylint: enable=E1101
-        compressed.write(compress.flush())
-        compressed.close()
-        digest = sha1.hexdigest()
-        self.rev.sha1 = digest
-        blob_path_tuple = _sha1_to_blob_path_tuple(self.rev.sha1)
-        if not os.path.exists(blob_path_tuple.path):
-            if not os.path.exists(blob_path_tuple.dir):
-                os.makedirs(blob_path_tuple.dir)
-            shutil.move(compressed.name, blob_path_tuple.path)
-        else:
-            os.remove(compressed.name)
+        if self.blob_writer.is_streaming:
+            self.streamed_rev_count += 1
+        self.rev.sha1 = self.blob_writer.close()
+        self.blob_writer = None
         #self.revs.append(self.rev)
-        symlink_path = _depot_rev_to_symlink( depot_path  = self.rev.depot_path
-                                            , rev         = self.rev.revision
-                                            , symlink_dir = self.symlink_dir )
-        p4gf_util.ensure_parent_dir(symlink_path)
-
-        e = os.path.islink(symlink_path)
-        if not e:
-            os.symlink(blob_path_tuple.path, symlink_path)
-
-        _debug3('Printed {e} {blob} @{ch:<5} {rev:<50} {symlink}'
-               , blob    = blob_path_tuple.path
-               , symlink = symlink_path
+        e = not self.rev_index.add( self.rev.depot_path
+                                  , self.rev.revision
+                                  , self.rev.sha1 )
+
+        _debug3('Printed {e} {blob} @{ch:<5} {rev:<50}'
+               , blob    = self.rev.sha1
                , rev     = self.rev.rev_path()
                , ch      = self.rev.change
                , e       = 'e' if e else ' ')
@@ -673,12 +797,14 @@ class PrintHandlerMC(OutputHandler):
         #       , self.rev.depot_path
         #       , self.rev.revision )
 
-        if self.tempfile:
-            self.tempfile.seek(0)
-            self.tempfile.truncate()
-        else:
-            self.tempfile = tempfile.TemporaryFile(buffering=10000000, dir=self.tempdir,
-                                                   prefix='p2g-print-')
+        size = size_if_streamable( vardict       = h
+                                 , p4file        = self.rev
+                                 , need_unexpand = self.need_unexpand
+                                 , charset       = self.p4.charset )
+        self.blob_writer = BlobWriter( tempdir     = self.tempdir
+                                     , size        = size
+                                     , objects_dir = BLOB_PATH_PREFIX
+                                     , pack_writer = self.pack_writer )
         return OutputHandler.HANDLED
 
     def outputInfo(self, _h):
@@ -691,15 +817,23 @@ class PrintHandlerMC(OutputHandler):
                         # pylint:enable=C0103,R0201
 
 
-def _depot_rev_to_symlink(depot_path, rev, symlink_dir):
+def _digest_matches_content(p4file):
     '''
-    Return {symlink_dir}/depot/dir/file#1
+    Does the server's MD5 digest of this file revision describe the same
+    bytes that we'd hash after 'p4 print'?
 
-    This is the symlink that we create upon printing a file, points to the
-    Git blob file that holds the file's zlibbed content.
+    Not for deleted revisions (no content), symlinks (we trim their trailing
+    newline), keyword types (digest vs. expanded or unexpanded keywords),
+    or unicode/utf16 types (charset translation).
     '''
-    depot_ish = '{}#{}'.format(depot_path[2:], rev)
-    return os.path.join(symlink_dir, depot_ish)
+    return not (   p4file.is_delete()
+                or p4file.is_symlink()
+                or p4file.is_k_type()
+                or p4file.is_unicode())
+
+
+# Digest and size of one file revision's content, from 'p4 fstat -Ol'.
+DigestSize = namedtuple('DigestSize', ['md5', 'size'])
 
 
 # Element of change_num_on_branch_list, always sorted by change_num.
@@ -766,31 +900,8 @@ def _debug2(msg, *arg, **kwarg):
         LOG.debug2(msg.format(*arg, **kwarg))
 
 
-BlobPathTuple = namedtuple('BlobPathTuple', ['sha1', 'dir', 'file', 'path'])
 BLOB_PATH_PREFIX = '.git/objects/'
 
-def _sha1_to_blob_path_tuple(sha1):
-    '''
-    Return a BlobPathTuple where the blob file should go.
-
-    path is a RELATIVE path ".git/objects/xx/x{38}"
-    '''
-    blob_dir  = BLOB_PATH_PREFIX + sha1[:2]
-    blob_file = sha1[2:]
-    blob_path = blob_dir+"/"+blob_file
-    return BlobPathTuple( sha1 = sha1
-                        , dir  = blob_dir
-                        , file = blob_file
-                        , path = blob_path )
-
-
-def _blob_path_to_sha1(path):
-    '''
-    Convert a BlobPathTuple.path back to its original sha1.
-    '''
-    assert path.startswith(BLOB_PATH_PREFIX)
-    return path[len(BLOB_PATH_PREFIX):].replace('/', '')
-
 
 OVERALL     = "P4 to Git Overall"
 CHANGES     = "p4 changes"
@@ -1,19 +1,18 @@
 #! /usr/bin/env python3.3
 '''PrintHandler'''
 
-import binascii
 import os
 import logging
-import tempfile
 
 from P4 import OutputHandler, P4Exception
 
-import p4gf_git
+from   p4gf_blob_writer           import BlobWriter, size_if_streamable
+import p4gf_config
+from   p4gf_git_pack              import PackWriter
 from   p4gf_l10n                  import _
 from   p4gf_p2g_rev_list          import RevList
 from   p4gf_p4file                import P4File
 import p4gf_progress_reporter     as     ProgressReporter
-import p4gf_util
 
 LOG = logging.getLogger('p4gf_copy_to_git').getChild('print_handler')
 
@@ -28,13 +27,21 @@ class PrintHandler(OutputHandler):
         OutputHandler.__init__(self)
         self.rev = None
         self.revs = RevList()
-        self.tempfile = None
+        self.blob_writer = None
         self.p4 = ctx.p4
         self.p4gf = ctx.p4gf
         self.change_set = set()
         self.repo = ctx.view_repo
         self.ctx  = ctx
 
+        # Append blobs to a packfile rather than write loose objects?
+        self.pack_writer = None
+        config = p4gf_config.get_repo(ctx.p4gf, ctx.config.view_name)
+        if config.getboolean( p4gf_config.SECTION_REPO
+                            , p4gf_config.KEY_PRINT_TO_PACK
+                            , fallback = False ):
+            self.pack_writer = PackWriter(git_dir = ctx.view_dirs.GIT_DIR)
+
     def outputBinary(self, h):
         """assemble file content, then pass it to hasher via temp file"""
         self.appendContent(h)
@@ -71,55 +78,39 @@ class PrintHandler(OutputHandler):
         return OutputHandler.HANDLED
 
     def appendContent(self, h):
-        """append a chunk of content to the temp file
-
-        It would be nice to incrementally compress and hash the file
-        but that requires knowing the size up front, which p4 print does
-        not currently supply.  If/when it does, this can be reworked to
-        be more efficient with large files.  As it is, as long as the
-        TemporaryFile doesn't rollover, it won't make much of a difference.
+        """append a chunk of content to the blob writer
 
-        So with that limitation, the incoming content is stuffed into
-        a TemporaryFile.
+        When outputStat() found a usable fileSize, the BlobWriter is
+        already hashing and compressing as content arrives. Otherwise it
+        spools content until flush().
         """
         if not len(h):
             return
-        self.tempfile.write(h)
+        self.blob_writer.write(h)
 
     def flush(self):
-        """compress the last file, hash it and stick it in the repo
+        """finish the last file's blob and stick it in the repo
 
-        Now that we've got the complete file contents, the header can be
-        created and used along with the spooled content to create the sha1
-        and zlib compressed blob content.  Finally that is written into
-        the .git/objects dir.
+        Now that we've got the complete file contents, the BlobWriter can
+        finish its sha1 and zlib compressed blob content, and write that
+        into the .git/objects dir.
         """
         if not self.rev:
             return
-        size = self.tempfile.tell()
-        if size > 0 and self.rev.is_symlink():
+        if self.rev.is_symlink():
             # p4 print adds a trailing newline, which is no good for symlinks.
-            self.tempfile.seek(-1, 2)
-            b = self.tempfile.read(1)
-            if b[0] == 10:
-                size = self.tempfile.truncate(size - 1)
-        self.tempfile.close()
+            self.blob_writer.trim_trailing_newline()
         # pylint:disable=W0703
         # Catching too general exception Exception
         try:
-            tmpname = os.path.basename(self.tempfile.name)
-            oid = self.repo.create_blob_fromfile(tmpname)
-            self.rev.sha1 = binascii.hexlify(oid).decode()
+            self.rev.sha1 = self.blob_writer.close()
             self.revs.append(self.rev)
-            self._chmod_644_minimum(self.rev.sha1)
         except Exception as e:
             LOG.error('failed to write blob to repository: {}'.format(e))
+            self.blob_writer.discard()
         finally:
-            try:
-                os.unlink(self.tempfile.name)
-            finally:
-                self.tempfile = None
-                self.rev = None
+            self.blob_writer = None
+            self.rev = None
         # pylint:enable=W0703
 
     def outputStat(self, h):
@@ -130,12 +121,25 @@ class PrintHandler(OutputHandler):
         ProgressReporter.increment(_('Copying files'))
         LOG.debug2("PrintHandler.outputStat() ch={} {}#{}".format(
             self.rev.change, self.rev.depot_path, self.rev.revision))
-        # use the git working tree so we can use create_blob_fromfile()
-        tmpdir = os.getcwd()
-        self.tempfile = tempfile.NamedTemporaryFile(
-            buffering=10000000, prefix='p2g-print-', dir=tmpdir, delete=False)
+        size = size_if_streamable( vardict = h
+                                 , p4file  = self.rev
+                                 , charset = self.p4.charset )
+        self.blob_writer = BlobWriter(
+                  tempdir     = self.ctx.tempdir.name
+                , size        = size
+                , objects_dir = os.path.join(self.ctx.view_dirs.GIT_DIR, 'objects')
+                , pack_writer = self.pack_writer )
         return OutputHandler.HANDLED
 
+    def close(self):
+        """finish the last file, and if writing to a pack, index that pack
+
+        Printed blobs are not visible to git-fast-import until close().
+        """
+        self.flush()
+        if self.pack_writer:
+            self.pack_writer.finish()
+
     def outputInfo(self, _h):
         """outputInfo call not expected"""
         return OutputHandler.REPORT
@@ -144,21 +148,4 @@ class PrintHandler(OutputHandler):
         """outputMessage call not expected, indicates an error"""
         return OutputHandler.REPORT
 
-    def _chmod_644_minimum(self, sha1):
-        '''
-        pygit2 created a blob. If that blob is a loose object,
-        make sure that loose object's file has at least file mode 644
-        so that we (owner) has read+write, and the world has read access.
-
-        Don't raise/abort if this fails due to file not found. Assume that
-        is due to the blob landing in a packfile.
-        '''
-        blob_path = os.path.join( self.ctx.view_dirs.GIT_WORK_TREE
-                                , p4gf_git.object_path(sha1))
-        try:
-            p4gf_util.chmod_644_minimum(blob_path)
-        except OSError as e:
-            LOG.warn("chmod 644 failed path={path} err={e}"
-                     .format(blob_path, e=e))
-
 # pylint: enable=C0103,R0201
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3.3
+'''
+A pool of worker threads, each with its own P4 connection, that shards
+'p4 print' requests across multiple connections.
+
+A single P4 connection serializes every 'p4 print' request: the Perforce
+server streams one file revision after another, and we hash and compress
+each one before asking for the next. For very long histories that single
+stream is the bottleneck of the whole P4-to-Git copy.
+
+PrintPool splits each list of depot_path#rev into one contiguous shard per
+worker and prints all shards concurrently. Each worker feeds its own
+PrintHandlerMC, and all handlers write into the same .git/objects store.
+print_revs() does not return until every shard is printed and flushed, so
+callers see the same ordering guarantee as a single 'p4 print': every
+requested revision is blobbed before print_revs() returns.
+'''
+import logging
+import queue
+import threading
+
+from P4 import P4
+
+import p4gf_create_p4
+from   p4gf_l10n      import _, NTR
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # Sentinel that tells a worker thread to exit.
+_STOP = None
+
+
+class PrintPool:
+    '''
+    N worker threads, each with its own P4 connection and print handler.
+
+    Lazy-connects workers upon first print_revs(). Call close() when done
+    to disconnect all worker connections.
+    '''
+
+    def __init__(self, ctx, worker_count, handler_factory):
+        '''
+        handler_factory is a function that accepts a P4 connection and
+        returns a new P4.OutputHandler that prints revisions fetched over
+        that connection. Each handler must have a flush() method, and
+        total_byte_count and printed_rev_count instrumentation members.
+        '''
+        self.ctx             = ctx
+        self.worker_count    = max(1, int(worker_count))
+        self.handler_factory = handler_factory
+
+        self._work_queue     = queue.Queue()
+        self._done_queue     = queue.Queue()
+        self._workers        = []
+
+    def __str__(self):
+        return NTR('PrintPool workers={}').format(self.worker_count)
+
+    @property
+    def total_byte_count(self):
+        '''Sum of bytes printed by all workers.'''
+        return sum(w.handler.total_byte_count for w in self._workers)
+
+    @property
+    def printed_rev_count(self):
+        '''Sum of file revisions printed by all workers.'''
+        return sum(w.handler.printed_rev_count for w in self._workers)
+
+    def print_revs(self, args, depot_path_rev_list):
+        '''
+        p4 print {args} {depot_path_rev_list}, sharded across all workers.
+
+        Blocks until every shard completes. If any worker fails, raises
+        that worker's exception after the remaining shards complete.
+        '''
+        if not depot_path_rev_list:
+            return
+        self._start()
+        shard_list = _shard(depot_path_rev_list, self.worker_count)
+        LOG.debug2('print_revs() rev_ct={} shard_ct={}'
+                   .format(len(depot_path_rev_list), len(shard_list)))
+        for shard in shard_list:
+            self._work_queue.put((args, shard))
+
+        err = None
+        for _i in range(len(shard_list)):
+            e = self._done_queue.get()
+            if e and not err:
+                err = e
+        if err:
+            raise err
+
+    def close(self):
+        '''
+        Stop all worker threads and disconnect their P4 connections.
+        '''
+        for _w in self._workers:
+            self._work_queue.put(_STOP)
+        for w in self._workers:
+            w.thread.join()
+            w.disconnect()
+        self._workers = []
+
+    def _start(self):
+        '''
+        Lazy-create our worker threads and their connections.
+
+        Connections are created here, in the calling thread, so that
+        p4gf_create_p4's connection list is never modified concurrently.
+        '''
+        if self._workers:
+            return
+        for i in range(self.worker_count):
+            p4 = p4gf_create_p4.create_p4( port   = self.ctx.config.p4port
+                                         , user   = self.ctx.config.p4user
+                                         , client = self.ctx.config.p4client )
+            if not p4:
+                raise RuntimeError(_('PrintPool: unable to connect worker {}')
+                                   .format(i))
+            if self.ctx.p4.charset:
+                p4.charset = self.ctx.p4.charset
+            worker = _Worker( p4         = p4
+                            , handler    = self.handler_factory(p4)
+                            , work_queue = self._work_queue
+                            , done_queue = self._done_queue )
+            worker.thread = threading.Thread(
+                                  target = worker.run
+                                , name   = NTR('p4gf-print-{}').format(i)
+                                , daemon = True )
+            worker.thread.start()
+            self._workers.append(worker)
+        LOG.debug('started {}'.format(self))
+
+# -- end class PrintPool ------------------------------------------------------
+
+
+class _Worker:
+    '''
+    One worker thread's connection, print handler, and main loop.
+    '''
+
+    def __init__(self, p4, handler, work_queue, done_queue):
+        self.p4         = p4
+        self.handler    = handler
+        self.work_queue = work_queue
+        self.done_queue = done_queue
+        self.thread     = None
+
+    def run(self):
+        '''
+        Print each shard we pull from the work queue. Report completion,
+        or the exception that prevented completion, to the done queue.
+        '''
+        while True:
+            item = self.work_queue.get()
+            if item is _STOP:
+                return
+            (args, shard) = item
+                        # pylint:disable=W0703
+                        # Catching too general exception
+                        # Must report every failure back to print_revs(),
+                        # otherwise the calling thread waits forever.
+            try:
+                self._print(args, shard)
+                self.done_queue.put(None)
+            except Exception as e:
+                LOG.error('print worker {} failed: {}'
+                          .format(self.thread.name, e))
+                self.done_queue.put(e)
+                        # pylint:enable=W0703
+
+    def _print(self, args, shard):
+        '''
+        p4 print one shard into our handler.
+        '''
+        cmd = ['print'] + args + shard
+        with p4gf_util.RawEncoding(self.p4)             \
+        ,    p4gf_util.Handler(self.p4, self.handler)   \
+        ,    self.p4.at_exception_level(P4.RAISE_ALL):
+            p4gf_util.p4run_logged(self.p4, cmd)
+        self.handler.flush()
+
+    def disconnect(self):
+        '''
+        Close our connection.
+        '''
+        if self.p4.connected():
+            p4gf_create_p4.p4_disconnect(self.p4)
+        p4gf_create_p4.unregister(self.p4)
+        self.p4 = None
+
+# -- end class _Worker --------------------------------------------------------
+
+
+def _shard(lizt, shard_ct):
+    '''
+    Split lizt into at most shard_ct contiguous, non-empty sub-lists.
+
+    Contiguous rather than round-robin so that consecutive revisions of the
+    same file stay on the same connection, where the Perforce server can
+    reuse its work reconstructing RCS deltas.
+    '''
+    shard_ct = min(shard_ct, len(lizt))
+    size, extra = divmod(len(lizt), shard_ct)
+    result = []
+    start = 0
+    for i in range(shard_ct):
+        end = start + size + (1 if i < extra else 0)
+        result.append(lizt[start:end])
+        start = end
+    return result
@@ -188,6 +188,11 @@ class P4File:
         """return True if file is a symlink type"""
         return self.type.startswith("symlink")
 
+    def is_unicode(self):
+        """return True if file content is subject to charset translation"""
+        base = update_type_string(self.type).split('+')[0]
+        return base in ['unicode', 'utf16', 'utf8']
+
     def equal(self, path, rev):
         """compare this object to the given path and revision"""
         if not isinstance(rev, int):
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3.3
+'''
+Remember which Git blob holds the content that has a given Perforce digest.
+
+Branch-heavy depots store the same file content under dozens of depot
+branches. Lazy copies share the very same archive file. 'p4 print' does not
+know that: it sends the same content once per depot_path#rev.
+
+The Perforce server already knows each revision's MD5 digest and size, and
+'p4 fstat -Ol' reports them cheaply in bulk. If we have already blobbed
+content with the same (digest, size), we need not print it again: reuse
+that blob's sha1.
+
+PrintDigestCache stores (digest, size) ==> blob sha1 in a SQLite file under
+the repo's view directory, so it persists across runs. Entries recorded by
+an earlier run are trusted only if their blob still exists in this repo's
+object store: someone might have deleted and rebuilt the repo since then.
+'''
+import binascii
+import logging
+import sqlite3
+import threading
+import time
+
+from   p4gf_l10n      import NTR
+import p4gf_git
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # SQLite page cache, in KiB (negative cache_size).
+_CACHE_KIB = 4 * 1024
+
+
+class PrintDigestCache:
+    '''
+    (digest, size) ==> blob sha1, stored in a single SQLite file.
+
+    Thread-safe.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        p4gf_util.ensure_parent_dir(db_path)
+        self._lock    = threading.Lock()
+        self._db      = sqlite3.connect(db_path, check_same_thread=False)
+                        # Rows written during this run point to blobs we
+                        # just wrote, possibly into a pack whose index does
+                        # not yet exist. Trust those without checking.
+        self._session = int(time.time() * 1000)
+        self._db.execute(NTR('PRAGMA synchronous = OFF'))
+        self._db.execute(NTR('PRAGMA cache_size = {}').format(-_CACHE_KIB))
+        self._db.execute(NTR('CREATE TABLE IF NOT EXISTS digest'
+                             ' ( md5     TEXT    NOT NULL'
+                             ' , size    INTEGER NOT NULL'
+                             ' , sha1    BLOB    NOT NULL'
+                             ' , session INTEGER NOT NULL'
+                             ' , PRIMARY KEY (md5, size) )'))
+
+                        # Instrumentation
+        self.hit_count   = 0
+        self.miss_count  = 0
+        self.stale_count = 0
+
+    def get(self, md5, size):
+        '''
+        Return the 40-char hex sha1 of a blob that holds content with this
+        digest and size, or None if we have no such blob.
+        '''
+        md5 = md5.upper()
+        with self._lock:
+            row = self._db.execute(
+                          NTR('SELECT sha1, session FROM digest'
+                              ' WHERE md5 = ? AND size = ?')
+                        , (md5, int(size))).fetchone()
+        if not row:
+            self.miss_count += 1
+            return None
+        sha1 = binascii.hexlify(row[0]).decode()
+        if row[1] != self._session and not p4gf_git.object_exists(sha1):
+            LOG.debug('stale digest cache entry {} {} ==> {}'
+                      .format(md5, size, sha1))
+            self.stale_count += 1
+            with self._lock:
+                self._db.execute( NTR('DELETE FROM digest'
+                                      ' WHERE md5 = ? AND size = ?')
+                                , (md5, int(size)))
+            return None
+        self.hit_count += 1
+        return sha1
+
+    def add(self, md5, size, sha1):
+        '''
+        Record that blob sha1 holds content with this digest and size.
+        '''
+        with self._lock:
+            self._db.execute( NTR('INSERT OR REPLACE INTO digest'
+                                  ' VALUES (?, ?, ?, ?)')
+                            , ( md5.upper(), int(size)
+                              , binascii.unhexlify(sha1), self._session ))
+
+    def commit(self):
+        '''Write pending changes to disk.'''
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        '''Commit and close.'''
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+# -- end class PrintDigestCache -----------------------------------------------
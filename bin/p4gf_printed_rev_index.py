@@ -0,0 +1,248 @@
+#! /usr/bin/env python3.3
+'''
+Record which depot_path#rev we've already 'p4 print'ed, and to which blob.
+
+P2GMemcapped must remember every file revision it has printed, but huge
+histories have more file revisions than we can hold in memory. It used to
+record each one as a filesystem symlink {dir}/depot/path#rev --> blob path:
+one inode and several directory entries per revision, and once the kernel's
+dentry cache is exhausted each lookup or create is a cold disk seek.
+
+PrintedRevIndex stores the same mapping in a single SQLite table keyed by
+(depot_path, rev) with a 20-byte binary sha1 value. SQLite's page cache is
+bounded, so memory stays bounded no matter how many revisions we record.
+
+SymlinkRevIndex keeps the old symlink implementation behind the same
+interface, for comparison. Run this module to benchmark one against the
+other:
+
+    p4gf_printed_rev_index.py --count 1000000 --dir /tmp/bench
+'''
+import binascii
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from   p4gf_l10n      import _, NTR
+import p4gf_util
+
+LOG = logging.getLogger(__name__)
+
+                        # Commit pending inserts after this many.
+                        # Keeps the journal small without paying for a
+                        # transaction per revision.
+_COMMIT_INTERVAL = 10000
+
+                        # SQLite page cache, in KiB (negative cache_size).
+_CACHE_KIB = 16 * 1024
+
+
+class PrintedRevIndex:
+    '''
+    depot_path#rev ==> blob sha1, stored in a single SQLite file.
+
+    Thread-safe: PrintPool workers may add() concurrently.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        p4gf_util.ensure_parent_dir(db_path)
+        self._lock    = threading.Lock()
+        self._db      = sqlite3.connect(db_path, check_same_thread=False)
+        self._pending = 0
+                        # This is a scratch index for one copy. Durability
+                        # across power failure buys us nothing.
+        self._db.execute(NTR('PRAGMA journal_mode = OFF'))
+        self._db.execute(NTR('PRAGMA synchronous = OFF'))
+        self._db.execute(NTR('PRAGMA cache_size = {}').format(-_CACHE_KIB))
+        self._db.execute(NTR('CREATE TABLE IF NOT EXISTS printed'
+                             ' ( depot_path TEXT    NOT NULL'
+                             ' , rev        INTEGER NOT NULL'
+                             ' , sha1       BLOB    NOT NULL'
+                             ' , PRIMARY KEY (depot_path, rev) )'))
+
+    def add(self, depot_path, rev, sha1):
+        '''
+        Record that depot_path#rev printed to blob sha1 (40-char hex).
+        Return False if already recorded, True if newly recorded.
+        '''
+        with self._lock:
+            cur = self._db.execute(
+                          NTR('INSERT OR IGNORE INTO printed VALUES (?, ?, ?)')
+                        , (depot_path, int(rev), binascii.unhexlify(sha1)))
+            self._pending += 1
+            if _COMMIT_INTERVAL <= self._pending:
+                self._commit_locked()
+            return cur.rowcount == 1
+
+    def get(self, depot_path, rev):
+        '''
+        Return the 40-char hex sha1 of depot_path#rev's blob,
+        or None if never printed.
+        '''
+        with self._lock:
+            row = self._db.execute(
+                          NTR('SELECT sha1 FROM printed'
+                              ' WHERE depot_path = ? AND rev = ?')
+                        , (depot_path, int(rev))).fetchone()
+        if not row:
+            return None
+        return binascii.hexlify(row[0]).decode()
+
+    def contains(self, depot_path, rev):
+        '''Have we already printed depot_path#rev?'''
+        return self.get(depot_path, rev) is not None
+
+    def commit(self):
+        '''Flush pending inserts.'''
+        with self._lock:
+            self._commit_locked()
+
+    def _commit_locked(self):
+        '''Flush pending inserts. Caller must hold self._lock.'''
+        if self._pending:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        '''Flush and close.'''
+        with self._lock:
+            self._commit_locked()
+            self._db.close()
+            self._db = None
+
+# -- end class PrintedRevIndex ------------------------------------------------
+
+
+class SymlinkRevIndex:
+    '''
+    depot_path#rev ==> blob sha1, stored as one symlink per revision:
+
+        {symlink_dir}/depot/dir/file#1 --> .git/objects/xx/x{38}
+
+    The original P2GMemcapped implementation. Retained for benchmarks.
+    '''
+
+    def __init__(self, symlink_dir):
+        self.symlink_dir = symlink_dir
+
+    def _path(self, depot_path, rev):
+        '''Return {symlink_dir}/depot/dir/file#1'''
+        depot_ish = NTR('{}#{}').format(depot_path[2:], rev)
+        return os.path.join(self.symlink_dir, depot_ish)
+
+    def add(self, depot_path, rev, sha1):
+        '''Record that depot_path#rev printed to blob sha1.'''
+        path = self._path(depot_path, rev)
+        p4gf_util.ensure_parent_dir(path)
+        try:
+            os.symlink(NTR('.git/objects/{}/{}').format(sha1[:2], sha1[2:]), path)
+        except FileExistsError:
+            return False
+        return True
+
+    def get(self, depot_path, rev):
+        '''Return sha1 of depot_path#rev's blob, or None if never printed.'''
+        try:
+            target = os.readlink(self._path(depot_path, rev))
+        except OSError:
+            return None
+        return target[len('.git/objects/'):].replace('/', '')
+
+    def contains(self, depot_path, rev):
+        '''Have we already printed depot_path#rev?'''
+        return os.path.islink(self._path(depot_path, rev))
+
+    def commit(self):
+        '''NOP: every add() is already on disk.'''
+        pass
+
+    def close(self):
+        '''NOP'''
+        pass
+
+# -- end class SymlinkRevIndex ------------------------------------------------
+
+
+def _bench_one(index, count, files_per_dir):
+    '''
+    Add count revisions, then look each one up, then look up count
+    revisions that were never added. Return (add, hit, miss) seconds.
+    '''
+    def depot_path(i):
+        '''Spread revisions across directories, several revs per file.'''
+        n = i // 4
+        return NTR('//depot/dir{}/sub{}/file{}.c').format(
+                    n // (files_per_dir * 10), (n // files_per_dir) % 10, n)
+
+    start = time.time()
+    for i in range(count):
+        index.add(depot_path(i), 1 + i % 4, NTR('{:040x}').format(i))
+    index.commit()
+    add_secs = time.time() - start
+
+    start = time.time()
+    for i in range(count):
+        assert index.contains(depot_path(i), 1 + i % 4)
+    hit_secs = time.time() - start
+
+    start = time.time()
+    for i in range(count):
+        assert not index.contains(depot_path(i), 5)
+    miss_secs = time.time() - start
+    return (add_secs, hit_secs, miss_secs)
+
+
+def _inode_count(path):
+    '''Number of files, links, and directories under path.'''
+    count = 0
+    for _root, dirs, files in os.walk(path):
+        count += len(dirs) + len(files)
+    return count
+
+
+def main():
+    '''
+    Benchmark PrintedRevIndex against SymlinkRevIndex.
+    '''
+    parser = p4gf_util.create_arg_parser(
+        _('Benchmark the printed-revision index against per-revision symlinks.'))
+    parser.add_argument('--count', type=int, default=100000,
+                        help=_('number of file revisions to record'))
+    parser.add_argument('--dir', default=NTR('p4gf_printed_rev_bench'),
+                        help=_('scratch directory, deleted when done'))
+    parser.add_argument('--files-per-dir', type=int, default=100,
+                        help=_('files per depot directory'))
+    args = parser.parse_args()
+
+    if os.path.exists(args.dir):
+        sys.stderr.write(_('{} already exists\n').format(args.dir))
+        sys.exit(1)
+    fmt = NTR('{name:<10} add:{add:8.2f}s  hit:{hit:8.2f}s  miss:{miss:8.2f}s'
+              '  {rate:10,.0f} adds/s  inodes:{inodes:,d}')
+    try:
+        for name, index, root in [
+                ( NTR('sqlite')
+                , PrintedRevIndex(os.path.join(args.dir, NTR('sqlite'), NTR('printed.db')))
+                , os.path.join(args.dir, NTR('sqlite')))
+              , ( NTR('symlink')
+                , SymlinkRevIndex(os.path.join(args.dir, NTR('symlink')))
+                , os.path.join(args.dir, NTR('symlink')))]:
+            (add, hit, miss) = _bench_one(index, args.count, args.files_per_dir)
+            index.close()
+            print(fmt.format( name   = name
+                            , add    = add
+                            , hit    = hit
+                            , miss   = miss
+                            , rate   = args.count / add if add else 0
+                            , inodes = _inode_count(root) ))
+    finally:
+        shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,11 @@ were using 800MB of memory, the child will as well, even though all it may
 be doing is running `ps`.
 
 Note that on Darwin this is not a problem.
+
+ProcessRunner keeps a pool of such child processes so that concurrent
+callers (threads) need not wait for each other's commands. Size the pool
+with the P4GF_PROC_WORKER_COUNT environment variable, usually set in the
+P4GF_ENV configuration file. Default is 1.
 """
 
 import io
@@ -19,6 +24,8 @@ import queue
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
@@ -26,6 +33,8 @@ from p4gf_const import GIT_BIN as git_bin
 from p4gf_const import GIT_BIN_DEFAULT as git_bin_default
 
 import p4gf_char
+import p4gf_const
+import p4gf_histogram
 from   p4gf_l10n      import _, NTR
 
 LOG = logging.getLogger(__name__)
@@ -33,6 +42,11 @@ LOG = logging.getLogger(__name__)
 ChildProc = None
 ParentProc = None
 
+                        # Child sends standard output larger than this
+                        # through its scratch file rather than pickling
+                        # it through the result queue.
+_STREAM_THRESHOLD = 64 * 1024
+
 
 def translate_git_cmd(cmd):
     '''Translate git commands from 'git' to value in GIT_BIN, which defaults to 'git' '''
@@ -71,18 +85,35 @@ def install_stack_dumper():
     signal.signal(signal.SIGUSR1, _dumper)
 
 
-def init():
+def worker_count():
+    """
+    How many child processes should ProcessRunner launch?
+    """
+    value = os.environ.get(p4gf_const.P4GF_PROC_WORKER_COUNT_NAME)
+    if not value:
+        return 1
+    try:
+        return max(1, int(value))
+    except ValueError:
+        LOG.warning('{} has invalid value {}, defaulting to 1'
+                    .format(p4gf_const.P4GF_PROC_WORKER_COUNT_NAME, value))
+        return 1
+
+
+def init(count=None):
     """
-    Launch the separate Python process for running commands. This should
+    Launch the separate Python processes for running commands. This should
     be invoked early in the process, before gobs of memory are allocated,
-    otherwise the child will consume gobs of memory as well.
+    otherwise the children will consume gobs of memory as well.
+
+    count: number of child processes, default from worker_count().
     """
     global ChildProc, ParentProc
     if ChildProc and not ParentProc == os.getpid():
         ChildProc = None
     if not ChildProc:
         ParentProc = os.getpid()
-        ChildProc = ProcessRunner()
+        ChildProc = ProcessRunner(count if count else worker_count())
         ChildProc.start()
         return True
     return False
@@ -181,6 +212,21 @@ def popen_binary(cmd_, expect_error=False, stdin=None, env=None):
     return result
 
 
+def popen_to_file(cmd_, out_path, expect_error=False, stdin=None, env=None):
+    """
+    Run the command with its standard output written to the file out_path,
+    for output too large to hold in memory. The caller reads that file.
+    The result dict's "out" is empty, "err" is binary.
+    """
+    if _validate_popen(cmd_) is None:
+        return None
+    cmd = translate_git_cmd(cmd_)
+    result = ChildProc.popen_to_file(cmd, out_path, stdin, env)
+    result['cmd'] = ' '.join(cmd_)
+    _log_cmd_result(result, expect_error)
+    return result
+
+
 def popen_no_throw(cmd, stdin=None, env=None):
     """
     Call popen() and return, even if popen() returns a non-zero returncode.
@@ -244,19 +290,40 @@ def call(cmd_, stdin=None, env=None):
     return result['ec']
 
 
-def _cmd_runner(event, incoming, outgoing):
+def _read_scratch(out_file):
+    """
+    Return the contents of a child's scratch file if small enough to send
+    back through the result queue, or None if the parent should read it.
+    """
+    out_file.flush()
+    size = os.fstat(out_file.fileno()).st_size
+    if _STREAM_THRESHOLD < size:
+        return None
+    out_file.seek(0)
+    return out_file.read()
+
+
+def _cmd_runner(event, incoming, outgoing, out_path):
     """
     Running in a separate process, this function invokes subprocess.Popen()
     to perform the actual task of running a subprocess. This should never
     be called directly, but instead launched via multiprocessing.Process().
+
+    Commands write their standard output straight into scratch file
+    out_path, rewritten for each command. Small output returns through
+    outgoing. Large output stays in out_path, and the result holds
+    "out_path" instead of "out": the parent reads it from there before
+    sending us another command. Commands sent with a stdout_path write
+    their standard output there instead, for the parent to read.
     """
     LOG.debug("_cmd_runner() running, pid={}".format(os.getpid()))
     install_stack_dumper()
+    out_file = open(out_path, 'w+b')
     try:
         while not event.is_set():
             try:
                 # Use timeout so we loop around and check the event.
-                (cmd, stdin, cwd, wait_, call_, env) = incoming.get(timeout=1)
+                (cmd, stdin, cwd, wait_, call_, env, stdout_path) = incoming.get(timeout=1)
                 # By taking a command list vs a string, we implicitly avoid
                 # shell quoting. Also note that we are intentionally _not_
                 # using the shell, to avoid security vulnerabilities.
@@ -275,13 +342,28 @@ def _cmd_runner(event, incoming, outgoing):
                     elif call_:
                         result["ec"] = subprocess.call(cmd, stdin=stdin_file,
                                                        restore_signals=False, env=env)
+                    elif stdout_path:
+                        with open(stdout_path, 'wb') as stdout_file:
+                            p = subprocess.Popen(cmd, cwd=cwd, stdout=stdout_file,
+                                                 stderr=subprocess.PIPE, stdin=subprocess.PIPE,
+                                                 restore_signals=False, env=env)
+                            fd = p.communicate(stdin)
+                        result["err"] = fd[1]
+                        result["ec"] = p.returncode
                     else:
-                        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                        out_file.seek(0)
+                        out_file.truncate()
+                        p = subprocess.Popen(cmd, cwd=cwd, stdout=out_file,
                                              stderr=subprocess.PIPE, stdin=subprocess.PIPE,
                                              restore_signals=False, env=env)
                         fd = p.communicate(stdin)
                         # return the raw binary, let higher level funcs decode it
-                        result["out"] = fd[0]
+                        out = _read_scratch(out_file)
+                        if out is None:
+                            del result["out"]
+                            result["out_path"] = out_path
+                        else:
+                            result["out"] = out
                         result["err"] = fd[1]
                         result["ec"] = p.returncode
                 except IOError as e:
@@ -302,39 +384,120 @@ def _cmd_runner(event, incoming, outgoing):
         LOG.error("_cmd_runner() died unexpectedly, pid={}: {}".format(os.getpid(), e))
         event.set()
     # pylint: enable=W0703
+    finally:
+        out_file.close()
+        try:
+            os.unlink(out_path)
+        except OSError:
+            pass
 
 
-class ProcessRunner():
+class _Worker:
     """
-    Manages a child process which receives commands to be run via the
-    subprocess module, returning the output to the caller.
+    One child process and the queues that carry its commands and results.
     """
+    def __init__(self, event):
+        self.input    = multiprocessing.Queue()
+        self.output   = multiprocessing.Queue()
+        (fd, self.out_path) = tempfile.mkstemp(
+                                  prefix=p4gf_const.P4GF_TEMP_DIR_PREFIX
+                                       + NTR('proc_'))
+        os.close(fd)
+        pargs = [event, self.input, self.output, self.out_path]
+        self.process = multiprocessing.Process( target=_cmd_runner
+                                              , args=pargs
+                                              , daemon=True)
+
+    def remove_scratch(self):
+        """
+        Delete our child's scratch file. The child may still hold it open.
+        """
+        try:
+            os.unlink(self.out_path)
+        except OSError:
+            pass
+
+    def read_out(self, result):
+        """
+        If our child left its output in its scratch file,
+        move that into result["out"].
+        """
+        if "out_path" not in result:
+            return
+        with open(result.pop("out_path"), 'rb') as f:
+            result["out"] = f.read()
 
+
+class _CmdStats:
+    """
+    Count, cumulative time, and latency/queue-wait histograms for one
+    git command.
+    """
     def __init__(self):
+        self.count        = 0
+        self.elapsed      = 0.0
+        self.queue_wait   = 0.0
+        self.latency_hist = p4gf_histogram.latency_histogram()
+        self.wait_hist    = p4gf_histogram.latency_histogram()
+
+    def add(self, elapsed, queue_wait):
+        """Record one command."""
+        self.count      += 1
+        self.elapsed    += elapsed
+        self.queue_wait += queue_wait
+        p4gf_histogram.add_latency(self.latency_hist, elapsed)
+        p4gf_histogram.add_latency(self.wait_hist,    queue_wait)
+
+
+class ProcessRunner():
+    """
+    Manages a pool of child processes which receive commands to be run via
+    the subprocess module, returning the output to the caller.
+
+    Each command goes to whichever child is idle. Callers in different
+    threads run their commands concurrently, up to the number of children.
+    """
+
+    def __init__(self, count=1):
+        self.__count = max(1, count)
         self.__event = None
-        self.__input = None
-        self.__output = None
+        self.__workers = []
+        self.__idle = None
         self.__stats = {}
+        self.__stats_lock = threading.Lock()
 
     def log_stats(self):
         """
         log statistics for git commands run
         """
-        LOG.debug("\nProcessRunner statistics:\n" +
-                  "\n".join(["\t{:10.10}: {:6} {:6.3f}".format(k, v[0], v[1])
-                  for (k, v) in self.__stats.items()]))
+        with self.__stats_lock:
+            items = sorted(self.__stats.items())
+        LOG.debug("\nProcessRunner statistics ({} workers):\n".format(self.__count) +
+                  "\n".join(["\t{:10.10}: {:6} {:6.3f} wait {:6.3f}"
+                             .format(k, v.count, v.elapsed, v.queue_wait)
+                  for (k, v) in items]))
+        if not LOG.isEnabledFor(logging.DEBUG2):
+            return
+        for (k, v) in items:
+            for title, hist in [ (NTR('latency'),    v.latency_hist)
+                               , (NTR('queue wait'), v.wait_hist) ]:
+                lines = p4gf_histogram.latency_lines(hist)
+                if lines:
+                    LOG.debug2("ProcessRunner {} {} ms:\n\t".format(k, title)
+                               + "\n\t".join(lines))
 
     def start(self):
         """
-        Start the child process and prepare to run commands.
+        Start the child processes and prepare to run commands.
         """
         self.__event = multiprocessing.Event()
-        self.__input = multiprocessing.Queue()
-        self.__output = multiprocessing.Queue()
-        pargs = [self.__event, self.__input, self.__output]
-        p = multiprocessing.Process(target=_cmd_runner, args=pargs, daemon=True)
-        p.start()
-        LOG.debug("ProcessRunner started child {}, pid={}".format(p.pid, os.getpid()))
+        self.__workers = [_Worker(self.__event) for _i in range(self.__count)]
+        self.__idle = queue.Queue()
+        for w in self.__workers:
+            w.process.start()
+            self.__idle.put(w)
+            LOG.debug("ProcessRunner started child {}, pid={}"
+                      .format(w.process.pid, os.getpid()))
         if LOG.isEnabledFor(logging.DEBUG3):
             sink = io.StringIO()
             traceback.print_stack(file=sink)
@@ -343,48 +506,74 @@ class ProcessRunner():
 
     def stop(self):
         """
-        Signal the child process to terminate. Does not wait.
+        Signal the child processes to terminate. Does not wait.
         """
         if self.__event:
             self.__event.set()
+            for w in self.__workers:
+                w.remove_scratch()
             self.__event = None
-            self.__input = None
-            self.__output = None
+            self.__workers = []
+            self.__idle = None
         self.log_stats()
 
-    def run_cmd(self, cmd_, stdin, _wait, _call, env):
+    def _acquire(self, event, idle):
+        """
+        Wait for an idle child. Return None if our children are stopping.
+        """
+        while not event.is_set():
+            try:
+                return idle.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+    def run_cmd(self, cmd_, stdin, _wait, _call, env, stdout_path=None):
         """
         Invoke the given command via subprocess.Popen() and return the
         exit code, standard output, and standard error in a dict.
         """
-        if not self.__input:
+        if not self.__idle:
             LOG.warn("ProcessRunner.run_cmd() called before start()")
             self.start()
+        event = self.__event
+        idle = self.__idle
 
         # Make the child process use whatever happens to be our current
         # working directory, which seems to matter with Git.
         cwd = os.getcwd()
         start_time = time.time()
         cmd = translate_git_cmd(cmd_)  # translate the 'git' command if needed
-        self.__input.put((cmd, stdin, cwd, _wait, _call, env))
+        worker = self._acquire(event, idle)
+        if not worker:
+            raise RuntimeError(_('Error running: {}').format(cmd))
+        run_time = time.time()
         result = None
-        while not self.__event.is_set():
-            try:
-                result = self.__output.get(timeout=1)
-                break
-            except queue.Empty:
-                pass
+        try:
+            worker.input.put((cmd, stdin, cwd, _wait, _call, env, stdout_path))
+            while not event.is_set():
+                try:
+                    result = worker.output.get(timeout=1)
+                    break
+                except queue.Empty:
+                    pass
+            if result:
+                worker.read_out(result)
+        finally:
+            idle.put(worker)
         if not result:
             raise RuntimeError(_('Error running: {}').format(cmd))
         if cmd_[0] == "git":
             git_cmd = cmd_[1]
             if git_cmd.startswith("--git-dir") or git_cmd.startswith("--work-tree"):
                 git_cmd = cmd_[2]
-            elapsed_time = time.time() - start_time
-            current = self.__stats.get(git_cmd, (0, 0))
-            self.__stats[git_cmd] = (current[0] + 1, current[1] + elapsed_time)
+            end_time = time.time()
+            with self.__stats_lock:
+                stats = self.__stats.get(git_cmd)
+                if not stats:
+                    stats = self.__stats[git_cmd] = _CmdStats()
+                stats.add(end_time - run_time, run_time - start_time)
         return result
-
     def popen(self, cmd, stdin, env=None):
         """
         Invoke the given command via subprocess.Popen() and return the
@@ -392,6 +581,15 @@ class ProcessRunner():
         """
         return self.run_cmd(cmd, stdin, _wait=False, _call=False, env=env)
 
+    def popen_to_file(self, cmd, stdout_path, stdin, env=None):
+        """
+        Invoke the given command via subprocess.Popen() with its standard
+        output written to stdout_path. Return the exit code and standard
+        error in a dict.
+        """
+        return self.run_cmd(cmd, stdin, _wait=False, _call=False, env=env,
+                            stdout_path=stdout_path)
+
     def wait(self, cmd, stdin, env=None):
         """
         Invoke the given command via subprocess.Popen() and return the
@@ -2,6 +2,8 @@
 
 """Wrapper for 'p4 protect' table."""
 
+import hashlib
+import json
 import logging
 import os
 
@@ -9,6 +11,7 @@ import P4
 
 from   p4gf_path import enquote, dequote
 import p4gf_const
+from   p4gf_ensure_dir import ensure_dir
 from   p4gf_l10n import _, NTR
 
 LOG = logging.getLogger(__name__)
@@ -198,6 +201,15 @@ def get_remote_client_addr():
     return None
 
 
+def _protects_host():
+    """Return the host to pass to 'p4 protects -h', or None."""
+    # Override the host for use in the protects call.
+    # If set, it allows admins to require access via a proxy.
+    if p4gf_const.P4GF_PROTECTS_HOST in os.environ:
+        return os.environ[p4gf_const.P4GF_PROTECTS_HOST]
+    return get_remote_client_addr()
+
+
 def _create_protect_for_user(p4, user, client_name=None):
     """Create a new Protect object from 'p4 protects -u <user>'
     If user is None, return empty Protect
@@ -208,13 +220,7 @@ def _create_protect_for_user(p4, user, client_name=None):
 
     client = '//' + client_name + '/...' if client_name else None
 
-
-    # Override the host for use in the protects call.
-    # If set, it allows admins to require access via a proxy.
-    if p4gf_const.P4GF_PROTECTS_HOST in os.environ:
-        host = os.environ[p4gf_const.P4GF_PROTECTS_HOST]
-    else:
-        host = get_remote_client_addr()
+    host = _protects_host()
 
     LOG.debug('_create_protect_for_user() using host {} for user {}'.format(host, user))
     if client:
@@ -230,6 +236,69 @@ def _create_protect_for_user(p4, user, client_name=None):
     return Protect.from_protects(r)
 
 
+def _sha1(text):
+    """Return the hex SHA1 of a str."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class ViewProtectsCache:
+    """Results of 'p4 protects -u <user> //<client>/...', keyed by the
+    client's view lines, shared by all processes on this Git Fusion host
+    and all repos.
+
+    A user's protections for a view are a function of the view and of the
+    protections table lines that apply to that user and host: exactly what
+    'p4 protects -u <user>' without a path returns. So that result is our
+    stamp. Cached results recorded under any other stamp are discarded:
+    any change to the protections table or the user's groups that
+    affects this user invalidates them.
+
+    One JSON file per server, user, and host under P4GF_HOME, replaced
+    all at once so concurrent readers never see half of one.
+    """
+
+                        # Discard all of a user's views past this many,
+                        # rather than grow one file without bound.
+    MAX_VIEWS = 1000
+
+    def __init__(self, p4, user, protect):
+        self.path = os.path.join(
+              p4gf_const.P4GF_HOME
+            , p4gf_const.P4GF_PROTECTS_CACHE_DIR
+            , _sha1('\0'.join([p4.port, user, _protects_host() or ''])) + '.json')
+        self.stamp = _sha1(json.dumps(protect.get_protects_dict(), sort_keys=True))
+        self.views = {}
+        try:
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+            if content[NTR('stamp')] == self.stamp:
+                self.views = content[NTR('views')]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def get(self, view_lines):
+        """Return a Protect for view_lines, or None if not cached."""
+        protects = self.views.get(_sha1('\n'.join(view_lines)))
+        if protects is None:
+            return None
+        return Protect.from_protects(protects)
+
+    def put(self, view_lines, protect):
+        """Remember protect for view_lines."""
+        if self.MAX_VIEWS <= len(self.views):
+            self.views = {}
+        self.views[_sha1('\n'.join(view_lines))] = protect.get_protects_dict()
+        ensure_dir(os.path.dirname(self.path))
+        tmp_path = NTR('{}.{}').format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({ NTR('stamp') : self.stamp
+                          , NTR('views') : self.views }, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            LOG.warning('cannot write protects cache {}: {}'.format(self.path, e))
+
+
 class UserToProtect:
     """Caching/Factory object that maintains a cache of Protect objects,
     one per requested user, and knows how to create those Protect objects
@@ -239,6 +308,7 @@ class UserToProtect:
     def __init__(self, p4):
         self._p4 = p4
         self._user_to_protect = {}
+        self._user_to_view_cache = {}
 
     def user_to_protect(self, user):
         """Return a Protect object for user, from cache if one already
@@ -256,6 +326,30 @@ class UserToProtect:
         """
         return  _create_protect_for_user(self._p4, user, client_name=view)
 
+    def user_view_lines_to_protect(self, user, view, view_lines, switch_view):
+        """Return a Protect object for user + //view/..., where client view
+        has, or is about to have, view_lines.
+
+        From the shared ViewProtectsCache if some earlier check of the same
+        user and view lines left one there and the user's protections have
+        not changed since. Otherwise call switch_view() to set client view's
+        lines, then run 'p4 protects' and cache the result.
+        """
+        if not user:
+            return Protect()
+        cache = self._user_to_view_cache.get(user)
+        if not cache:
+            cache = ViewProtectsCache(self._p4, user, self.user_to_protect(user))
+            self._user_to_view_cache[user] = cache
+        p = cache.get(view_lines)
+        if p:
+            LOG.debug2('user_view_lines_to_protect() cache hit for user {}'.format(user))
+            return p
+        switch_view()
+        p = self.user_view_to_protect(user, view)
+        cache.put(view_lines, p)
+        return p
+
 def _map_inclusion_can_bypass_files(mapapi):
     """Do any of the map's lines contain wildcards other than terminal ... ?
     Any exclusions?
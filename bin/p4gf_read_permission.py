@@ -11,6 +11,7 @@ import P4
 import p4gf_const
 from   p4gf_l10n           import _, NTR
 import p4gf_log
+import p4gf_path
 import p4gf_util
 import p4gf_protect
 import p4gf_config
@@ -64,11 +65,51 @@ def _remove_view_modifier(line):
     return l
 
 
-def _compare_paths(path_a, path_b):
+def _compile_path(line):
+    """
+    Precompile a view or protect line for _compare_compiled_paths().
+
+    Return (literal, is_tree) for a path with no wildcard other than a
+    trailing '...': ('//depot/a/', True) for //depot/a/... , or
+    ('//depot/a/f', False) for //depot/a/f . Return None for any other
+    path: only P4.Map can compare those.
+    """
+    path = p4gf_path.dequote(_remove_view_modifier(line))
+    is_tree = path.endswith('...')
+    if is_tree:
+        path = path[:-3]
+    for wild in p4gf_protect.WILDCARDS:
+        if wild in path:
+            return None
+    return (path, is_tree)
+
+
+def _compare_compiled_paths(a, b):
+    """
+    Return the relation between two paths precompiled by _compile_path(),
+    same as _compare_paths() would, with only string prefix comparisons.
+    """
+    (a_path, a_tree) = a
+    (b_path, b_tree) = b
+    if a == b:
+        return PATHS.EQUAL
+    if b_tree and a_path.startswith(b_path):
+        return PATHS.SUBSET
+    if a_tree and b_path.startswith(a_path):
+        return PATHS.SUPERSET
+    return PATHS.NO_OVERLAP
+
+
+def _compare_paths(path_a, path_b, compiled_a=None, compiled_b=None):
     """
     Return the relation between two paths as named in the enums below.
     Ignore leading - or +
+
+    Pass _compile_path() results for either path to skip P4.Map work
+    when both paths have no wildcards other than a trailing '...'.
     """
+    if compiled_a and compiled_b:
+        return _compare_compiled_paths(compiled_a, compiled_b)
     a = _remove_view_modifier(path_a)
     b = _remove_view_modifier(path_b)
     if a == b:
@@ -297,10 +338,12 @@ class ReadPermission:
             else:
                 view_mark_inclusion.append((v, False, False))
         lastidx = len(view_mark_inclusion) -1
+        compiled_views = [_compile_path(v) for v in view_lines]
         for p in read_protections[::-1]:               # reverser order slice
+            compiled_p = _compile_path(p)
             for vix in range(lastidx, -1, -1):
                 vmi = view_mark_inclusion[vix]
-                result = _compare_paths(vmi[VIEW], p)
+                result = _compare_paths(vmi[VIEW], p, compiled_views[vix], compiled_p)
                 if result ==  PATHS.NO_OVERLAP:
                     continue                           # vmi inner loop
                 if p.startswith('-'):                  # p is exclusion
@@ -334,9 +377,15 @@ class ReadPermission:
         """
         LOG.debug ("read_permission_check_for_view : switch to branch dict {0}".
                 format(branch.to_log(LOG)))
-        self.switch_client_view_to_branch(branch)
-        self.user_branch_protections = self.user_to_protect.user_view_to_protect(self.p4user,
-                self.p4client)
+        if branch.stream_name:
+            # Stream views are not known until we switch to the stream.
+            self.switch_client_view_to_branch(branch)
+            self.user_branch_protections = self.user_to_protect.user_view_to_protect(
+                    self.p4user, self.p4client)
+        else:
+            self.user_branch_protections = self.user_to_protect.user_view_lines_to_protect(
+                    self.p4user, self.p4client, branch.view_p4map.as_array(),
+                    lambda: self.switch_client_view_to_branch(branch))
         self.current_branch = branch
         return self.check_views_read_permission()
 
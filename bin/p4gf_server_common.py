@@ -29,6 +29,13 @@ LOG = p4gf_log.for_module()
 COMMAND_TO_PERM = {'git-upload-pack': p4gf_group.PERM_PULL,
                    'git-receive-pack': p4gf_group.PERM_PUSH}
 
+                        # time.time() until which the server-wide checks
+                        # (readiness, lock permission, protects, p4gf_init)
+                        # are known to have passed. p4gf_daemon.py runs them
+                        # periodically; the request handlers it forks
+                        # inherit this value and skip the checks.
+_checks_passed_until = 0
+
 
 class CommandError(RuntimeError):
     """
@@ -68,6 +75,30 @@ class ExceptionAuditLogger:
         return False # False = do not squelch. Propagate
 
 
+def checks_passed():
+    """
+    Did a long-lived parent process already run the server-wide checks
+    recently enough for us to skip them?
+    """
+    return time.time() < _checks_passed_until
+
+
+def record_checks_passed(ttl):
+    """
+    Remember that the server-wide checks passed, for ttl seconds.
+    """
+    global _checks_passed_until
+    _checks_passed_until = time.time() + ttl
+
+
+def forget_checks_passed():
+    """
+    Require the next request to run the server-wide checks itself.
+    """
+    global _checks_passed_until
+    _checks_passed_until = 0
+
+
 def check_protects(p4):
     """Check that the protects table is either empty or that the Git
     Fusion user is granted sufficient privileges. Returns False if this
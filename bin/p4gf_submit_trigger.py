@@ -28,6 +28,20 @@ P4GF_P4_BINARY = "p4"
 
 # For Windows systems use no spaces in the p4.exe path
 #P4GF_P4_BINARY = "C:\PROGRA~1\Perforce\p4.exe"
+
+# Use P4Python, if it is installed for the python that runs this trigger,
+# to run all of a trigger's p4 commands over one connection per Perforce
+# user instead of launching the p4 binary for every command.
+# Set to False to always launch the p4 binary.
+P4GF_USE_P4PYTHON = True
+
+# Record how long each trigger run takes, and where that time goes, so that
+# administrators can see what these triggers add to each submit.
+# Set to a file path to append one line per trigger run to that file.
+P4GF_TRIGGER_TIMING_LOG = None
+# Set to True to store the most recent line for each trigger type in
+# counter 'git-fusion-trigger-timing-<trigger type>'.
+P4GF_TRIGGER_TIMING_COUNTER = False
 # -----------------------------------------------------------------------------
 
 import sys
@@ -102,6 +116,20 @@ except ImportError:
                         # pylint:enable=C0103
                         # pylint:enable=W9903
 
+                        # Optional single-connection support.
+                        # If P4Python is installed, run p4 commands over
+                        # one connection per user rather than launching
+                        # the p4 binary for each one.
+P4 = None
+if P4GF_USE_P4PYTHON:
+    # pylint:disable=F0401
+    # Unable to import
+    try:
+        import P4
+    except ImportError:
+        pass
+    # pylint:enable=F0401
+
 
 # Find the 'p4' command line tool.
 # If this fails, edit P4GF_P4_BINARY in the "Configuration"
@@ -182,6 +210,9 @@ CHANGE_FOUND_END = False
 P4GF_HEARTBEATS             = "git-fusion-view-*-lock-heartbeat"
 HEARTBEAT_TIMEOUT_SECS      = 60
 
+# Most recent P4GF_TRIGGER_TIMING_COUNTER line, per trigger type.
+P4GF_COUNTER_TRIGGER_TIMING = NTR('git-fusion-trigger-timing-{0}')
+
 # Value for counter P4GF_REVIEWS_NON_GF_SUBMIT when submit trigger decided this
 # changelist requires no further processing by this trigger.
 #
@@ -315,6 +346,7 @@ QUOTE_PLUS_WHITE   = re.compile(r'(.*[^"]+)("[\t ]+)(.*)')
 NOLOGIN_REGEX         = re.compile(r'Perforce password \(P4PASSWD\) invalid or unset')
 CONNECT_REGEX         = re.compile(r'.*TCP connect to.*failed.*')
 CHANGE_UNKNOWN_REGEX  = re.compile(r'Change \d+ unknown')
+UNICODE_REGEX         = re.compile(r'Unicode server permits only unicode enabled clients')
 TRUST_REGEX  = re.compile(r"^.*authenticity of '(.*)' can't.*fingerprint.*p4 trust.*$",
     flags=re.DOTALL)
 TRUST_MSG  = _("""
@@ -326,6 +358,90 @@ ACTION_RESET  = NTR('reset')
 ACTION_UNSET  = NTR('unset')
 ACTION_ADD    = NTR('add')
 
+
+class TriggerTimer:
+    """Wall-clock cost of one trigger run, by phase.
+
+    Call phase() as each step of the trigger begins; each phase ends when
+    the next one begins. p4_run() and friends report time spent in p4
+    commands with add_p4_command().
+    """
+    def __init__(self):
+        self.start         = time.time()
+        self.phases        = []     # [(name, seconds)] in the order run
+        self.phase_name    = None
+        self.phase_start   = None
+        self.p4_count      = 0
+        self.p4_seconds    = 0.0
+        self.connect_seconds = 0.0
+
+    def phase(self, name):
+        """End the current phase, if any, and start the named one."""
+        self.end_phase()
+        self.phase_name  = name
+        self.phase_start = time.time()
+
+    def end_phase(self):
+        """End the current phase, if any."""
+        if self.phase_name:
+            self.phases.append((self.phase_name, time.time() - self.phase_start))
+            self.phase_name = None
+
+    def add_p4_command(self, seconds):
+        """Record one p4 command's run time."""
+        self.p4_count   += 1
+        self.p4_seconds += seconds
+
+    def to_line(self, trigger_type, change):
+        """Return a single line describing this trigger run."""
+        self.end_phase()
+        mode = NTR('p4python') if [p for p in _P4PYTHON.values() if p] else NTR('p4')
+        parts = [ NTR('{0} change={1}').format(trigger_type, change)
+                , NTR('total={0:.1f}ms').format(_ms(time.time() - self.start))
+                , NTR('p4={0}/{1:.1f}ms').format(self.p4_count, _ms(self.p4_seconds))
+                , NTR('connect={0:.1f}ms').format(_ms(self.connect_seconds))
+                , NTR('mode={0}').format(mode) ]
+        for name, seconds in self.phases:
+            parts.append(NTR('{0}={1:.1f}ms').format(name, _ms(seconds)))
+        return ' '.join(parts)
+
+
+def _ms(seconds):
+    """Seconds to milliseconds."""
+    return seconds * 1000.0
+
+TIMER = TriggerTimer()
+
+
+def report_timing(trigger_type, change):
+    """Log this trigger run's timing where the admin asked us to.
+
+    Never fail a submit because we could not record its timing.
+    """
+    if not (P4GF_TRIGGER_TIMING_LOG or P4GF_TRIGGER_TIMING_COUNTER or GF_TRIGGER_DEBUG):
+        return
+    line = TIMER.to_line(trigger_type, change)
+    print_debug(line)
+    if P4GF_TRIGGER_TIMING_LOG:
+        try:
+            f = open(P4GF_TRIGGER_TIMING_LOG, 'a')
+            try:
+                f.write("{0} {1}\n".format(
+                    datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), line))
+            finally:
+                f.close()
+        except (IOError, OSError) as e:
+            print_debug(_("Cannot write timing log {0}: {1}")
+                        .format(P4GF_TRIGGER_TIMING_LOG, e))
+    if P4GF_TRIGGER_TIMING_COUNTER:
+        # pylint: disable=W0703
+        # Catch Exception
+        try:
+            set_counter(P4GF_COUNTER_TRIGGER_TIMING.format(trigger_type), line)
+        except (Exception, SystemExit) as e:
+            print_debug(_("Cannot set timing counter: {0}").format(e))
+        # pylint: enable=W0703
+
 def mini_usage(invalid=False):
     """Argument help"""
     _usage = ''
@@ -685,15 +801,219 @@ def p4_print(depot_path):
     return contents
 
 
+# -- P4Python single-connection mode -------------------------------------------
+#
+# A trigger run issues a dozen or so p4 commands, and each launch of the p4
+# binary costs a process spawn plus a connect and login to p4d, all on the
+# submit's critical path. With P4Python we connect once per Perforce user
+# and run every command over that connection.
+#
+# Results are converted to what 'p4 -G' would have returned, so callers
+# cannot tell which way a command ran. Anything we cannot convert (stdin
+# input, unknown global options, a lost connection) launches p4 instead.
+
+_P4PYTHON = {}   # user -> connected P4.P4, or None if that user must launch p4
+
+
+def _p4python_connection(user):
+    """Return a connected P4.P4 for user, or None to launch p4 instead."""
+    if P4 is None or not P4PORT:
+        return None
+    if user in _P4PYTHON:
+        return _P4PYTHON[user]
+    start = time.time()
+    p4 = P4.P4()
+    p4.port = P4PORT
+    p4.user = user
+    p4.prog = NTR('p4gf_submit_trigger')
+    p4.exception_level = 0
+    # pylint: disable=W0703
+    # Catch Exception
+    try:
+        if CHARSET:
+            p4.charset = CHARSET[-1]
+        p4.connect()
+    except Exception as e:
+        # Let the p4 binary report why it cannot connect.
+        print_debug(_("P4Python cannot connect as '{0}': {1}").format(user, e))
+        p4 = None
+    # pylint: enable=W0703
+    TIMER.connect_seconds += time.time() - start
+    _P4PYTHON[user] = p4
+    return p4
+
+
+def p4python_disconnect():
+    """Close all of our P4Python connections."""
+    for user, p4 in list(_P4PYTHON.items()):
+        if p4:
+            try:
+                p4.disconnect()
+            except P4.P4Exception:
+                pass
+        del _P4PYTHON[user]
+
+
+def _p4python_args(cmd):
+    """Split cmd into (client, args) for P4.run().
+
+    Handles the few p4 global options these triggers use: -c client,
+    -x argfile, and -ztag (P4Python is already tagged).
+    Return None for anything else.
+    """
+    client = None
+    file_args = []
+    i = 0
+    while i < len(cmd) and cmd[i].startswith('-'):
+        if cmd[i] == '-ztag':
+            i += 1
+        elif cmd[i] == '-c' and i + 1 < len(cmd):
+            client = cmd[i + 1]
+            i += 2
+        elif cmd[i] == '-x' and i + 1 < len(cmd):
+            f = open(cmd[i + 1], 'rb')
+            try:
+                lines = f.read().splitlines()
+            finally:
+                f.close()
+            for line in lines:
+                if line:
+                    file_args.append(decode(line) if PYTHON3 else line)
+            i += 2
+        else:
+            return None
+    if i == len(cmd):
+        return None
+    return (client, list(cmd[i:]) + file_args)
+
+
+def _p4python_execute(cmd, user, input_data=None):
+    """Run cmd over user's P4Python connection.
+
+    Return (command, results, errors, warnings), or None if the caller must
+    launch p4 instead.
+    """
+    global CHARSET
+    p4 = _p4python_connection(user)
+    if not p4:
+        return None
+    parsed = _p4python_args(cmd)
+    if not parsed:
+        return None
+    (client, args) = parsed
+    old_client = p4.client
+    try:
+        if client:
+            p4.client = client
+        if input_data is not None:
+            p4.input = input_data
+        results = p4.run(*args)
+        errors   = list(p4.errors)
+        warnings = list(p4.warnings)
+        if client:
+            p4.client = old_client
+    except P4.P4Exception:
+        results = None
+    if results is None or not p4.connected():
+        # Lost our connection. Launch p4 for this and every later command.
+        _P4PYTHON[user] = None
+        return None
+
+    if (not CHARSET) and errors and UNICODE_REGEX.search(errors[0]):
+        # Same retry as _p4_run_process(), for all connections.
+        CHARSET = ['-C', 'utf8']
+        p4python_disconnect()
+        return _p4python_execute(cmd, user, input_data)
+    return (args[0], results, errors, warnings)
+
+
+def _p4python_to_g(command, results, errors, warnings):
+    """Convert P4Python results and messages to 'p4 -G' dictionaries."""
+    data = []
+    for r in results:
+        if isinstance(r, dict):
+            d = {'code': 'stat'}
+            for key, value in r.items():
+                if isinstance(value, list):
+                    for i, v in enumerate(value):
+                        d[key + str(i)] = v
+                else:
+                    d[key] = value
+            data.append(d)
+        else:
+            code = NTR('text') if command == 'print' else NTR('info')
+            data.append({'code': code, 'data': r})
+    for severity, messages in ((3, errors), (2, warnings)):
+        for msg in messages:
+            data.append({'code': NTR('error'), 'data': msg + '\n',
+                         'severity': severity, 'generic': 0})
+    return _convert_bytes(data)
+
+
+def p4python_run(cmd, user=P4GF_USER):
+    """Run cmd over a P4Python connection and return 'p4 -G' dictionaries.
+
+    Return None if the caller must launch p4 instead.
+    """
+    r = _p4python_execute(cmd, user)
+    if r is None:
+        return None
+    data = _p4python_to_g(*r)
+    _exit_if_not_logged_in(data, user)
+    return data
+
+
+def _p4python_run_ztag(cmd, user):
+    """Run cmd over a P4Python connection and return 'p4 -ztag' lines,
+    without their leading '... '.
+
+    Return None if the caller must launch p4 instead.
+    """
+    r = _p4python_execute(cmd, user)
+    if r is None:
+        return None
+    (command, results, errors, warnings) = r
+    _exit_if_not_logged_in(_p4python_to_g(command, [], errors, warnings), user)
+    if errors:
+        print (_("Error in Git Fusion Trigger \n{0}").format(errors[0]))
+        sys.exit(P4FAIL)
+    lines = []
+    for item in results:
+        if isinstance(item, dict):
+            for key, value in item.items():
+                if isinstance(value, list):
+                    for i, v in enumerate(value):
+                        lines.append("{0}{1} {2}".format(key, i, v))
+                else:
+                    lines.append("{0} {1}".format(key, value))
+    return _convert_bytes(lines)
+
+
 _unicode_error = [{'generic': 36,
                    'code': NTR('error'),
                    'data': _('Unicode server permits only unicode enabled clients.\n'),
                    'severity': 3}]
 
+def p4_run(cmd, stdin=None, user=P4GF_USER):
+    """Use the -G option to return a list of dictionaries.
+
+    Runs over a P4Python connection if we have one, else launches p4.
+    """
+    start = time.time()
+    try:
+        data = None
+        if stdin is None:
+            data = p4python_run(cmd, user=user)
+        if data is None:
+            data = _p4_run_process(cmd, stdin=stdin, user=user)
+        return data
+    finally:
+        TIMER.add_p4_command(time.time() - start)
+
 # pylint: disable=R0912
 # Too many branches
-def p4_run(cmd, stdin=None, user=P4GF_USER):
-    """Use the -G option to return a list of dictionaries."""
+def _p4_run_process(cmd, stdin=None, user=P4GF_USER):
+    """Launch p4 -G and return its list of dictionaries."""
     raw_cmd = cmd
     global CHARSET
     while True:
@@ -734,6 +1054,14 @@ def p4_run(cmd, stdin=None, user=P4GF_USER):
                             # pylint: enable=W0212
             data.append({"Error": ret})
         break
+    _exit_if_not_logged_in(data, user)
+    if ret:
+        print (_("Error in Git Fusion Trigger \n{0}").format(data[0]['data']))
+        sys.exit(P4FAIL)
+    return data
+
+def _exit_if_not_logged_in(data, user):
+    """Report and exit if p4d rejected our login or our trust."""
     if len(data) and 'code' in data[0] and data[0]['code'] == 'error':
         if NOLOGIN_REGEX.match(data[0]['data']):
             print(_("\nGit Fusion Submit Trigger user '{0}' is not logged in.\n{1}").
@@ -743,10 +1071,7 @@ def p4_run(cmd, stdin=None, user=P4GF_USER):
         if m:
             print(TRUST_MSG)
             sys.exit(P4FAIL)
-    if ret:
-        print (_("Error in Git Fusion Trigger \n{0}").format(data[0]['data']))
-        sys.exit(P4FAIL)
-    return data
+
 
 def p4_run_ztag(cmd, stdin=None, user=P4GF_USER):
     """Call p4 using the -ztag option to stdout.
@@ -754,6 +1079,12 @@ def p4_run_ztag(cmd, stdin=None, user=P4GF_USER):
     This is required to avoid sorting dictionary data when
     calling p4 reviews.
     """
+    if stdin is None:
+        start = time.time()
+        data = _p4python_run_ztag(cmd, user)
+        if data is not None:
+            TIMER.add_p4_command(time.time() - start)
+            return data
     raw_cmd = cmd
     cmd = [P4GF_P4_BIN, "-p", P4PORT, "-u", user, "-ztag"] + CHARSET + raw_cmd
     try:
@@ -1110,6 +1441,22 @@ def update_userspec(userspec, user, p4user=P4GF_USER):
             newspec = "{0}\n{1}:\t{2}".format(newspec, key, val)
 
     newspec = newspec + reviews
+    if p4user != P4GF_USER:
+        cmd = NTR(['user', '-f', '-i'])
+        runner = p4user
+    else:
+        cmd = NTR(['user', '-i'])
+        runner = user
+    start = time.time()
+    r = _p4python_execute(cmd, runner, input_data=newspec)
+    if r is not None:
+        TIMER.add_p4_command(time.time() - start)
+        errors = r[2]
+        if errors:
+            print ("{0}".format('\n'.join(errors)))
+            print(MSG_MALFORMED_CONFIG)
+        return
+
     file_ = tempfile.NamedTemporaryFile(prefix='p4gf-trigger-userspec', delete=False)
     line = "%s" % newspec
     file_.write(encode(line))
@@ -1299,6 +1646,7 @@ def change_submit_trigger(change, client):
     # Only 'submit' - not 'submit -e' - has opened files
     # Set the counter value with the command type.
     # The change-content trigger will reset the counter with the list of files
+    TIMER.phase(NTR('opened'))
     data = p4_run(['opened', '-m', '1' , '-c',  change, '-C', client])
     submit_command = 'submit' if data else 'submit -e'
     counter = get_trigger_countername(change)
@@ -1342,6 +1690,7 @@ def change_content_trigger(change, client, command, args):
 
     try:
         # set methods and data for this change_content trigger
+        TIMER.phase(NTR('reviews'))
         content_trigger = ContentTrigger(change, client, command, args)
         content_trigger.check_if_locked_by_review()
         if content_trigger.is_locked:
@@ -1353,16 +1702,21 @@ def change_content_trigger(change, client, command, args):
             returncode = P4FAIL
         elif content_trigger.is_in_union:   # needs protection from GF
             # Get the change list files into content_trigger.cfiles
+            TIMER.phase(NTR('files'))
             content_trigger.get_cfiles()
 
             # Now get the user spec lock
+            TIMER.phase(NTR('lock'))
             acquire_counter_lock(P4GF_REVIEWS__NON_GF)
             counter_lock_acquired = True
             if not P4D_14_OR_LATER:
+                TIMER.phase(NTR('cleanup'))
                 cleanup_previous_submits()
             # add our Reviews
+            TIMER.phase(NTR('add-reviews'))
             add_non_gf_reviews(content_trigger)
             # now check again
+            TIMER.phase(NTR('recheck-reviews'))
             content_trigger.check_if_locked_by_review()
             if content_trigger.is_locked:
                 # Locked by GF .. so remove the just added locked files from reviews
@@ -1381,6 +1735,7 @@ def change_content_trigger(change, client, command, args):
         returncode = P4FAIL
     # pylint: enable=W0703
     finally:
+        TIMER.phase(NTR('release'))
         if content_trigger:
             content_trigger.cleanup_populate_reviews_file()
         if counter_lock_acquired:
@@ -1580,13 +1935,16 @@ def change_commit_p4gf_config(change, user=P4GF_USER):
     # Catch Exception
 
     try:
+        TIMER.phase(NTR('lock'))
         acquire_counter_lock(P4GF_REVIEWS__ALL_GF, user=user)
+        TIMER.phase(NTR('add-reviews'))
         add_repo_views_to_union(change, user=user)
     except Exception as exce:
         print (MSG_PRE_SUBMIT_FAILED)
         print (_("Exception: {0}").format(exce))
         returncode = P4FAIL
     finally:
+        TIMER.phase(NTR('release'))
         release_counter_lock(P4GF_REVIEWS__ALL_GF, user=user)
     return returncode
 
@@ -1620,12 +1978,15 @@ def change_commit_trigger(change):
     lock_acquired = False
     # pylint: disable=W0703
     try:
+        TIMER.phase(NTR('counter'))
         countername = get_trigger_countername(change)
         value = get_counter(countername)
+        TIMER.phase(NTR('lock'))
         acquire_counter_lock(P4GF_REVIEWS__NON_GF)
         lock_acquired = True
         if str(value) != "0":    # valid non-gf counter
             # the first 2 counter array items are submit_type and client
+            TIMER.phase(NTR('remove-reviews'))
             (submit_type, client, filecount) = get_submit_counter_data(value)
             remove_counter_and_reviews(change)
         else:
@@ -1634,12 +1995,14 @@ def change_commit_trigger(change):
             # thus we must rely on the heuristic cleanup approach
             # for 14.x the old changelist parameter is accurate and no cleanup code is required
             if not P4D_14_OR_LATER:
+                TIMER.phase(NTR('cleanup'))
                 cleanup_previous_submits()
     except Exception as exce:
         print (MSG_POST_SUBMIT_FAILED)
         print (exce.args)
         returncode = P4FAIL
     finally:
+        TIMER.phase(NTR('release'))
         if lock_acquired:
             release_counter_lock(P4GF_REVIEWS__NON_GF)
     return returncode
@@ -1837,6 +2200,33 @@ def print_debug(msg):
         print("\n" + str(msg))
 
 
+def run_trigger(args):
+    """Run the trigger that p4d invoked us as, return its exit code."""
+    TIMER.phase(NTR('server-type'))
+    set_p4d_server_type()
+    #print("p4gf_submit_trigger Args:\n{0}\n".format(args))
+    exitcode = P4PASS
+    if args.trigger_type in TRIGGER_TYPES:
+        if args.trigger_type == 'change-submit':
+            exitcode = change_submit_trigger(args.change, args.client)
+        elif args.trigger_type == 'change-content':
+            exitcode = change_content_trigger(args.change, args.client
+                                            , args.command, args.args)
+        elif args.trigger_type == 'change-commit':
+            # the change-commit trigger sets the oldchangelist - use it
+            if args.oldchangelist:
+                args.change = args.oldchangelist
+            exitcode = change_commit_trigger(args.change)
+        elif args.trigger_type == 'change-failed':
+            exitcode = change_failed_trigger(args.change)
+        elif args.trigger_type == 'change-commit-p4gf-config':
+            exitcode = change_commit_p4gf_config(args.change)
+    else:
+        print(_("Invalid trigger type: {0}").format(args.trigger_type))
+        exitcode = P4FAIL
+    return exitcode
+
+
 # pylint: disable=R0912
 # Too many branches
 # pylint: disable=R0915
@@ -1855,27 +2245,11 @@ def main():
             # See P4PORT global override at top of this file
             if not P4PORT:
                 P4PORT = args.serverport
-            set_p4d_server_type()
-            # pylint: disable=W0703
-            #print("p4gf_submit_trigger Args:\n{0}\n".format(args))
-            if args.trigger_type in TRIGGER_TYPES:
-                if args.trigger_type == 'change-submit':
-                    exitcode = change_submit_trigger(args.change, args.client)
-                elif args.trigger_type == 'change-content':
-                    exitcode = change_content_trigger(args.change, args.client
-                                                    , args.command, args.args)
-                elif args.trigger_type == 'change-commit':
-                    # the change-commit trigger sets the oldchangelist - use it
-                    if args.oldchangelist:
-                        args.change = args.oldchangelist
-                    exitcode = change_commit_trigger(args.change)
-                elif args.trigger_type == 'change-failed':
-                    exitcode = change_failed_trigger(args.change)
-                elif args.trigger_type == 'change-commit-p4gf-config':
-                    exitcode = change_commit_p4gf_config(args.change)
-            else:
-                print(_("Invalid trigger type: {0}").format(args.trigger_type))
-                exitcode = P4FAIL
+            try:
+                exitcode = run_trigger(args)
+            finally:
+                report_timing(args.trigger_type, args.change)
+                p4python_disconnect()
     else:
         # we have been called with optional args to perform a support task
         if args.set_version_counter:
@@ -63,8 +63,7 @@ def _add_tag(ctx, name, sha1, edit_list, add_list):
         obj = ctx.view_repo.get(sha1)
         if obj.type == pygit2.GIT_OBJ_TAG:
             LOG.debug("_add_tag() annotated tag {}".format(name))
-            op = p4gf_git.object_path(sha1)
-            os.link(op, fpath)
+            p4gf_git.link_object(sha1, fpath)
         else:
             # Lightweight tags can be anything: commit, tree, blob
             LOG.debug("_add_tag() lightweight tag {}".format(name))
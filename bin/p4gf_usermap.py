@@ -13,6 +13,7 @@ import logging
 import os
 import re
 import sys
+import time
 
 import p4gf_env_config    # pylint: disable=W0611
 import p4gf_const
@@ -25,28 +26,61 @@ import p4gf_util
 
 LOG = logging.getLogger('p4gf_usermap')
 
-# Only sync the user map once per run.
-_user_map_synced = False
 USERMAP_REGEX = re.compile('([^ \t]+)[ \t]+([^ \t]+)[ \t]+"?([^"]+)"?')
 
 
-def _find_by_tuple_index(index, find_value, users):
-    """
-    Return the first matching element of tuple_list that matches
-    find_value.
-
-    Return None if not found.
-    """
-    for usr in users:
-        if usr[index] == find_value:
-            return usr
-    return None
-
 # Because tuple indexing is less work for Zig than converting to NamedTuple
 TUPLE_INDEX_P4USER   = 0
 TUPLE_INDEX_EMAIL    = 1
 TUPLE_INDEX_FULLNAME = 2
 
+                        # Loaded maps, shared by every UserMap in this
+                        # process, so that a long-lived process serving
+                        # many repos loads each only once.
+                        #
+                        # (P4PORT, local path) ==> (head change, _UserTable)
+_USER_MAP_FILES   = {}
+                        # (P4PORT, case-sensitive) ==> (time loaded, _UserTable)
+_P4_USERS         = {}
+                        # P4PORT ==> True if server is case-sensitive
+_CASE_SENSITIVE   = {}
+
+                        # Seconds after which a UserMap fetches a new
+                        # 'p4 users' list rather than use one that an
+                        # earlier UserMap fetched.
+_P4_USERS_MAX_AGE = 300
+
+
+class _UserTable:
+    """
+    3-tuples indexed by p4user and by email.
+
+    Where more than one tuple has the same p4user or email, the first
+    one added wins, same as a front-to-back list scan.
+    """
+
+    def __init__(self, tuples=None):
+        self.by_index = {TUPLE_INDEX_P4USER: {}, TUPLE_INDEX_EMAIL: {}}
+        for t in tuples or []:
+            self.add(t)
+
+    def add(self, um_3tuple):
+        """
+        Index one 3-tuple, unless earlier tuples already claim its keys.
+        """
+        for (index, d) in self.by_index.items():
+            d.setdefault(um_3tuple[index], um_3tuple)
+
+    def find(self, index, value):
+        """
+        Return the first 3-tuple whose tuple[index] == value, or None.
+        """
+        return self.by_index[index].get(value)
+
+    def __len__(self):
+        return len(self.by_index[TUPLE_INDEX_P4USER])
+
+
 # pylint: disable=C0103
 # C0103 Invalid name
 # The correct type is P4User, not p4user.
@@ -68,18 +102,33 @@ class UserMap:
     Mapping of Git authors to Perforce users. Caches the lists of users
     to improve performance when performing repeated searches (e.g. when
     processing a Git push consisting of many commits).
+
+    Lookups are dict lookups, not list scans. The p4gf_usermap file and
+    'p4 users' list are loaded once and shared by all UserMap instances in
+    this process: the file until its head changelist changes, the user
+    list for up to _P4_USERS_MAX_AGE seconds, or until a lookup misses in
+    a list that this instance did not fetch itself.
     """
 
     def __init__(self, p4):
-        # List of 3-tuples: first whatever's loaded from p4gf_usermap,
-        # then followed by single tuples fetched from 'p4 users' to
-        # satisfy later lookup_by_xxx() requests.
+        # Indexed 3-tuples loaded from p4gf_usermap.
         self.users = None
 
-        # List of 3-tuples, filled in only if needed.
-        # Complete list of all Perforce user specs, as 3-tuples.
+        # Indexed 3-tuples fetched from 'p4 users' to satisfy earlier
+        # lookup_by_xxx() requests. Searched after p4gf_usermap, before
+        # 'p4 users', same as if appended to p4gf_usermap.
+        self.found = _UserTable()
+
+        # Indexed 3-tuples, filled in only if needed.
+        # Complete list of all Perforce user specs.
         self.p4users = None
 
+        # Did this instance fetch self.p4users, or use an older list?
+        self._p4users_fresh = False
+
+        # (tuple index, value) pairs that matched nobody.
+        self._misses = set()
+
         self.p4 = p4
         self._case_sensitive = None
 
@@ -88,29 +137,47 @@ class UserMap:
         Returns True if the server indicates case-handling is 'sensitive',
         and False otherwise.
         """
+        if self._case_sensitive is None:
+            self._case_sensitive = _CASE_SENSITIVE.get(self.p4.port)
         if self._case_sensitive is None:
             info = p4gf_util.first_dict(self.p4.run('info'))
             self._case_sensitive = info.get('caseHandling') == 'sensitive'
+            _CASE_SENSITIVE[self.p4.port] = self._case_sensitive
         return self._case_sensitive
 
     def _read_user_map(self):
         """
-        Reads the user map file from Perforce into a list of tuples,
+        Reads the user map file from Perforce into a table of tuples,
         consisting of username, email address, and full name. If no
-        such file exists, an empty list is returned.
+        such file exists, an empty table is returned.
 
-        Returns a list of 3-tuples: (p4user, email, fullname)
+        Reuses the table that an earlier UserMap read, unless the file's
+        head changelist has changed since.
+
+        Returns a _UserTable of 3-tuples: (p4user, email, fullname)
         """
-        usermap = []
         root = p4gf_util.p4_to_p4gf_dir(self.p4)
         mappath = root + '/users/p4gf_usermap'
 
-        global _user_map_synced
-        if not _user_map_synced:
-            # don't let a writable usermap file get in our way
-            self.p4.run('sync', '-fq', mappath)
-            _user_map_synced = True
+        head = p4gf_util.first_value_for_key(
+                    self.p4.run('fstat', '-T', 'headChange', mappath), 'headChange')
+        key = (self.p4.port, mappath)
+        cached = _USER_MAP_FILES.get(key)
+        if cached and cached[0] == head:
+            return cached[1]
+
+        # don't let a writable usermap file get in our way
+        self.p4.run('sync', '-fq', mappath)
+        usermap = _UserTable(self._parse_user_map(mappath))
+        _USER_MAP_FILES[key] = (head, usermap)
+        LOG.debug('Loaded {} users from {} @{}'.format(len(usermap), mappath, head))
+        return usermap
 
+    def _parse_user_map(self, mappath):
+        """
+        Return a list of 3-tuples from the user map file, in file order.
+        """
+        usermap = []
         if not os.path.exists(mappath):
             return usermap
 
@@ -151,41 +218,71 @@ class UserMap:
                 users.append((name, r['Email'], r['FullName']))
         return users
 
+    def _p4users_table(self, refresh=False):
+        """
+        Return a _UserTable of 'p4 users', fetching it only if this process
+        has no recent copy, or refresh is True.
+        """
+        if self.p4users is None or refresh:
+            key = (self.p4.port, self._is_case_sensitive())
+            cached = _P4_USERS.get(key)
+            if (   refresh
+                or not cached
+                or cached[0] + _P4_USERS_MAX_AGE < time.time()):
+                cached = (time.time(), _UserTable(self._get_p4_users()))
+                _P4_USERS[key] = cached
+                self._p4users_fresh = True
+            self.p4users = cached[1]
+        return self.p4users
+
+    def _find_p4user(self, index, value):
+        """
+        Return 3-tuple from 'p4 users' whose tuple matches requested value.
+
+        A miss in a list that some earlier UserMap fetched might be a user
+        created since. Fetch a new list and try again.
+        """
+        user = self._p4users_table().find(index, value)
+        if not user and not self._p4users_fresh:
+            user = self._p4users_table(refresh=True).find(index, value)
+        return user
+
     def _lookup_by_tuple_index(self, index, value):
         """
         Return 3-tuple for user whose tuple matches requested value.
 
         Searches in order:
-        * p4gf_usermap (stored in first portion of self.users)
-        * previous lookup results (stored in last portion of self.users)
+        * p4gf_usermap (stored in self.users)
+        * previous lookup results (stored in self.found)
         * 'p4 users' (stored in self.p4users)
 
         Lazy-fetches p4gf_usermap and 'p4 users' as needed.
 
-        O(n) list scan.
+        Dict lookups. Remembers misses, too.
         """
-        if not self.users:
+        if (index, value) in self._misses:
+            return None
+        if self.users is None:
             self.users = self._read_user_map()
         # Look for user in existing map. If found return. We're done.
-        user = _find_by_tuple_index(index, value, self.users)
+        user = self.users.find(index, value) or self.found.find(index, value)
         if user:
             return user
 
         # Look for user in Perforce.
-        if not self.p4users:
-            self.p4users = self._get_p4_users()
-        user = _find_by_tuple_index(index, value, self.p4users)
+        user = self._find_p4user(index, value)
 
         if not user:
             # Look for the "unknown git" user, if any.
-            user = _find_by_tuple_index(TUPLE_INDEX_P4USER,
-                                       p4gf_const.P4GF_UNKNOWN_USER,
-                                       self.p4users)
+            user = self.p4users.find(TUPLE_INDEX_P4USER,
+                                     p4gf_const.P4GF_UNKNOWN_USER)
 
         # Remember this search hit for later so that we don't have to
-        # re-scan our p4users list again.
+        # re-search our p4users list again.
         if user:
-            self.users.append(user)
+            self.found.add(user)
+        else:
+            self._misses.add((index, value))
 
         return user
 
@@ -212,12 +309,10 @@ class UserMap:
         """
         Return True if we saw this p4user in 'p4 users' list.
         """
-        # Look for user in Perforce.
-        if not self.p4users:
-            self.p4users = self._get_p4_users()
         if not self._is_case_sensitive():
             p4user = p4user.casefold()
-        user = _find_by_tuple_index(TUPLE_INDEX_P4USER, p4user, self.p4users)
+        # Look for user in Perforce.
+        user = self._find_p4user(TUPLE_INDEX_P4USER, p4user)
         if user:
             return True
         return False
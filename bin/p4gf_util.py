@@ -27,6 +27,7 @@ import p4gf_bootstrap  # pylint: disable=W0611
 import p4gf_const
 from   p4gf_ensure_dir import parent_dir, ensure_dir, ensure_parent_dir
 from   p4gf_l10n       import _, NTR, mo_dir
+import p4gf_lru_cache
 import p4gf_p4msg
 import p4gf_p4msgid
 import p4gf_path
@@ -495,28 +496,139 @@ def reset_git_enviro(p4=None):
         os.chdir(view_dirs.GIT_WORK_TREE)
 
 
+                        # Per-process registry of shared pygit2.Repository
+                        # objects, so that helpers below need not discover
+                        # and open the repo on every call.
+                        #
+                        # dict { cwd : git dir found from there }
+_GIT_DIR_FOR_CWD = {}
+                        # dict { git dir : pygit2.Repository }
+_GIT_REPO        = {}
+
+                        # Object-existence caches, per git dir.
+                        #
+                        # dict { git dir : LRUCache { sha1 : True } }
+                        # Objects known to exist. Git objects do not go away
+                        # while we run, so these stay true.
+_SHA1_EXISTS     = {}
+                        # Objects known not to exist, until something
+                        # writes objects: see sha1_exists_invalidate().
+_SHA1_MISSING    = {}
+_SHA1_CACHE_SIZE = 100000
+
+
+def git_repo(git_dir=None):
+    '''
+    Return a shared pygit2.Repository for git_dir, or for the repo that
+    contains the current working directory if git_dir is None.
+
+    Raises KeyError or ValueError, as pygit2 does, if no such repo.
+    '''
+    return _git_dir_repo(git_dir)[1]
+
+
+def _git_dir_repo(git_dir=None):
+    '''
+    Return (git dir, shared pygit2.Repository). See git_repo().
+    '''
+    if git_dir is None:
+        cwd = os.getcwd()
+        git_dir = _GIT_DIR_FOR_CWD.get(cwd)
+        if not git_dir or not os.path.isdir(git_dir):
+            git_dir = os.path.abspath(pygit2.discover_repository(cwd))
+            _GIT_DIR_FOR_CWD[cwd] = git_dir
+    else:
+        git_dir = os.path.abspath(git_dir)
+    repo = _GIT_REPO.get(git_dir)
+    if repo is None or not os.path.isdir(git_dir):
+                        # New, or deleted and maybe re-created since we
+                        # opened it. Nothing we knew about it still holds.
+        repo = pygit2.Repository(git_dir)
+        _GIT_REPO[git_dir] = repo
+        _SHA1_EXISTS .pop(git_dir, None)
+        _SHA1_MISSING.pop(git_dir, None)
+    return (git_dir, repo)
+
+
+def forget_git_repos():
+    '''
+    Drop every shared Repository and cached object-existence answer.
+    Call after deleting or replacing a Git repo out from under us.
+    '''
+    _GIT_DIR_FOR_CWD.clear()
+    _GIT_REPO.clear()
+    _SHA1_EXISTS.clear()
+    _SHA1_MISSING.clear()
+
+
+def _sha1_cache(caches, git_dir):
+    '''
+    Return git_dir's LRUCache from caches, creating it if necessary.
+    '''
+    cache = caches.get(git_dir)
+    if cache is None:
+        cache = p4gf_lru_cache.LRUCache(_SHA1_CACHE_SIZE, git_dir)
+        caches[git_dir] = cache
+    return cache
+
+
 def sha1_exists(sha1):
     '''
     Check if there's an object in the repo for the given sha1.
     '''
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
-        return sha1 in repo
+        (git_dir, repo) = _git_dir_repo()
+        exists  = _sha1_cache(_SHA1_EXISTS,  git_dir)
+        missing = _sha1_cache(_SHA1_MISSING, git_dir)
+        if exists.get(sha1):
+            return True
+        if missing.get(sha1):
+            return False
+        if sha1 in repo:
+            exists.put(sha1, True)
+            return True
+        missing.put(sha1, True)
+        return False
     except KeyError:
         return False
     except ValueError:
         return False
 
 
+def note_sha1s_exist(sha1_list):
+    '''
+    We just wrote these objects into the current working directory's repo.
+    Tell sha1_exists().
+    '''
+    try:
+        git_dir = _git_dir_repo()[0]
+    except (KeyError, ValueError):
+        return
+    exists  = _sha1_cache(_SHA1_EXISTS,  git_dir)
+    missing = _SHA1_MISSING.get(git_dir)
+    for sha1 in sha1_list:
+        exists.put(sha1, True)
+        if missing is not None:
+            missing.pop(sha1)
+
+
+def sha1_exists_invalidate():
+    '''
+    Something (git-fast-import, a restore from our Perforce mirror, an
+    unpack) just wrote objects we cannot list. Forget every sha1 that
+    sha1_exists() knows to be missing.
+    '''
+    for cache in _SHA1_MISSING.values():
+        cache.clear()
+
+
 def git_rev_list_1(commit):
     """Return the sha1 of a single commit, usually specified by ref.
 
     Return None if no such commit.
     """
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
+        repo = git_repo()
         obj = repo.revparse_single(commit)
         return obj.hex
     except KeyError:
@@ -530,8 +642,7 @@ def git_sha1_to_parents(child_sha1):
     Retrieve the list of all parents of a single commit.
     '''
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
+        repo = git_repo()
         obj = repo.get(child_sha1)
         if obj.type == pygit2.GIT_OBJ_COMMIT:
             return [parent.hex for parent in obj.parents]
@@ -548,8 +659,7 @@ def sha1_for_branch(branch):
     Return None if no such branch.
     """
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
+        repo = git_repo()
         ref = repo.lookup_reference(fully_qualify(branch))
         return ref.hex
     except KeyError:
@@ -561,8 +671,7 @@ def sha1_for_branch(branch):
 def git_empty():
     """Is our git repo completely empty, not a single commit?"""
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
+        repo = git_repo()
         return len(repo.listall_references()) == 0
     except KeyError:
         return True
@@ -591,8 +700,7 @@ def git_ref_list_to_sha1(ref_list):
     Output a dict of ref to sha1.
     '''
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
+        repo = git_repo()
     except KeyError:
         return None
     except ValueError:
@@ -1234,8 +1342,7 @@ def is_bare_git_repo():
     Is the Git repo already loaded for --bare?
     '''
     try:
-        path = pygit2.discover_repository('.')
-        repo = pygit2.Repository(path)
+        repo = git_repo()
         return repo.is_bare
     except KeyError:
         return False